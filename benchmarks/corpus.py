@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+"""
+Generate a synthetic library of chordpro songs for benchmarking, along with a book file
+and a setlist that picks some of them out.
+
+usage:
+
+python3 benchmarks/corpus.py <directory> [-n SONGS] [options]
+
+Songs are made up from a fixed vocabulary with a seeded random number generator,
+so the same options always give the same library.
+"""
+
+import argparse
+import os
+import random
+
+roots = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+variants = ["", "", "", "m", "m", "7", "m7", "maj7", "sus4", "6", "9", "dim", "add9"]
+words = ["love", "road", "night", "river", "heart", "home", "rain", "morning", "train", "song",
+         "dance", "light", "gone", "again", "down", "the", "a", "my", "your", "and", "we", "were",
+         "walking", "singing", "on", "under", "over", "blue", "moon", "town", "whiskey", "time"]
+sections = ["Verse", "Chorus", "Bridge"]
+
+
+def song_text(rng, number, chord_density = 0.3, transpose_fraction = 0.2, new_pages = 0,
+              define_fraction = 0.1, lines_per_section = 4, sections_per_song = 6):
+    """ Text of one chordpro song
+    chord_density: chance of each word having a chord in front of it
+    transpose_fraction: chance of the song having a {transpose: } directive
+    new_pages: number of {new_page} directives in the song
+    define_fraction: chance of the song having its own {define: } for one of its chords
+    """
+    key = rng.choice(roots)
+    title = "Song %05d %s %s" % (number, rng.choice(words).title(), rng.choice(words).title())
+    lines = ["{title: %s}" % title, "{key: %s}" % key]
+    if rng.random() < transpose_fraction:
+        lines.append("{transpose: %+d %+d}" % (rng.randint(1, 5), -rng.randint(1, 5)))
+    chords_used = []
+    page_breaks = sorted(rng.sample(range(1, sections_per_song), min(new_pages, sections_per_song - 1)))
+    for section in range(sections_per_song):
+        if section in page_breaks:
+            lines.append("{new_page}")
+        name = sections[section % len(sections)]
+        if name == "Chorus":
+            lines.append("{soc}")
+        else:
+            lines.append("{c: %s}" % name)
+        for line in range(lines_per_section):
+            line_words = []
+            for word in range(rng.randint(5, 9)):
+                word = rng.choice(words)
+                if rng.random() < chord_density:
+                    chord = rng.choice(roots) + rng.choice(variants)
+                    chords_used.append(chord)
+                    word = "[%s]%s" % (chord, word)
+                line_words.append(word)
+            lines.append(" ".join(line_words))
+        if name == "Chorus":
+            lines.append("{eoc}")
+        lines.append("")
+    if chords_used and rng.random() < define_fraction:
+        frets = " ".join(str(rng.randint(0, 5)) for string in range(4))
+        lines.insert(2, "{define: %s frets %s}" % (rng.choice(chords_used), frets))
+    return title, "\n".join(lines) + "\n"
+
+
+def generate(songs, seed = 1, **options):
+    """ Returns a list of (file name, title, text) for a library of songs, see song_text for the options """
+    rng = random.Random(seed)
+    library = []
+    for number in range(songs):
+        title, text = song_text(rng, number, **options)
+        library.append(("song_%05d.cho.txt" % number, title, text))
+    return library
+
+
+def setlist_text(library, seed = 1, songs = 20, sets = 2):
+    """ A setlist picking out some songs (by the first few words of their titles) from a library """
+    rng = random.Random(seed)
+    picked = rng.sample(library, min(songs, len(library)))
+    lines = ["{title: Benchmark setlist}", ""]
+    per_set = max(1, len(picked) // sets)
+    for i, (file_name, title, text) in enumerate(picked):
+        if i % per_set == 0 and i // per_set < sets:
+            lines.append("# Set %s" % (i // per_set + 1))
+        lines.append("## %s" % " ".join(title.split(" ")[:2]))
+        if i % 3 == 0:
+            lines.append("Count it in slowly")
+    return "\n".join(lines) + "\n"
+
+
+def write(directory, library, setlist = None):
+    """ Write the songs, a book file listing them all (book.txt) and the setlist (setlist.md) """
+    os.makedirs(directory, exist_ok=True)
+    for file_name, title, text in library:
+        with open(os.path.join(directory, file_name), "w") as f:
+            f.write(text)
+    with open(os.path.join(directory, "book.txt"), "w") as f:
+        f.write("{title: Benchmark book}\n")
+        f.write("\n".join(file_name for file_name, title, text in library) + "\n")
+    if setlist != None:
+        with open(os.path.join(directory, "setlist.md"), "w") as f:
+            f.write(setlist)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='Where to write the songs, book file and setlist')
+    parser.add_argument('-n', '--songs', type=int, default=100, help='Number of songs')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--chord-density', type=float, default=0.3, help='Chance of each word having a chord')
+    parser.add_argument('--transpose-fraction', type=float, default=0.2, help='Fraction of songs with a {transpose: } directive')
+    parser.add_argument('--new-pages', type=int, default=0, help='Number of {new_page} directives in each song')
+    parser.add_argument('--define-fraction', type=float, default=0.1, help='Fraction of songs with their own {define: }')
+    parser.add_argument('--setlist-songs', type=int, default=20, help='Number of songs in the setlist')
+    args = vars(parser.parse_args())
+    library = generate(args["songs"], args["seed"],
+                       chord_density = args["chord_density"],
+                       transpose_fraction = args["transpose_fraction"],
+                       new_pages = args["new_pages"],
+                       define_fraction = args["define_fraction"])
+    write(args["directory"], library, setlist_text(library, args["seed"], args["setlist_songs"]))
+    print("Wrote %s songs to %s" % (len(library), args["directory"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+"""
+Measure how long it takes to start chordprobook, each run in a fresh Python process,
+as that's what an editor calling mksong on every save pays for.
+
+usage:
+
+python3 benchmarks/startup.py [-n RUNS] [--importtime]
+
+Reports the best and median times for importing the modules and for mksong --instruments,
+and which heavy modules (PIL, pypandoc, yaml) each one ended up loading.
+With --importtime also lists the slowest imports, from python -X importtime
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+heavy_modules = ["PIL", "pypandoc", "yaml"]
+
+cases = [
+    ("import chordprobook.chords", "import chordprobook.chords"),
+    ("import chordprobook.instruments", "import chordprobook.instruments"),
+    ("import chordprobook.books", "import chordprobook.books"),
+    ("mksong --instruments", "import sys, runpy; sys.argv = ['mksong', '--instruments']; runpy.run_path(%r, run_name='__main__')" % os.path.join(root, "mksong")),
+]
+
+timer = """
+import sys, time, io, contextlib
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        exec(%r)
+    except SystemExit:
+        pass
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(name for name in %r if name in sys.modules))
+"""
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+def time_case(code, runs):
+    times = []
+    loaded = ""
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", timer % (code, heavy_modules)], env=environment(), cwd=root, stderr=subprocess.DEVNULL)
+        elapsed, _, loaded = out.decode().strip().splitlines()[-1].partition(" ")
+        times.append(float(elapsed))
+    return times, loaded
+
+def slowest_imports(code, count=15):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=environment(), cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in result.stderr.decode().splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Number of runs for each case')
+    parser.add_argument('--importtime', action='store_true', help='Also show the slowest imports for each case')
+    args = vars(parser.parse_args())
+
+    print("%-34s %9s %9s  %s" % ("", "best ms", "median ms", "heavy modules loaded"))
+    for name, code in cases:
+        times, loaded = time_case(code, args["runs"])
+        print("%-34s %9.1f %9.1f  %s" % (name, min(times) * 1000, statistics.median(times) * 1000, loaded or "-"))
+        if args["importtime"]:
+            for (microseconds, module) in slowest_imports(code):
+                print("    %8.1f ms %s" % (microseconds / 1000, module))
+
+if __name__ == "__main__":
+    main()
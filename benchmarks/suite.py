@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks for the pure-Python parts of chordprobook, run against synthetic song libraries
+(see corpus.py) of different sizes.
+
+usage:
+
+python3 benchmarks/suite.py run [--sizes 10 1000 10000] [--repeat 3] [-o results.json] [--baseline baseline.json]
+python3 benchmarks/suite.py compare baseline.json results.json [--threshold 0.1]
+
+run times each benchmark (the best of --repeat runs) and saves the results as JSON.
+compare (or run --baseline) lists any benchmark that got slower by more than the threshold
+(a fraction, 0.1 is 10%) and exits with status 1 if there were any.
+
+Nothing here runs pandoc or wkhtmltopdf: whole book builds use the null renderer.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import chordprobook.books as books
+import chordprobook.chords as chords
+import chordprobook.instruments
+import chordprobook.renderers as renderers
+import corpus
+
+default_sizes = [10, 1000, 10000]
+# Differences smaller than this are noise, whatever the ratio
+noise_seconds = 0.002
+chart_dir = os.path.join(os.path.dirname(os.path.realpath(chords.__file__)), "chord_data")
+
+
+class Library:
+    """ A generated library, with everything benchmarks need set up ahead of time """
+    def __init__(self, size, directory, instruments):
+        self.size = size
+        self.songs = corpus.generate(size)
+        self.setlist = corpus.setlist_text(self.songs, songs=min(50, size))
+        self.directory = directory
+        self.instruments = instruments
+        self.formatted = None
+
+    def parse(self):
+        return [books.cp_song(text, path=os.path.join(self.directory, file_name), instruments=self.instruments)
+                for (file_name, title, text) in self.songs]
+
+    def book(self, songs):
+        book = books.cp_song_book(instruments=self.instruments)
+        book.title = "Benchmark"
+        book.songs = list(songs)
+        return book
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+# Benchmarks that depend on the size of the library: take a Library, return seconds
+
+def bench_parse(library):
+    return timed(library.parse)
+
+def bench_format(library):
+    songs = library.parse()
+    def format_all():
+        for song in songs:
+            song.format(instrument_name="Soprano Ukulele")
+    return timed(format_all)
+
+def bench_reorder(library):
+    book = library.book(library.formatted)
+    return timed(lambda: book.reorder(1, old=None, new_order=[], waiting=[]))
+
+def bench_toc(library):
+    book = library.book(library.formatted)
+    return timed(lambda: books.TOC(book, 2).format())
+
+def bench_setlist(library):
+    book = library.book(library.formatted)
+    return timed(lambda: book.order_by_setlist(library.setlist))
+
+def bench_output(library):
+    """ Whole PDF book build (HTML, chord diagrams and all) with the null renderer """
+    book = library.book(copy.deepcopy(library.formatted))
+    book.instrument_name_passed = "Soprano Ukulele"
+    book.html_cache = {} # Not the on-disk cache, so every run converts every song
+    args = {"html": False, "pdf": True, "docx": False, "odt": False, "epub": False, "a4": True}
+    renderers.use("null")
+    return timed(lambda: book.output(args, os.path.join(library.directory, "book")))
+
+# Benchmarks that don't depend on library size: take nothing, return seconds
+
+def bench_chart_load():
+    chords.ChordChart.indexes.clear()
+    paths = [os.path.join(chart_dir, name) for name in sorted(os.listdir(chart_dir)) if name.endswith(".cho")]
+    return timed(lambda: [chords.ChordChart(0, path) for path in paths])
+
+def bench_chart_load_text():
+    paths = [os.path.join(chart_dir, name) for name in sorted(os.listdir(chart_dir)) if name.endswith(".cho")]
+    def load_all():
+        for path in paths:
+            with open(path) as f:
+                chords.ChordChart().load_file(f)
+    return timed(load_all)
+
+def bench_diagrams():
+    chart = chords.ChordChart()
+    chart.load_tuning_by_name("Soprano Ukulele")
+    chart.load_all()
+    grids = [voicings.voicings[0] for voicings in chart.grids.values()][:60]
+    def render_all():
+        chords.ChordDiagram.data_URIs.clear()
+        return [grid.to_data_URI() for grid in grids]
+    return timed(render_all)
+
+def bench_fingerings():
+    guitar = chordprobook.instruments.Instrument(data={"name": "Guitar", "tuning": "EADGBE"})
+    names = [root + variant for root in ["C", "E", "F#", "Bb"] for variant in ["", "m", "7", "maj7", "sus4"]]
+    return timed(lambda: [chords.Chord(name).find_fingerings(guitar, unplayed=1) for name in names])
+
+sized_benchmarks = [("cp_song.parse", bench_parse),
+                    ("cp_song.format", bench_format),
+                    ("reorder", bench_reorder),
+                    ("TOC", bench_toc),
+                    ("order_by_setlist", bench_setlist),
+                    ("cp_song_book.output (null renderer)", bench_output)]
+fixed_benchmarks = [("ChordChart load", bench_chart_load),
+                    ("ChordChart load (text)", bench_chart_load_text),
+                    ("ChordDiagram render", bench_diagrams),
+                    ("Fingerings search", bench_fingerings)]
+
+
+def run(sizes, repeat, only = None):
+    """ Returns a dict of "name@size" (or just "name" for fixed size benchmarks) -> best time in seconds """
+    results = {}
+    def wanted(name):
+        return only == None or any(part.lower() in name.lower() for part in only)
+
+    def record(key, function, *args):
+        best = min(function(*args) for i in range(repeat))
+        results[key] = best
+        print("%-44s %10.4f s" % (key, best))
+        sys.stdout.flush()
+
+    instruments = chordprobook.instruments.Instruments()
+    for (name, function) in fixed_benchmarks:
+        if wanted(name):
+            record(name, function)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            library = Library(size, directory, instruments)
+            library.formatted = library.parse()
+            for song in library.formatted:
+                song.format(instrument_name="Soprano Ukulele")
+            for (name, function) in sized_benchmarks:
+                if wanted(name):
+                    record("%s@%s" % (name, size), function, library)
+    return results
+
+
+def compare(baseline, current, threshold = 0.1):
+    """ Print a table comparing two sets of results, returns the names of the ones that regressed """
+    regressions = []
+    print("%-44s %10s %10s %8s" % ("", "baseline s", "current s", "change"))
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > threshold and after - before > noise_seconds:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print("%-44s %10.4f %10.4f %+7.1f%%%s" % (key, before, after, change * 100, flag))
+    for key in sorted(set(baseline) ^ set(current)):
+        print("%-44s only in %s" % (key, "baseline" if key in baseline else "current results"))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument('--sizes', type=int, nargs="+", default=default_sizes, help='Library sizes (number of songs) to run at')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the best time is kept')
+    run_parser.add_argument('--only', nargs="+", default=None, help='Only run benchmarks with names containing one of these')
+    run_parser.add_argument('-o', '--output', default="benchmark-results.json", help='Where to save the results')
+    run_parser.add_argument('--baseline', default=None, help='Results file to compare against when done')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='Slow-down (as a fraction) that counts as a regression')
+    compare_parser = commands.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument('baseline', help='Results file to compare against')
+    compare_parser.add_argument('current', help='New results file')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Slow-down (as a fraction) that counts as a regression')
+    args = vars(parser.parse_args())
+
+    if args["command"] == "run":
+        results = run(args["sizes"], args["repeat"], args["only"])
+        with open(args["output"], "w") as f:
+            json.dump({"meta": {"python": platform.python_version(),
+                                "platform": platform.platform(),
+                                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                                "sizes": args["sizes"],
+                                "repeat": args["repeat"]},
+                       "results": results}, f, indent=1)
+        print("Saved results to %s" % args["output"])
+        if args["baseline"]:
+            regressions = compare(load(args["baseline"]), results, args["threshold"])
+            sys.exit(1 if regressions else 0)
+    elif args["command"] == "compare":
+        regressions = compare(load(args["baseline"]), load(args["current"]), args["threshold"])
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
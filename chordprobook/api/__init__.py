@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+"""
+Rendering songs and books in memory, for embedding chordprobook in other programs (eg a web service):
+
+    import chordprobook.api as api
+    pdf = api.render_song(open("song.cho").read(), key="D", instrument="Soprano Ukulele")
+    epub = api.render_book([text_1, text_2], title="Gig", fmt="epub")
+
+Both return the document as bytes and print nothing. Nothing is written to disk when the renderer can
+work from stdin and stdout (pandoc, wkhtmltopdf and WeasyPrint all can), apart from chordprobook's usual
+chart, fingering and diagram caches (see chordprobook.cache).
+
+They're safe to call from several threads at once: each call gets its own songs, book and Instruments
+(they hold the chart being drawn from), made from the instruments.yaml, chord chart indexes and diagrams
+loaded once for the whole process. Conversions run in the calling thread.
+"""
+import re
+import chordprobook.books as books
+import chordprobook.build as build
+import chordprobook.chords as chords
+import chordprobook.instruments as inst
+import chordprobook.renderers as renderers
+
+def check_format(fmt):
+    if fmt not in build.formats:
+        raise ValueError("Can't render %s, try one of: %s" % (fmt, ", ".join(build.formats)))
+
+
+def note_number(name):
+    """ 0 for C up to 11 for B, from a key or note name (eg F#m), raises ValueError if it isn't one """
+    match = re.match("^([A-G](#|b)?)", name.strip())
+    if match == None:
+        raise ValueError("%s isn't a key" % name)
+    return chords.Note(match.group(1)).num
+
+
+def transposition(song, key):
+    """ Semitones to transpose song by to get it into key """
+    if key == None:
+        return song.transpose or 0
+    if song.original_key == None:
+        raise ValueError("Can't put %s in %s, it has no {key: } to start from" % (song.title or "the song", key))
+    return (note_number(key) - note_number(song.original_key)) % 12
+
+
+def word_args(fmt, reference_doc = None, book = False):
+    """ pandoc options for the HTML to word processor format conversion """
+    if fmt == 'epub':
+        return ["--toc", "--toc-depth=1", "--epub-chapter-level=1"]
+    args = (["--toc", "--toc-depth=1"] if book else []) + ["--data-dir=.", "--self-contained"]
+    if reference_doc != None:
+        args.append('--reference-doc=%s' % reference_doc)
+    return args
+
+
+def render_song(text, key = None, instrument = None, fmt = 'pdf', transpose = 0, lefty = False,
+                nashville = False, major_chart = False, reference_doc = None, html_cache = None):
+    """ A single sheet for a song, as bytes
+    text: the song, in chordpro
+    key: key to put it in (eg "D"), from the song's {key: }. Or transpose it by transpose semitones
+    instrument: name of an instrument to show chord grids for, eg "Soprano Ukulele"
+    fmt: pdf, html (a stand-alone page), docx, odt or epub
+    reference_doc: reference docx or odt, for docx and odt
+    html_cache: song markdown -> HTML to share conversions through (eg books.FragmentCache.shared()),
+    by default nothing is shared """
+    check_format(fmt)
+    song = books.cp_song(text, transpose = transpose, instruments = inst.Instruments(), nashville = nashville,
+                         major_chart = major_chart, lefty = lefty)
+    if key != None and not song.nashville:
+        song.set_transpose(transposition(song, key))
+    sheet = song.sheet(instrument, song.transpose)
+
+    # Any fingerings worked out for chords the chart didn't have
+    chords.FingeringStore.save_all()
+
+    if fmt in ['pdf', 'html']:
+        html = books.songs_to_html([sheet["html_md"]], {} if html_cache == None else html_cache)[0]
+        document = books.html_book.format(html, title = sheet["title"], stand_alone = True)
+        if fmt == 'html':
+            return document.encode("utf-8")
+        return renderers.html_to_pdf_bytes(document, books.sheet_pdf_options)
+
+    args = word_args(fmt, reference_doc)
+    html = renderers.convert(song.to_final_md(), "html", format = "markdown", extra_args = args)
+    return renderers.convert_to_bytes(html, fmt, format = "html", extra_args = args)
+
+
+def render_book(songs, title = None, instrument = None, fmt = 'pdf', lefty = False, nashville = False,
+                major_chart = False, keep_order = True, reference_doc = None, html_cache = None):
+    """ A book of songs, as bytes
+    songs: the songs, in chordpro (or (text, semitones to transpose it by) pairs)
+    title: the book's title
+    keep_order: False to sort the songs by title, as mksong does
+    The rest are as for render_song, with html being the whole book on one page """
+    check_format(fmt)
+    book = books.cp_song_book(keep_order = keep_order, title = title, instruments = inst.Instruments(),
+                              instrument_name = instrument, nashville = nashville, major_chart = major_chart,
+                              lefty = lefty)
+    for number, song in enumerate(songs):
+        text, transpose = song if isinstance(song, tuple) else (song, 0)
+        book.add_song_from_text(text, "song-%s" % number, transpose)
+    book.format_sets()
+    book.format(instrument_name = instrument)
+    book_title, suffix = book.title_and_suffix(instrument)
+    # Lays out the chord grids for to_final_md too
+    song_mds = [song.to_html_md() for song in book.songs]
+    chords.FingeringStore.save_all()
+
+    if fmt in ['pdf', 'html']:
+        document, song_htmls, contents = book.html_document(book_title, song_mds, True, {} if html_cache == None else html_cache)
+        if fmt == 'html':
+            return document.encode("utf-8")
+        return renderers.html_to_pdf_bytes(document, book.pdf_options())
+
+    md = "% " + book_title + "\n\n" + "".join(song.to_final_md() for song in book.songs)
+    html = renderers.convert(md, "html", format = "markdown", extra_args = ["--self-contained"])
+    return renderers.convert_to_bytes(html, fmt, format = "html", extra_args = word_args(fmt, reference_doc, book = True))
@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+"""
+Batch builds (mksong batch nightly.yaml): lots of books, setlists and sets of single sheets from one
+manifest, in one process. Songs are parsed once for every target that has them (a shared
+books.SongCache), chord charts are indexed once (chords.ChordChart.indexes) and chord diagrams and
+song HTML are made once (chords.ChordDiagram.data_URIs, books.FragmentCache).
+
+The manifest is YAML, a target per mksong run, eg for samples/makefile:
+
+defaults:                 # options for every target
+  directory: example_output
+targets:
+  gimme:                  # the target's name, then any mksong long options (underscores or dashes)
+    one_doc: true
+    files: [gimme_a_u.cho.txt]
+  lazy:
+    book_file: sample-lazy.book.txt
+    formats: [pdf, html]  # or pdf: true, html: true
+
+Paths are relative to the manifest, and files can be glob patterns. Targets are built by a pool of
+threads (--jobs), each one running its conversions in parallel too, and the time each took is reported
+at the end.
+"""
+import glob
+import os
+import time
+import chordprobook.books as books
+import chordprobook.build as build
+import chordprobook.cache as cache
+import chordprobook.instruments as inst
+import chordprobook.renderers as renderers
+
+
+def target_args(name, options, cwd, data_dir = None):
+    """ mksong options for a target from its manifest entry, raises ValueError if it asks for something we don't know about """
+    if not isinstance(options, dict):
+        raise ValueError("Target %s should be a mapping of mksong options" % name)
+    options = dict((option.replace("-", "_"), value) for (option, value) in options.items())
+    formats = options.pop('formats', [])
+    unknown = [format for format in formats if format not in build.formats]
+    unknown += [option for option in options if option in build.request_options]
+    if unknown:
+        raise ValueError("Target %s can't do %s" % (name, ", ".join(unknown)))
+    if isinstance(options.get('files'), str):
+        options['files'] = [options['files']]
+    if options.get('files'):
+        files = []
+        for pattern in options['files']:
+            # Anything that doesn't match is left for the build to complain about
+            files += sorted(glob.glob(os.path.join(cwd, pattern))) or [pattern]
+        options['files'] = files
+    try:
+        args = build.default_args(**options)
+    except ValueError as e:
+        raise ValueError("Target %s: %s" % (name, e))
+    for format in formats:
+        args[format] = True
+    return build.prepare(args, data_dir)
+
+
+def load(path, data_dir = None):
+    """ The targets in a manifest, as a list of (name, mksong options). Raises ValueError if it's not right """
+    import yaml
+    with open(path) as f:
+        manifest = yaml.safe_load(f)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('targets'), dict):
+        raise ValueError("%s should have targets: a mapping of target names to mksong options" % path)
+    defaults = manifest.get('defaults') or {}
+    cwd = os.path.dirname(os.path.abspath(path))
+    return [(str(name), target_args(name, dict(defaults, **(options or {})), cwd, data_dir))
+            for name, options in manifest['targets'].items()]
+
+
+def build_target(name, args, cwd, song_cache):
+    """ Build one target, returns {"name", "seconds", "outputs", "error"} """
+    start = time.perf_counter()
+    result = {"name": name, "outputs": [], "error": None}
+    try:
+        result["outputs"] = build.build(args, inst.Instruments(), song_cache, cwd)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run(targets, cwd, jobs = None, song_cache = None):
+    """ Build targets (from load) with a pool of jobs threads (defaults to the number of CPUs)
+    Returns a result (see build_target) for each target, in the same order """
+    if song_cache == None:
+        song_cache = books.SongCache()
+    if jobs == 1 or len(targets) < 2:
+        return [build_target(name, args, cwd, song_cache) for name, args in targets]
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+        futures = [pool.submit(build_target, name, args, cwd, song_cache) for name, args in targets]
+        return [future.result() for future in futures]
+
+
+def summary(results, seconds = None, song_cache = None):
+    """ Timing for each target, slowest first """
+    width = max([len("target")] + [len(result["name"]) for result in results])
+    lines = ["%-*s %8s %8s  %s" % (width, "target", "seconds", "outputs", "")]
+    for result in sorted(results, key = lambda result: -result["seconds"]):
+        lines.append("%-*s %8.2f %8s  %s" % (width, result["name"], result["seconds"], len(result["outputs"]),
+                                              "FAILED %s" % result["error"] if result["error"] else ""))
+    failed = len([result for result in results if result["error"]])
+    total = "%s targets, %s failed" % (len(results), failed)
+    if seconds != None:
+        total += ", %.2f seconds (%.2f one after the other)" % (seconds, sum(result["seconds"] for result in results))
+    if song_cache != None:
+        total += ", %s songs parsed, %s shared" % (song_cache.misses, song_cache.hits)
+    lines.append(total)
+    return "\n".join(lines).rstrip()
+
+
+def argument_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog = "mksong batch", description = "Build every target in a YAML manifest, sharing parsed songs, chord charts, diagrams and song HTML between them")
+    parser.add_argument('manifest', help = 'YAML file of targets, see chordprobook/batch/__init__.py')
+    parser.add_argument('-j', '--jobs', type = int, default = None, help = 'Targets to build at once: defaults to the number of CPUs')
+    parser.add_argument('--targets', nargs = '+', default = None, help = 'Only build these targets')
+    parser.add_argument('--force', action = 'store_true', help = 'Make every output, even ones that are up to date')
+    parser.add_argument('--renderer', default = None, choices = sorted(renderers.renderers), help = 'As for mksong --renderer')
+    parser.add_argument('--pdf-engine', default = None, choices = sorted(renderers.pdf_engines), help = 'As for mksong --pdf-engine')
+    return parser
+
+
+def command(argv, data_dir = None):
+    """ mksong batch ...: returns (summary text, whether every target built) """
+    args = argument_parser().parse_args(argv)
+    if args.renderer:
+        renderers.use(args.renderer)
+    if args.pdf_engine:
+        renderers.use_pdf_engine(args.pdf_engine)
+    targets = load(args.manifest, data_dir)
+    if args.targets != None:
+        unknown = set(args.targets) - set(name for name, options in targets)
+        if unknown:
+            raise ValueError("No target %s in %s" % (", ".join(sorted(unknown)), args.manifest))
+        targets = [(name, options) for name, options in targets if name in args.targets]
+    for name, options in targets:
+        options['force'] = options['force'] or args.force
+    song_cache = books.SongCache()
+    start = time.perf_counter()
+    results = run(targets, os.path.dirname(os.path.abspath(args.manifest)), args.jobs, song_cache)
+    seconds = time.perf_counter() - start
+    cache.record()
+    return summary(results, seconds, song_cache), all(result["error"] == None for result in results)
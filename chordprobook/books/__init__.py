@@ -1,22 +1,22 @@
 #! /usr/bin/env python3
-import glob
 import re
-import argparse
 import os, os.path
-import subprocess
-import pypandoc
 import tempfile
+import threading
 import copy
 import fnmatch
 import math
-from PIL import Image, ImageFont, ImageDraw
-from io import BytesIO
-import base64
-import yaml
+import chordprobook.cache as cache
 import chordprobook.chords as chords
 import chordprobook.instruments
+import chordprobook.profiling as profiling
+import chordprobook.renderers as renderers
 import datetime
 
+def describe_song(song, *args, **kwargs):
+    """ Span details for profiled cp_song methods """
+    return {"song": song.title or os.path.basename(song.path or "")}
+
 
 def extract_transposition(text):
     """Find a transpose directive and get rid of it out of a string"""
@@ -216,6 +216,7 @@ class cp_song:
         self.standard_transpositions = [0]
         self.title = ""
         self.grids = None
+        self.page_images = [] # Paths of {page_image: } files
         self.parse()
         self.md = ""
         self.formatted_title = ""
@@ -223,6 +224,7 @@ class cp_song:
             self.title = title
 
 
+    @profiling.profiled("cp_song.parse", "song", describe_song)
     def parse(self):
         """ Deal with directives and turn song into markdown"""
         in_tab = False
@@ -329,6 +331,7 @@ class cp_song:
                         new_text += "</div>\n"
                         in_block = False
                     new_text += "<img src='file://%s/%s' width='680'/>"  % (self.dir, dir.value)
+                    self.page_images.append(os.path.join(self.dir, dir.value))
 
 
                 elif dir.type == directive.instrument:
@@ -358,6 +361,7 @@ class cp_song:
 
 
 
+    @profiling.profiled("cp_song.format", "song", describe_song)
     def format(self, transpose=None, instrument_name=None, stand_alone=True):
         """
         Create a markdown version of the song, transposed if necessary,
@@ -455,8 +459,27 @@ class cp_song:
         md += self.md
         return md
 
+    @profiling.profiled("cp_song.save_as_single_sheet", "song", describe_song)
     def save_as_single_sheet(self, instrument_name, trans, out_dir, args):
+        """ Returns the paths of the files written """
+        return save_sheets([self.single_sheet(instrument_name, trans, out_dir, args)], args)[0]
+
+    def sheet(self, instrument_name, trans):
+        """ Format the song for one single sheet: returns {"title", "html_md", "pages"} """
         self.format(transpose = trans, instrument_name=instrument_name)
+        sheet = {"title": self.title, "html_md": self.to_html_md()}
+        # What the first page's h1 says, see pdfs.split
+        sheet["heading"] = self.formatted_title
+        # Each page of the song is a div of its own
+        sheet["pages"] = sheet["html_md"].count("<div class='page'>")
+        return sheet
+
+    def single_sheet(self, instrument_name, trans, out_dir, args):
+        """ Format the song for one single sheet and work out the files to make from it,
+        without converting anything: see save_sheets """
+        sheet = self.sheet(instrument_name, trans)
+        sheet["pdf_path"] = None
+        sheet["word_path"] = None
         if self.nashville:
             suffix_string = "_nashville"
         elif self.key != None:
@@ -467,36 +490,30 @@ class cp_song:
         if instrument_name != None:
             suffix_string += "_" + instrument_name.lower().replace(" ","_")
 
-        temp_file = tempfile.NamedTemporaryFile(suffix=".html")
-        html_path = temp_file.name
-        with open(html_path, 'w') as html:
-            html.write(self.to_stand_alone_html())
         path, filename = os.path.split(self.path)
 
         out_dir = os.path.join(path, out_dir)
         os.makedirs(out_dir, exist_ok=True)
         if args['pdf']:
             pdf_file = "%s%s.pdf" % (filename, suffix_string )
-            pdf_path = os.path.join(out_dir, pdf_file)
-            print("Saving to %s" % (pdf_path))
-            command = ['wkhtmltopdf', '--enable-javascript', '--print-media-type', html_path, pdf_path]
-            subprocess.call(command)
+            sheet["pdf_path"] = os.path.join(out_dir, pdf_file)
         if args['docx'] or args['odt']:
             if args['docx']:
                 ext = 'docx'
             else:
                 ext = 'odt'
             word_file = "%s%s.%s" % (filename, suffix_string, ext)
-            word_path = os.path.join(out_dir, word_file)
-            xtra = ["--data-dir=.", "--self-contained"]
-            if args["reference_docx"] != None:
-                xtra.append('--reference-docx=%s' % args["reference_docx"])
-
-            print("Writing doc", word_path)
-            pypandoc.convert(self.to_final_md(), "html", format="markdown", outputfile=html_path, extra_args=xtra)
-            pypandoc.convert(html_path, ext, format="html", outputfile=word_path, extra_args=xtra)
+            sheet["word_path"] = os.path.join(out_dir, word_file)
+            sheet["ext"] = ext
+            sheet["final_md"] = self.to_final_md()
+        return sheet
 
+    @profiling.profiled("cp_song.to_html", "song", describe_song)
     def to_html(self):
+        return renderers.convert(self.to_html_md(), 'html', format='md')
+
+    def to_html_md(self):
+        """ The markdown (with HTML in it) that to_html converts """
         #TODO STANDALONE
 
         # Deal with chords
@@ -562,7 +579,20 @@ class cp_song:
         """ % song
 
         self.formatted_md = song
-        return pypandoc.convert(song, 'html', format='md')
+        return song
+
+    def all_keys(self):
+        """ Transpositions for the song in each of the 12 keys, starting with its own """
+        if self.nashville:
+            return [0]
+        return list(range(12))
+
+    def set_transpose(self, trans):
+        """ Transpose by trans semitones from the song as written (whatever it was transposed by before) """
+        self.transpose = trans
+        self.transposer = chords.transposer(trans)
+        if self.original_key:
+            self.key = self.transposer.transpose_chord(self.original_key)
 
     def to_stand_alone_html(self):
         return html_book.format(self.to_html(), title = self.title, stand_alone = True)
@@ -576,17 +606,290 @@ class cp_song:
 
         return "(%s)" % self.key if self.key != None else ""
 
+def songs_to_html(markdowns, html_cache = None, jobs = []):
+    """ Convert songs' markdown (from cp_song.to_html_md) to HTML, all at once along with any other jobs
+    passed. Returns the HTML for each song.
+    html_cache: markdown -> HTML (a dict or a FragmentCache) to look conversions up in first, and save
+    them to. Defaults to FragmentCache.shared() """
+    if html_cache == None:
+        html_cache = FragmentCache.shared()
+    needed = {}
+    for md in markdowns:
+        if md not in html_cache and md not in needed:
+            needed[md] = renderers.convert_job(md, 'html', format='md')
+    renderers.run(list(needed.values()) + list(jobs))
+    for md, job in needed.items():
+        html_cache[md] = job.output
+    return [html_cache[md] for md in markdowns]
+
+# wkhtmltopdf options for single sheets
+sheet_pdf_options = ['--enable-javascript', '--print-media-type']
+
+def save_sheets(sheets, args, html_cache = None, manifest = None):
+    """ Make the files for single sheets (from cp_song.single_sheet), running the conversions
+    for all the sheets together. Returns a list of the output paths for each sheet
+    html_cache: see songs_to_html
+    manifest: Manifest to skip outputs that are up to date with """
+    pdf_options = sheet_pdf_options
+    outputs = [[] for sheet in sheets]
+    make_pdf = {} # sheet number -> manifest key (or None without a manifest)
+    make_word = {}
+    for i, sheet in enumerate(sheets):
+        if sheet["pdf_path"] != None:
+            outputs[i].append(sheet["pdf_path"])
+            key = None
+            if manifest != None:
+                key = manifest.key("pdf", sheet["title"], sheet["html_md"], pdf_options)
+            if manifest == None or not manifest.up_to_date(sheet["pdf_path"], key):
+                make_pdf[i] = key
+                print("Saving to %s" % (sheet["pdf_path"]))
+        if sheet["word_path"] != None:
+            outputs[i].append(sheet["word_path"])
+            sheet["word_args"] = ["--data-dir=.", "--self-contained"]
+            if args["reference_docx"] != None:
+                sheet["word_args"].append('--reference-docx=%s' % args["reference_docx"])
+            key = None
+            if manifest != None:
+                key = manifest.key(sheet["ext"], sheet["final_md"], sheet["word_args"], Manifest.file_hash(args["reference_docx"]))
+            if manifest == None or not manifest.up_to_date(sheet["word_path"], key):
+                make_word[i] = key
+                print("Writing doc", sheet["word_path"])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Songs to HTML, and to the HTML the word processor formats are made from
+        word_html = dict((i, os.path.join(temp_dir, "%s-word.html" % i)) for i in make_word)
+        word_jobs = [renderers.convert_job(sheets[i]["final_md"], "html", format="markdown",
+                                           outputfile=word_html[i], extra_args=sheets[i]["word_args"]) for i in make_word]
+        html = songs_to_html([sheets[i]["html_md"] for i in make_pdf], html_cache, word_jobs)
+
+        # Then the files themselves
+        jobs = []
+        made = [] # (job, output path, manifest key)
+        html_paths = {}
+        for i, page in zip(make_pdf, html):
+            html_paths[i] = os.path.join(temp_dir, "%s.html" % i)
+            with open(html_paths[i], 'w') as f:
+                f.write(html_book.format(page, title = sheets[i]["title"], stand_alone = True))
+
+        def pdf_job(i):
+            made.append((renderers.html_to_pdf_job(html_paths[i], sheets[i]["pdf_path"], pdf_options), sheets[i]["pdf_path"], make_pdf[i]))
+            return made[-1][0]
+
+        batches = []
+        if args.get('batch_pdf') and len(make_pdf) > 1:
+            import chordprobook.pdfs as pdfs
+            # A wkhtmltopdf for each batch (as many as the renderer runs at once) rather than each sheet
+            numbers = list(make_pdf)
+            size = int(math.ceil(len(numbers) / getattr(renderers.current(), "concurrency", 1)))
+            for start in range(0, len(numbers), size):
+                batch = numbers[start:start + size]
+                # With an outline to check where each sheet starts
+                job = renderers.html_to_pdf_job([html_paths[i] for i in batch], os.path.join(temp_dir, "batch-%s.pdf" % start),
+                                                pdf_options + ['--outline', '--outline-depth', '1'])
+                batches.append((batch, job))
+                jobs.append(job)
+        else:
+            jobs += [pdf_job(i) for i in make_pdf]
+        for i in make_word:
+            jobs.append(renderers.convert_job(word_html[i], sheets[i]["ext"], format="html",
+                                              outputfile=sheets[i]["word_path"], extra_args=sheets[i]["word_args"]))
+            made.append((jobs[-1], sheets[i]["word_path"], make_word[i]))
+        renderers.run(jobs)
+
+        # Split up the batches, or if a sheet in a batch didn't start where expected, do its sheets one at a time
+        again = []
+        for batch, job in batches:
+            if job.ok and pdfs.split(job.details["pdf_path"], [(sheets[i]["pdf_path"], sheets[i]["pages"], sheets[i]["heading"]) for i in batch]):
+                made.extend((job, sheets[i]["pdf_path"], make_pdf[i]) for i in batch)
+            else:
+                again += [pdf_job(i) for i in batch]
+        renderers.run(again)
+
+    if manifest != None:
+        for job, path, key in made:
+            if job.ok:
+                manifest.record(path, key)
+    return outputs
+
+class Manifest:
+    """ What each output file was made from, as a hash of everything that goes into it (the formatted song,
+    options, templates and tool versions), kept in a file (Manifest.file_name) in each output directory.
+    Outputs that would come out the same as last time can be skipped.
+    force: make everything anyway (but still record it) """
+    file_name = ".chordprobook-manifest.json"
+    # Held while saving, so builds running at the same time (eg mksong batch) don't lose each other's entries
+    saving = threading.Lock()
+
+    def __init__(self, force = False):
+        self.force = force
+        self.directories = {} # directory -> {file name: key}
+        self.recorded = {} # directory -> {file name: key} made by this build
+        self.changed = set()
+        self.rebuilt = []
+        self.skipped = []
+        self.versions = None
+
+    def file_hash(path):
+        """ Hash of a file that goes into an output (eg a stylesheet), None if there isn't one """
+        import hashlib
+        if path == None or not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def key(self, *parts):
+        """ Hash of parts (anything JSON can hold) along with the template and tool versions """
+        import hashlib
+        import json
+        if self.versions == None:
+            renderer = renderers.current()
+            self.versions = [html_book.template_version, renderer.name, renderer.versions()]
+        return hashlib.sha256(json.dumps([self.versions] + list(parts)).encode("utf-8")).hexdigest()
+
+    def entries(self, directory):
+        if directory not in self.directories:
+            import json
+            try:
+                with open(os.path.join(directory, Manifest.file_name)) as f:
+                    self.directories[directory] = json.load(f)
+            except (OSError, ValueError):
+                self.directories[directory] = {}
+        return self.directories[directory]
+
+    def up_to_date(self, path, key):
+        """ Is path there, and made from the same things? If so it counts as skipped """
+        directory, name = os.path.split(os.path.abspath(path))
+        if not self.force and os.path.exists(path) and self.entries(directory).get(name) == key:
+            self.skipped.append(path)
+            return True
+        return False
+
+    def record(self, path, key):
+        """ Note that path has been made """
+        directory, name = os.path.split(os.path.abspath(path))
+        self.entries(directory)[name] = key
+        self.recorded.setdefault(directory, {})[name] = key
+        self.changed.add(directory)
+        self.rebuilt.append(path)
+
+    def save(self):
+        """ Write the manifests that have changed (to a temp file first, so a half-written one is never read).
+        What this build made is added to what's there now, in case another build saved since it was read """
+        import json
+        with Manifest.saving:
+            for directory in self.changed:
+                del self.directories[directory]
+                entries = self.entries(directory)
+                entries.update(self.recorded.get(directory, {}))
+                path = os.path.join(directory, Manifest.file_name)
+                temp_path = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+                with open(temp_path, "w") as f:
+                    json.dump(entries, f, indent=0, sort_keys=True)
+                os.replace(temp_path, path)
+        self.changed = set()
+        self.recorded = {}
+
+    def report(self):
+        return "%s rebuilt, %s up to date" % (len(self.rebuilt), len(self.skipped))
+
+class FragmentCache:
+    """ Song HTML by the song's markdown (see songs_to_html), kept in memory and on disk so every output
+    with the same song in the same key, for the same instrument and so on, shares one conversion, in this
+    process or a later one. The markdown is made from everything that changes the HTML (song text,
+    transposition, instrument, lefty, nashville, major_chart, notes and title) so it's the key, along with
+    the renderer and its versions """
+    _shared = None
+
+    def __init__(self, directory = None):
+        self.namespace = cache.Namespace("html-fragments", directory)
+        self.directory = self.namespace.directory
+        self.fragments = {} # key -> HTML
+        self.hits = 0
+        self.misses = 0
+
+    def shared():
+        """ The cache everything uses unless it's given another one (a new one if the cache has moved) """
+        if FragmentCache._shared == None or FragmentCache._shared.directory != cache.Namespace("html-fragments").directory:
+            FragmentCache._shared = FragmentCache()
+        return FragmentCache._shared
+
+    def key(self, md):
+        import hashlib
+        renderer = renderers.current()
+        return hashlib.sha256("\n".join([renderer.name, renderer.versions(), md]).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.namespace.path(key, ".html")
+
+    def __contains__(self, md):
+        key = self.key(md)
+        if key not in self.fragments:
+            html = self.namespace.get(key, ".html")
+            if html == None:
+                self.misses += 1
+                return False
+            self.fragments[key] = html.decode("utf-8")
+        self.hits += 1
+        return True
+
+    def __getitem__(self, md):
+        key = self.key(md)
+        if key not in self.fragments and md not in self:
+            raise KeyError(md)
+        return self.fragments[key]
+
+    def __setitem__(self, md, html):
+        key = self.key(md)
+        self.fragments[key] = html
+        self.namespace.put(key, html, ".html")
+
+    def clear(self):
+        """ Forget what's in memory (what's on disk stays) """
+        self.fragments = {}
+
+class SongCache:
+    """ Parsed songs kept from one book to the next (the render daemon keeps one of these),
+    keyed by the song text and everything else that goes into parsing it.
+    Books get a copy of the cached song, which they're free to format however they like """
+    def __init__(self):
+        self.songs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def song(self, text, instruments = None, **options):
+        """ Same arguments as cp_song """
+        key = (text,) + tuple(sorted(options.items()))
+        cached = self.songs.get(key)
+        if cached == None:
+            self.misses += 1
+            cached = cp_song(text, instruments = instruments, **options)
+            self.songs[key] = cached
+        else:
+            self.hits += 1
+        # Copy everything except the instruments, which should be the ones this book is using
+        return copy.deepcopy(cached, {id(cached.instruments): instruments or cached.instruments})
+
+    def clear(self):
+        self.songs = {}
+
 class cp_song_book:
     """Class to hold a set of songs and setlists"""
     transposition_options = ("all","0","1")
     transpose_all, do_not_transpose, transpose_first = transposition_options
     default_title = 'Songbook'
+    # Single sheets to convert at once, see save_as_single_sheets
+    sheets_per_batch = 50
     def __init__(self, keep_order = False, title = None,
                  instruments = None, instrument_name = None,
                  path = ".", nashville = False, major_chart = False,
                  lefty = False, external_css = None,
-                 header_font_name = None, header_font_size = None):
+                 header_font_name = None, header_font_size = None,
+                 song_cache = None):
         self.version = None
+        self.song_cache = song_cache
+        self.html_cache = None # Song markdown -> HTML, see songs_to_html (None for the shared FragmentCache)
+        self.manifest = None # Manifest of outputs, to skip the ones that are up to date
+        self.inputs = [] # Files (and directories) the book was made from, see input_paths
         self.lefty = lefty
         self.title = title
         self.songs = [] #songs
@@ -605,9 +908,12 @@ class cp_song_book:
         self.external_css = external_css
         self.header_font_name = header_font_name
         self.header_font_size = header_font_size
+        if external_css != None:
+            self.inputs.append(external_css)
         #If we're passed a file, load it
         self.set_path(path)
         if os.path.isfile(path):
+            self.inputs.append(path)
             with open(path) as p:
                 self.load_from_text(p.read(), relative_to=self.dir)
 
@@ -634,19 +940,24 @@ class cp_song_book:
             dir_list = ['.']
         for dir in dir_list:
             for root, dirnames, filenames in os.walk(os.path.join(self.dir,dir.strip())):
+                self.inputs.append(root) # New files show up as a change to the directory
                 for filename in fnmatch.filter(filenames, files):
                      if not filename.startswith("."):
                         self.add_song_from_file(open(os.path.join(root, filename)))
 
     def add_song_from_text(self, text, name, transpose=0):
         path = os.path.join(self.dir, name)
-        song = cp_song(text , path=path,
+        options = dict(path=path,
                        transpose=transpose,
                        instruments = self.instruments,
                        instrument_name=self.instrument_name_passed,
                        nashville=self.nashville,
                        major_chart=self.major_chart,
                        lefty = self.lefty)
+        if self.song_cache != None:
+            song = self.song_cache.song(text, **options)
+        else:
+            song = cp_song(text, **options)
         transpositions_needed = []
         if not self.nashville and self.auto_transpose == cp_song_book.transpose_all:
                 transpositions_needed = song.standard_transpositions
@@ -666,8 +977,17 @@ class cp_song_book:
     def add_song_from_file(self, file, transpose=0):
         """ Adds a song from a file to a book and works out how many transposed versions to add """
         with file as f:
+           self.inputs.append(os.path.abspath(f.name))
            self.add_song_from_text(f.read(), os.path.abspath(f.name), transpose)
 
+    def input_paths(self):
+        """ Everything the book depends on: the book file, setlist, song files, their page images,
+        directories searched for songs and the stylesheet """
+        paths = list(self.inputs)
+        for song in self.songs:
+            paths += song.page_images
+        return sorted(set(os.path.abspath(path) for path in paths))
+
 
     def load_from_text(self, text, relative_to="."):
         """ Reads a book in from a sting containing paths or directives """
@@ -694,6 +1014,7 @@ class cp_song_book:
                     if os.path.isfile(song_path):
                         self.add_song_from_file(open(song_path), transpose)
                     else:
+                        self.inputs.append(song_path) # In case it turns up later
                         print("Can't find song %s" % song_path)
             else:
                 if directiv.type == directive.title and self.title == None:
@@ -711,6 +1032,7 @@ class cp_song_book:
                         self.auto_transpose = directiv.value.lower()
 
 
+    @profiling.profiled("cp_song_book.format")
     def format(self, instrument_name=None):
 
         if self.title == None:
@@ -719,80 +1041,160 @@ class cp_song_book:
         # Format songs, need to know how long they are
         for song  in self.songs:
             song.format(instrument_name = instrument_name, stand_alone=False)
-
-        self.reorder(1, old=None, new_order=[], waiting=[])
-        toc = TOC(self, 2)
-        self.contents = toc.format()
+        self.paginate()
         #self.title += " " + version_string
 
+    def paginate(self):
+        """ Put the songs in page order (see reorder) by their number of pages, and make the table of contents """
+        self.unpaginated_songs = list(self.songs)
+        with profiling.span("reorder"):
+            self.reorder(1, old=None, new_order=[], waiting=[])
+        with profiling.span("TOC"):
+            toc = TOC(self, 2)
+            self.contents = toc.format()
+            self.toc_pages = len(toc.pages)
+
+    def shard_plan(self, shards):
+        """ Split the book (after format()) into up to shards runs of pages of about the same length to render separately.
+        Each run starts on an odd (right hand) page so no two-page spread is split, the first has the title page,
+        contents and sets as well as songs.
+        Returns the page count of the whole book and a list of (first page, songs) """
+        front_pages = 1 + self.toc_pages + sum(set.pages for set in self.sets)
+        total = front_pages + sum(song.pages for song in self.songs)
+        plan = [(1, [])]
+        page = front_pages + 1
+        for song in self.songs:
+            if len(plan) < shards and page % 2 == 1 and page - plan[-1][0] >= total / shards and plan[-1][1] != []:
+                plan.append((page, []))
+            plan[-1][1].append(song)
+            page += song.pages
+        return total, plan
 
 
 
-    def __save(self, instrument_name, args, output_file):
-        self.format(instrument_name=instrument_name)
-        all_songs = self.sets_md
 
+    def title_and_suffix(self, instrument_name):
+        """ The title for the book for an instrument (and version), and what goes on the end of its file names """
         if instrument_name != None:
             suffix = "%s_%s" % ("_lefty" if self.lefty else "", instrument_name.lower().replace(" ", "_"))
             title_suffix = " (for %s &nbsp;%s)" % ("Left-handed" if self.lefty else "", instrument_name)
         else:
             suffix = ""
             title_suffix = ""
-        output_file += suffix
         version_string = ""
 
         if self.version:
-            output_file += "-"
+            suffix += "-"
             if self.version.lower() == "auto":
                 version_string = str(datetime.datetime.now())
-                output_file +=  version_string.replace(" ", "_")
+                suffix +=  version_string.replace(" ", "_")
             else:
                 version_string = self.version
-                output_file +=  self.version.replace(" ", "_")
-
-        # TODO - only generate this if HTML
-
-        # Need to run this whatever the output_file# Now add formatted songs to output in the right order
-        for song in self.songs:
-            all_songs += song.to_html()
+                suffix +=  self.version.replace(" ", "_")
+
+        return self.title + title_suffix + " " + version_string, suffix
+
+    def pdf_options(self):
+        """ wkhtmltopdf options for the whole book """
+        options = [
+            '--enable-javascript', '--print-media-type', '--outline',
+            '--header-left', self.title,
+            '--header-right', '[page]/[toPage]',
+            '--header-spacing', '4',
+            '--margin-top', '26',
+            '--outline-depth', '1',
+            '-s', 'A4',
+        ]
+        if self.header_font_name:
+            options.extend(['--header-font-name', self.header_font_name])
+        if self.header_font_size:
+            options.extend(['--header-font-size', self.header_font_size])
+        return options
+
+    def html_document(self, title, song_mds, for_print = True, html_cache = None):
+        """ The whole book as one HTML document, after format(). Converts the contents and songs' markdown
+        (song_mds, from cp_song.to_html_md) all at once.
+        Returns (the document, each song's HTML, the contents' HTML) """
+        contents_job = renderers.convert_job(self.contents, "html", format="md")
+        song_htmls = songs_to_html(song_mds, html_cache, [contents_job])
+        document = html_book.format(self.sets_md + "".join(song_htmls),
+                                    title=title,
+                                    for_print = for_print,
+                                    external_css = self.external_css,
+                                    contents=contents_job.output)
+        return document, song_htmls, contents_job.output
+
+    @profiling.profiled("cp_song_book.save", describe = lambda book, instrument_name, *args: {"instrument": instrument_name})
+    def __save(self, instrument_name, args, output_file):
+        """ Returns the paths of the output files (with a manifest, some may have been up to date already) """
+        self.format(instrument_name=instrument_name)
+        written = []
 
-        title = self.title + title_suffix + " " + version_string
+        title, suffix = self.title_and_suffix(instrument_name)
+        output_file += suffix
+        manifest = self.manifest
+        assemble = args.get('assemble', False)
+        if assemble and self.title:
+            import chordprobook.pdfs as pdfs
+            if not pdfs.helvetica_can_write(self.title):
+                print("Can't put %s in --assemble's page headers, rendering the whole book instead" % self.title)
+                assemble = False
+        shards = args.get('shards') or 1
+        song_mds = [song.to_html_md() for song in self.songs]
+        html_path = output_file + ".html"
+        pdf_path = output_file + ".pdf"
+        options = self.pdf_options()
+
+        # Which outputs need making?
+        make_html = args['html']
+        make_pdf = args['pdf']
+        if manifest != None:
+            page = [title, self.sets_md, self.contents, song_mds, args['a4'], Manifest.file_hash(self.external_css)]
+            html_key = manifest.key("html", page)
+            pdf_key = manifest.key("pdf", page, options, assemble, shards)
+            make_html = make_html and not manifest.up_to_date(html_path, html_key)
+            make_pdf = make_pdf and not manifest.up_to_date(pdf_path, pdf_key)
         if args['html']:
-             html_path = output_file + ".html" #Save for the use
-        else: #Use a temp dir
-             temp_file = tempfile.NamedTemporaryFile(suffix=".html")
-             html_path = temp_file.name
-
+            written.append(html_path)
+        if args['pdf']:
+            written.append(pdf_path)
+
+        jobs = []
+        made = [] # (job, output path, manifest key) to record in the manifest once they've run
+        html_cache = self.html_cache
+        if make_pdf and assemble:
+            print("Assembling PDF:", pdf_path)
+            mds = dict((id(song), md) for song, md in zip(self.songs, song_mds))
+            if self.__assemble_pdf(title, pdf_path, mds, html_cache, args) and manifest != None:
+                manifest.record(pdf_path, pdf_key)
+            # The songs may have been paginated again
+            song_mds = [mds[id(song)] for song in self.songs]
+            make_pdf = False
+
+        if make_html or make_pdf:
+            # Need to run this whatever the output_file# Now add formatted songs to output in the right order
+            # (converting them all at once)
+            document, song_htmls, contents = self.html_document(title, song_mds, args['a4'], html_cache)
+
+            if not args['html']: #Use a temp dir
+                 temp_file = tempfile.NamedTemporaryFile(suffix=".html")
+                 html_path = temp_file.name
 
-        if args['html'] or args['pdf']:
             with open(html_path, 'w') as html:
-                html.write( html_book.format(all_songs,
-                                            title=title,
-                                            for_print = args['a4'],
-                                            external_css = self.external_css,
-                                            contents=pypandoc.convert(self.contents,
-                                                                        "html",
-                                                                        format="md")))
-            if args['pdf']:
-                pdf_path = output_file + ".pdf"
+                html.write(document)
+            if make_html and manifest != None:
+                manifest.record(html_path, html_key)
+            if make_pdf and shards > 1:
+                print("Outputting PDF in up to %s shards:" % shards, pdf_path)
+                if self.__save_shards(title, pdf_path, song_htmls, contents, options, args) and manifest != None:
+                    manifest.record(pdf_path, pdf_key)
+            elif make_pdf:
                 print("Outputting PDF:", pdf_path, html_path)
-                command = [
-                    'wkhtmltopdf',
-                    '--enable-javascript', '--print-media-type', '--outline',
-                    '--header-left', self.title,
-                    '--header-right', '[page]/[toPage]',
-                    '--header-spacing', '4',
-                    '--margin-top', '26',
-                    '--outline-depth', '1',
-                    '-s', 'A4',
-                ]
-                if self.header_font_name:
-                    command.extend(['--header-font-name', self.header_font_name])
-                if self.header_font_size:
-                    command.extend(['--header-font-size', self.header_font_size])
-                command.extend([html_path, pdf_path])
-                subprocess.call(command)
+                jobs.append(renderers.html_to_pdf_job(html_path, pdf_path, options))
+                if manifest != None:
+                    made.append((jobs[-1], pdf_path, pdf_key))
 
+        word_jobs = []
         if args['docx'] or args['odt'] or args['epub']:
             exts = []
             if args['docx']:
@@ -802,8 +1204,16 @@ class cp_song_book:
             if args['epub']:
                 exts.append('epub')
 
+            # Format some markdown for the non-PDF output, and convert it to HTML and then
+            # the word processor formats (needed for images to work)
+            h = "% " + title + "\n\n"
+            for song in self.songs:
+                h += song.to_final_md()
+            word_temp_file = tempfile.NamedTemporaryFile(suffix=".html")
+
             for ext in exts:
                 out_path = output_file + "." + ext
+                written.append(out_path)
                 if ext in ["docx","odt"]:
                     xtra = ["--toc","--toc-depth=1", "--data-dir=.", "--self-contained"]
                 else:
@@ -814,31 +1224,138 @@ class cp_song_book:
 
                 if args['odt'] and args["reference_odt"] != None:
                     xtra.append('--reference-doc=%s' % args["reference_odt"])
-                # Format some markdown for the non-PDF output
-                h = "% " + title + "\n\n"
-                for song in self.songs:
-                    h += song.to_final_md()
 
+                if manifest != None:
+                    key = manifest.key(ext, h, xtra, Manifest.file_hash(args["reference_docx"]), Manifest.file_hash(args["reference_odt"]))
+                    if manifest.up_to_date(out_path, key):
+                        continue
                 print("Writing output doc", out_path)
-                #Convert to HTML and then the word processor format (needed for images to work)
-                pypandoc.convert(h, "html", format="markdown", outputfile=html_path, extra_args=["--self-contained"])
-                pypandoc.convert(html_path, ext, format="html", outputfile=out_path, extra_args=xtra)
-
-
-    def output(self, args, output_file):
+                word_jobs.append(renderers.convert_job(word_temp_file.name, ext, format="html", outputfile=out_path, extra_args=xtra))
+                if manifest != None:
+                    made.append((word_jobs[-1], out_path, key))
+            if word_jobs:
+                jobs.append(renderers.convert_job(h, "html", format="markdown", outputfile=word_temp_file.name, extra_args=["--self-contained"]))
+
+        # The PDF and the HTML for word processors, then the word processor files
+        renderers.run(jobs)
+        renderers.run(word_jobs)
+        for job, path, key in made:
+            if job.ok:
+                manifest.record(path, key)
+        return written
+
+    def __save_shards(self, title, pdf_path, song_htmls, contents, options, args):
+        """ Render the book in parts (see shard_plan) with a wkhtmltopdf each, all at once, then join them up.
+        Page numbers in the headers and the outline come from the plan.
+        song_htmls: HTML for each song, contents: HTML for the contents
+        Returns True if the PDF was made """
+        import chordprobook.pdfs as pdfs
+        total, plan = self.shard_plan(args['shards'])
+        html = dict(zip(map(id, self.songs), song_htmls))
+        # The outline is made from the plan, the header gets the page count from it
+        options = [option for option in options if option not in ['--outline', '--outline-depth', '1']]
+        options[options.index('[page]/[toPage]')] = '[page]/%s' % total
+        jobs = []
+        outline = [(title, 0)]
+        page = 1 + self.toc_pages
+        for set in self.sets:
+            outline.append((set.title, page))
+            page += set.pages
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for number, (first_page, songs) in enumerate(plan):
+                for song in songs:
+                    if not song.blank:
+                        outline.append((song.title, page))
+                    page += song.pages
+                shard_html = "".join(html[id(song)] for song in songs)
+                if number == 0:
+                    document = html_book.format(self.sets_md + shard_html, title = title, for_print = args['a4'],
+                                                external_css = self.external_css, contents = contents)
+                else:
+                    document = html_book.format(shard_html, title = title, for_print = args['a4'],
+                                                external_css = self.external_css, stand_alone = True)
+                html_path = os.path.join(temp_dir, "%s.html" % number)
+                with open(html_path, 'w') as f:
+                    f.write(document)
+                jobs.append(renderers.html_to_pdf_job(html_path, os.path.join(temp_dir, "%s.pdf" % number),
+                                                      options + ['--page-offset', str(first_page - 1)]))
+            renderers.run(jobs)
+            if not all(job.ok for job in jobs):
+                print("Couldn't render all the shards of", pdf_path)
+                return False
+            paths = [job.details["pdf_path"] for job in jobs]
+            pages = sum(pdfs.page_count(path) for path in paths)
+            if pages != total:
+                print("%s came out %s pages, not %s, so page numbers will be out" % (pdf_path, pages, total))
+            pdfs.merge([(path, None) for path in paths], pdf_path, outline = outline, headers = False)
+        return True
+
+    def __assemble_pdf(self, title, pdf_path, mds, html_cache, args):
+        """ Make the book PDF from a PDF for the front matter, each set and each song (see chordprobook.pdfs),
+        so only the ones that have changed are rendered. If songs don't come out the number of pages
+        they were expected to, they're paginated again so the contents has the right page numbers.
+        mds: song markdown by id(song), filled in for any blank pages paginating adds
+        Returns True if the PDF was made """
+        import chordprobook.pdfs as pdfs
+        options = ['--enable-javascript', '--print-media-type', '--margin-top', '26', '-s', 'A4']
+        parts = pdfs.PartCache()
+
+        def part(html, part_title, contents = None):
+            return html_book.format(html, title = part_title, contents = contents, for_print = args['a4'],
+                                    stand_alone = contents == None, external_css = self.external_css)
+
+        def song_pdfs():
+            for song in self.songs:
+                if id(song) not in mds:
+                    mds[id(song)] = song.to_html_md()
+            htmls = songs_to_html([mds[id(song)] for song in self.songs], html_cache)
+            return parts.pdfs([part(html, song.title) for song, html in zip(self.songs, htmls)], options)
+
+        set_paths = parts.pdfs([part(html, set.title) for set, html in zip(self.sets, self.sets_html)], options)
+        song_paths = song_pdfs()
+        if None not in set_paths + song_paths:
+            sized = list(zip(self.sets + self.songs, set_paths + song_paths))
+            if any(item.pages != pdfs.page_count(path) for item, path in sized):
+                for item, path in sized:
+                    item.pages = pdfs.page_count(path)
+                self.songs = self.unpaginated_songs
+                self.paginate()
+                song_paths = song_pdfs()
+        front_paths = parts.pdfs([part("", title, renderers.convert(self.contents, "html", format="md"))], options)
+        if None in front_paths + set_paths + song_paths:
+            print("Couldn't render all the parts of", pdf_path)
+            return False
+
+        outline = [(front_paths[0], title)]
+        outline += [(path, set.title) for set, path in zip(self.sets, set_paths)]
+        outline += [(path, None if song.blank else song.title) for song, path in zip(self.songs, song_paths)]
+        header_size = float(self.header_font_size) if self.header_font_size else 12
+        pdfs.merge(outline, pdf_path, header_left = self.title, header_size = header_size)
+        print("Assembled %s parts (%s rendered) into %s" % (len(outline), parts.misses, pdf_path))
+        return True
+
+    def format_sets(self):
+        """ The setlists' HTML, for the start of the book """
         self.sets_md = ""
+        self.sets_html = []
         for set in self.sets:
             set.format()
-            self.sets_md += set.to_html()
+            self.sets_html.append(set.to_html())
+            self.sets_md += self.sets_html[-1]
 
+    def output(self, args, output_file):
+        """ Save the book in the formats asked for in args, returns the paths of the files written """
+        self.format_sets()
+        written = []
         if self.instrument_name_passed == None:
             if self.nashville:
-                self.__save(None, args, output_file)
+                written += self.__save(None, args, output_file)
             else:
                 for instrument_name in  self.default_instrument_names + [None]:
-                    self.__save(instrument_name, args, output_file)
+                    written += self.__save(instrument_name, args, output_file)
         else:
-            self.__save(self.instrument_name_passed, args, output_file)
+            written += self.__save(self.instrument_name_passed, args, output_file)
+        return written
 
 
 
@@ -847,27 +1364,52 @@ class cp_song_book:
     def save_as_single_sheets(self, out_dir, args={'pdf': True,
                                                    'docx':False,
                                                    'odt': False,
-                                                   'epub': False}):
+                                                   'epub': False}, songs = None):
         """
         Saves a song as exported files - one for each key/instrument combo
+        songs: only save these songs (by default all of them)
+        Returns a list of {"title", "path", "paths"}: path is the main file for the song in
+        each key, paths is every file written for that key
         """
         converted_songs = []
+        batch = [] # (converted song, sheets) waiting to be saved
+
+        def save_batch():
+            if batch == []:
+                return
+            sheets = [sheet for converted, song_sheets in batch for sheet in song_sheets]
+            written = iter(save_sheets(sheets, args, self.html_cache, self.manifest))
+            for converted, song_sheets in batch:
+                for sheet in song_sheets:
+                    sheet_written = next(written)
+                    converted["paths"] += sheet_written
+                # The last sheet is the one without an instrument, its first file is the song's main one
+                converted["path"] = sheet_written[0] if sheet_written else None
+            del batch[:]
+
         for song in self.songs:
-            if song.path != None:
+            if song.path != None and (songs == None or song in songs):
 
-                for trans in song.standard_transpositions:
+                for trans in song.all_keys() if args.get('all_keys') else song.standard_transpositions:
+                    if args.get('all_keys'):
+                        # From the one parse of the song, just as written
+                        song.set_transpose(trans)
                     if self.instrument_name_passed != None:
                         instruments=[self.instrument_name_passed]
                     else:
                          instruments = song.local_instrument_names
 
-                    for instrument_name in instruments:
-                        song.save_as_single_sheet(instrument_name, trans, out_dir, args)
-
-                    path = song.save_as_single_sheet(None, trans, out_dir, args)
-                    converted_songs.append({"title" : song.formatted_title, "path" : path})
+                    song_sheets = [song.single_sheet(instrument_name, trans, out_dir, args) for instrument_name in instruments]
+                    song_sheets.append(song.single_sheet(None, trans, out_dir, args))
+                    converted = {"title" : song.formatted_title, "path" : None, "paths" : []}
+                    converted_songs.append(converted)
+                    batch.append((converted, song_sheets))
+                    if sum(len(song_sheets) for converted, song_sheets in batch) >= cp_song_book.sheets_per_batch:
+                        save_batch()
+        save_batch()
         return converted_songs
 
+    @profiling.profiled("cp_song_book.order_by_setlist")
     def order_by_setlist(self, setlist):
         """
         setlist: A string or path
@@ -890,6 +1432,7 @@ class cp_song_book:
         """
         if os.path.exists(setlist):
             self.set_path(setlist)
+            self.inputs.append(setlist)
             with open(setlist) as s:
                 setlist = s.read()
 
@@ -898,6 +1441,7 @@ class cp_song_book:
             setlist, book_filename = extract_book_filename(setlist)
             if book_filename:
                 book_path = os.path.join(self.dir, book_filename)
+                self.inputs.append(book_path)
                 with open(book_path) as b:
                     self.load_from_text(b.read())
 
@@ -970,7 +1514,7 @@ class cp_song_book:
 
     def reorder(self, start_page, old = None, new_order=[], waiting = []):
         """Reorder songs in the book so two-page songs start on an even page
-           Unless this is a set-list in which case insert blanks. Recursive."""
+           Unless this is a set-list in which case insert blanks."""
 
         def make_blank():
             new_order.append(cp_song("", title="", blank=True))
@@ -978,41 +1522,41 @@ class cp_song_book:
         if old == None:
             old = self.songs
 
-        if old == []:
-            if start_page % 2 == 1 and waiting != []:
-                make_blank()
-            self.songs = new_order + waiting
-            return
-
-        if  start_page % 2 == 0:
-            #We're on an even page so can output all the two-or-more-page songs
-            for s in waiting:
-                new_order.append(s)
-                start_page += s.pages
-            waiting = []
-
-            #Also OK to start any other song here so append head of list
-
-            new_order.append(old[0])
-            start_page += old[0].pages
-
-        elif old[0].pages % 2 == 0:
-            # Have a two page spread, so save it
-            if self.keep_order:
-                make_blank()
-                new_order.append(old[0])
-                start_page += 1
+        # One song at a time (this used to recurse once per song, which ran out of stack for big books)
+        for song in old:
+            if  start_page % 2 == 0:
+                #We're on an even page so can output all the two-or-more-page songs
+                for s in waiting:
+                    new_order.append(s)
+                    start_page += s.pages
+                waiting = []
+
+                #Also OK to start any other song here so append head of list
+
+                new_order.append(song)
+                start_page += song.pages
+
+            elif song.pages % 2 == 0:
+                # Have a two page spread, so save it
+                if self.keep_order:
+                    make_blank()
+                    new_order.append(song)
+                    start_page += 1
+                else:
+                    waiting.append(song)
             else:
-                waiting.append(old[0])
-        else:
-            new_order.append(old[0])
+                new_order.append(song)
 
-            start_page += old[0].pages
+                start_page += song.pages
 
-        self.reorder(start_page, old[1:], new_order, waiting)
+        if start_page % 2 == 1 and waiting != []:
+            make_blank()
+        self.songs = new_order + waiting
 
 
 class html_book:
+    # Part of what outputs are made from (see Manifest): bump it when the templates or scripts change
+    template_version = 1
 
     def format(html, contents = "",  title="Untitled", for_print=True, stand_alone=False, external_css=None):
         external_styles = ""
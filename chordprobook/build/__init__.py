@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+"""
+What mksong does: its command line options, and the build that turns them into books or
+single sheets. The mksong script and the render daemon (chordprobook.daemon) both run builds
+from here, so they take the same options and make the same files.
+"""
+import argparse
+import os
+import time
+from chordprobook import books
+from chordprobook import cache
+from chordprobook import chords
+from chordprobook import instruments as inst
+from chordprobook import profiling
+from chordprobook import renderers
+
+default_output_file = "songbook"
+formats = ['pdf', 'html', 'docx', 'odt', 'epub']
+# Options that are about running mksong rather than what a build makes, so daemon requests and batch
+# targets can't set them
+request_options = ['daemon', 'watch', 'port', 'socket', 'max_concurrent', 'instruments', 'renderer', 'pdf_engine', 'prewarm', 'profile', 'profile_output']
+
+
+def argument_parser():
+    """ mksong's command line """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', type=argparse.FileType('r'), nargs="*", default=None, help='List of files')
+    parser.add_argument('-a', '--alphabetically', action='store_true', help='Sort songs alphabetically')
+    parser.add_argument('-d', '--directory', default='.', help='Directory in which to put the output, relative to the book, setlist or indivudal file. If you want to put files somwhere specific, use a full path starting with "/": defaults to "." ')
+    parser.add_argument('-i', '--instrument', default=None, help='Show chord grids for the given instrument. Eg --instrument "Soprano Ukulele"')
+    parser.add_argument('--instruments', action='store_true', help='List known instruments and their alises then quit. You use any of the names or aliases listed under AKA with the --instument option')
+    parser.add_argument('-l','--left-handed', action='store_true', help='Draw the chords for --instrument (or instruments specified in the document) left-handed, in mirror image')
+    parser.add_argument('-k',
+                        '--keep-order',
+                        action='store_true',
+                        help='Preserve song order for playing as a setlist (inserts blank pages to keep multi page songs on facing pages')
+    parser.add_argument('--a4', action='store_true', default=True, help='Format for printing (web page output)')
+    parser.add_argument('-e', '--epub', action='store_true', help='Output epub book')
+    parser.add_argument('-f', '--file-stem', default=default_output_file, help='Base file name, without extension, for output files')
+    parser.add_argument( '--html', default=False, action='store_true', help='Output HTML book, defaults to a4 at the moment')
+    parser.add_argument('-x', '--docx', action='store_true', help='Output .docx format')
+    parser.add_argument('-t', '--odt', action='store_true', help='Output .odt format')
+
+    parser.add_argument('-p', '--pdf', action='store_true', help='Output PDF this is the default')
+    parser.add_argument('--reference-docx', default=None, help="Reference docx file to use (eg with Heading 1 having a page-break before)")
+    parser.add_argument('--reference-odt', default=None, help="Reference odt file to use (eg with Heading 1 having a page-break before)")
+    parser.add_argument('-o','--one-doc', action='store_true', help='Output a single document per song: assumes you want A4 PDF')
+    parser.add_argument('--all-keys', action='store_true', help='With --one-doc, make each song in all 12 keys (for each instrument), starting from the key it is written in')
+    parser.add_argument('-n','--nashville', action='store_true', help='Use Nashville Numbering (actually Roman chord numbers rather than letter-names)')
+    parser.add_argument('-m','--major-chart', action='store_true', help='When using (Nashville/Roman) chord numbers, chart minor keys in the relative major')
+    parser.add_argument('--assemble', action='store_true', help='Make book PDFs from a PDF for each song, kept in the cache, so only songs that have changed are rendered again (needs pypdf). Page headers are in Helvetica: --header-font-name is ignored, and books with titles that are not Latin-1 are rendered whole')
+    parser.add_argument('--batch-pdf', action='store_true', help='With --one-doc, render sheets through one wkhtmltopdf per batch (rather than per sheet) and split them up (needs pypdf)')
+    parser.add_argument('--shards', type=int, default=None, help='Render book PDFs in this many parts at once (eg the number of CPUs), then join them up (needs pypdf)')
+    parser.add_argument('--force', action='store_true', help='Make every output, even ones that are up to date with their songs, options, stylesheet and tools')
+
+    parser.add_argument('-b',
+                        '--book-file',
+                       default=None,
+                        help ="""File containing a list of files, each line optionally followed by a transposition {transpose: (+|-)\\d\\d?}
+                                 eg to transpose up one tone:
+                                 song-file.cho {transpose: +2}, you can also add a title line: {title: Title of book}""")
+    parser.add_argument('-s',
+                        '--setlist',
+                        default=None,
+                        help ="Use a setlist file in markdown format to filter the book, one song per line, and keep facing pages together. Setlist lines can be one or more words from the song title starting with '## ', with '# ' for the names of sets and other markdown as you require in between you can also add a setlist line: {title: Title of setlist}")
+    parser.add_argument('--title', default=None, help='Title to use for the book, if there is no title in a book file or setlist file')
+    parser.add_argument('-c', '--external-css', default=None, help='Path to external stylesheet (CSS file). This is loaded after default styles to let you override those.')
+    parser.add_argument('--header-font-name', default=None, help='Font face to use for page header')
+    parser.add_argument('--header-font-size', default=None, help='Font size to use for page header')
+    parser.add_argument('--renderer', default=None, choices=sorted(renderers.renderers), help='What to run conversions with: pandoc (and wkhtmltopdf for PDF) or null, which just writes placeholder files, for timing and testing. Defaults to $CHORDPROBOOK_RENDERER or pandoc')
+    parser.add_argument('--pdf-engine', default=None, choices=sorted(renderers.pdf_engines), help='What makes PDFs with the pandoc renderer: wkhtmltopdf or weasyprint (in-process, needs pip install weasyprint, no JavaScript so song text isn\'t shrunk to fit). Defaults to $CHORDPROBOOK_PDF_ENGINE or wkhtmltopdf')
+    parser.add_argument('--profile', action='store_true', help='Time each stage, song and external program, print the slowest at the end and save the timings as JSON and as a Chrome trace (see --profile-output)')
+    parser.add_argument('--profile-output', default='mksong-profile', help='Base file name for --profile output, writes <name>.profile.json and <name>.trace.json: defaults to mksong-profile')
+    parser.add_argument('--prewarm', action='store_true', help='Draw the chord diagrams for every instrument, right and left-handed, into the cache (using a process per CPU) so builds do not have to (named diagrams only for the spellings in the charts, eg Bb but not A#). Quits afterwards unless there are files, a book file or a setlist to build')
+    parser.add_argument('--watch', action='store_true', help='Build, then keep rebuilding whenever the book file, setlist, songs, their page images or the stylesheet change. Ctrl-C to stop')
+    parser.add_argument('--daemon', action='store_true', help='Run as a render daemon, keeping instruments, songs, chord charts and diagrams loaded between builds. Takes build requests as JSON over HTTP, see --port and --socket')
+    parser.add_argument('--port', type=int, default=8765, help='Localhost port for --daemon to listen on: defaults to 8765')
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of a port with --daemon')
+    parser.add_argument('--max-concurrent', type=int, default=2, help='Builds --daemon will run at the same time, others wait their turn: defaults to 2')
+    return parser
+
+
+def default_args(**options):
+    """ mksong's options as a dict, with defaults for anything not passed """
+    args = vars(argument_parser().parse_args([]))
+    for name, value in options.items():
+        if name not in args:
+            raise ValueError("Unknown option %s" % name)
+        args[name] = value
+    return args
+
+
+def prepare(args, data_dir = None):
+    """ Fill in the options that depend on other options: PDF if no other format was asked for,
+    and the reference documents in data_dir for word processor formats """
+    if not(args['html'] or args['odt'] or args['docx'] or args['epub']):
+        args['pdf'] = True # Default to PDF if no other options given
+
+    if data_dir != None:
+        if args['docx'] and not args['reference_docx'] and os.path.exists(os.path.join(data_dir, 'reference.docx')):
+             args['reference_docx'] = os.path.join(data_dir, 'reference.docx')
+        if args['odt'] and not args['reference_odt'] and os.path.exists(os.path.join(data_dir, 'reference.odt')):
+             args['reference_odt'] = os.path.join(data_dir, 'reference.odt')
+    return args
+
+
+def relative_to(cwd, path):
+    """ path, relative to cwd (if there is one) """
+    if cwd == None or path == None:
+        return path
+    return os.path.join(cwd, path)
+
+
+def build(args, instruments = None, song_cache = None, cwd = None):
+    """ Make the book (or single sheets) asked for in args, a dict of mksong options (see default_args and prepare)
+    instruments: Instruments to use, a new set is loaded if not passed
+    song_cache: books.SongCache to get parsed songs from
+    cwd: directory relative paths in args are relative to, defaults to the current directory
+    Returns the paths of the files written
+    """
+    book, output_file = load_book(args, instruments, song_cache, cwd)
+    return save_book(book, args, output_file, cwd = cwd)
+
+
+def load_book(args, instruments = None, song_cache = None, cwd = None):
+    """ First half of build: load the songs. Returns the book and the output file name (without extension) """
+    def here(path):
+        return relative_to(cwd, path)
+
+    if instruments == None:
+        instruments = inst.Instruments()
+
+    out_dir = args["directory"]
+    output_file = args["file_stem"]
+    book_file = here(args["book_file"])
+    setlist = here(args["setlist"])
+
+    # Do we want chord grids?
+    if args["instrument"] != None:
+        instrument = instruments.get_instrument_by_name(args['instrument'])
+        if instrument != None:
+            instrument.load_chord_chart(lefty=True)
+            print("Loaded", args['instrument'])
+            chart = instrument.chart
+            if chart == None:
+                print(instrument.error)
+        else:
+            print("No such instrument on file. Try typing ./mksong --instruments to get a list")
+
+    with profiling.span("load songs"):
+        book = books.cp_song_book(
+            external_css = here(args['external_css']),
+            header_font_name = args['header_font_name'],
+            header_font_size = args['header_font_size'],
+            instrument_name = args['instrument'],
+            instruments = instruments,
+            keep_order = args['keep_order'] or args['setlist'],
+            lefty = args['left_handed'],
+            major_chart = args['major_chart'],
+            nashville = args['nashville'],
+            path = book_file or '.',
+            title = args['title'],
+            song_cache = song_cache
+        )
+
+        if book_file:
+            #base output path on book unless user passed a different name
+            book_dir, book_name = os.path.split(book_file)
+            if args["file_stem"]:
+                output_file = here(os.path.join(out_dir, output_file))
+            else:
+                output_file = os.path.join(book_dir, out_dir, book_name)
+            if not args["files"]:
+                print ("Read book file (%s), ignored other files passed" % args["book_file"])
+
+        elif args["files"] != None:
+           output_file = here(os.path.join(out_dir, output_file))
+           for f in args['files']:
+                if isinstance(f, str):
+                    f = open(here(f))
+                # Only render requests (see chordprobook.daemon) transpose files
+                book.add_song_from_file(f, args.get('transpose', 0))
+
+    if setlist:
+         book.order_by_setlist(setlist)
+         set_dir, set_name = os.path.split(setlist)
+         output_file = os.path.join(set_dir, out_dir, set_name)
+
+    if args["alphabetically"]:
+        book.sort_alpha()
+
+    return book, output_file
+
+
+def save_book(book, args, output_file, songs = None, cwd = None):
+    """ Second half of build: save the book from load_book in the formats asked for.
+    songs: for single sheets (--one-doc), only save these songs
+    Outputs whose inputs haven't changed since they were last made (see books.Manifest) are left alone
+    unless args['force'] is set.
+    Returns the paths of the outputs, made or already up to date """
+    args = dict(args, reference_docx = relative_to(cwd, args['reference_docx']), reference_odt = relative_to(cwd, args['reference_odt']))
+    written = []
+    book.manifest = books.Manifest(force = args['force'])
+
+    #PDF is generated from HTML, BTW
+    if args['one_doc']: #Assume standalone sheets
+        for sheet in book.save_as_single_sheets(args["directory"], args, songs):
+            written += sheet["paths"]
+
+    elif args['html'] or args['pdf'] or args['docx'] or args['odt'] or args['epub']:
+        written += book.output(args, output_file)
+
+    book.manifest.save()
+    print("Outputs: %s" % book.manifest.report())
+    chords.FingeringStore.save_all()
+    cache.record()
+    return written
+
+
+class Watcher:
+    """ mksong --watch: build, then rebuild whenever anything the build read changes (checking every
+    Watcher.interval seconds). Songs that haven't changed aren't parsed or converted to HTML again,
+    and for single sheets (--one-doc) only the sheets for songs that changed are saved """
+    interval = 0.3
+
+    def __init__(self, args, cwd = None):
+        self.args = dict(args)
+        if args["files"]:
+            # Files get read on every build, so keep their names rather than the open files
+            self.args["files"] = []
+            for f in args["files"]:
+                if not isinstance(f, str):
+                    f.close()
+                    f = f.name
+                self.args["files"].append(f)
+        self.cwd = cwd
+        self.song_cache = books.SongCache()
+        self.stamps = {} # Input path -> stamp when last built
+
+    def stamp(self, path):
+        """ Something that changes when the file does, None if it's not there """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def changes(self):
+        """ Inputs that have changed since the last build """
+        return set(path for path, stamp in self.stamps.items() if self.stamp(path) != stamp)
+
+    def song_inputs(self, song):
+        return set(os.path.abspath(path) for path in [song.path] + song.page_images if path != None)
+
+    def build(self, changed = None):
+        """ Build, or rebuild after changes to the paths in changed. Returns the paths written """
+        start = time.perf_counter()
+        written = []
+        try:
+            book, output_file = load_book(self.args, inst.Instruments(), self.song_cache, self.cwd)
+            songs = None
+            if changed != None and self.args['one_doc']:
+                songs = [song for song in book.songs if changed & self.song_inputs(song)]
+                if changed - set().union(*[self.song_inputs(song) for song in songs]):
+                    songs = None # Something other than the songs changed, so they're all affected
+            written = save_book(book, self.args, output_file, songs, self.cwd)
+            self.stamps = dict((path, self.stamp(path)) for path in book.input_paths())
+            print("Built %s files in %.2fs" % (len(written), time.perf_counter() - start))
+        except Exception as e:
+            # Probably something half-saved, wait for the next change
+            print("Build failed: %s: %s" % (type(e).__name__, e))
+            paths = list(self.stamps) or [relative_to(self.cwd, path) for path in
+                                          [self.args["book_file"], self.args["setlist"], self.args["external_css"]] + (self.args["files"] or []) if path != None]
+            self.stamps = dict((path, self.stamp(path)) for path in paths)
+        return written
+
+    def watch(self):
+        """ Build, then rebuild on changes until interrupted """
+        self.build()
+        print("Watching %s files for changes, Ctrl-C to stop" % len(self.stamps))
+        try:
+            while True:
+                time.sleep(self.interval)
+                changed = self.changes()
+                if changed:
+                    print("Changed: %s" % ", ".join(sorted(changed)))
+                    self.build(changed)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,347 @@
+#! /usr/bin/env python3
+"""
+The on-disk cache shared by every mksong (and render daemon) run as the same user: $CHORDPROBOOK_CACHE,
+or ~/.cache/chordprobook. Each kind of thing kept there has a namespace (a directory) of its own:
+
+html-fragments  song HTML (books.FragmentCache)
+pdf-parts       PDFs of songs, sets and front matter for --assemble (pdfs.PartCache)
+diagrams        chord diagram PNGs (chords.DiagramStore)
+charts          compiled chord charts (chords.CompiledChart)
+fingerings      fingerings worked out for tunings (chords.FingeringStore)
+
+Entries are written to a temp file then moved into place, so mksongs running at the same time never
+see half an entry, and are touched when they're used. Each namespace has a size budget (see budgets,
+override them with $CHORDPROBOOK_CACHE_LIMITS, eg "pdf-parts=1G,diagrams=50M"): when a build has
+written to a namespace that's over budget, the least recently used entries are removed until it isn't.
+
+Hits and misses are counted per namespace, and record() adds them to stats.log in the cache at the
+end of each build. mksong cache stats|prune|clear reports on and tidies up the cache, see command().
+"""
+import json
+import os
+import re
+import threading
+import time
+
+MB = 1024 * 1024
+budgets = {"html-fragments": 200 * MB,
+           "pdf-parts": 500 * MB,
+           "diagrams": 100 * MB,
+           "charts": 20 * MB,
+           "fingerings": 50 * MB}
+stats_file = "stats.log"
+# Entries used within this many seconds aren't touched again, it's plenty accurate for pruning
+touch_interval = 60
+# Temp files older than this are left over from a crash, prune() removes them
+stale_temp_seconds = 3600
+
+lock = threading.Lock()
+# namespace -> {"hits", "misses", "writes"} since the last record()
+counters = {}
+
+
+def root():
+    return os.environ.get("CHORDPROBOOK_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "chordprobook"))
+
+
+def parse_size(size):
+    """ Bytes in a size like 500M, 2G, 100k or 12345 """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*$", str(size))
+    if match == None:
+        raise ValueError("Don't understand size %s, try something like 500M" % size)
+    return int(float(match.group(1)) * {"": 1, "k": 1024, "m": MB, "g": 1024 * MB}[match.group(2).lower()])
+
+
+def format_size(size):
+    for unit, scale in (("G", 1024 * MB), ("M", MB), ("k", 1024)):
+        if size >= scale:
+            return "%.1f%s" % (size / scale, unit)
+    return "%sB" % size
+
+
+def budget(name):
+    """ Size budget for a namespace in bytes, from $CHORDPROBOOK_CACHE_LIMITS or budgets (None: no limit) """
+    for setting in os.environ.get("CHORDPROBOOK_CACHE_LIMITS", "").split(","):
+        if "=" in setting:
+            setting_name, size = setting.split("=", 1)
+            if setting_name.strip() == name:
+                return parse_size(size)
+    return budgets.get(name)
+
+
+def count(name, what):
+    with lock:
+        counts = counters.setdefault(name, {"hits": 0, "misses": 0, "writes": 0})
+        counts[what] += 1
+
+
+class Namespace:
+    """ One kind of thing in the cache: entries are files named by a key (normally a hash) """
+    def __init__(self, name, directory = None):
+        """ directory: where to keep the entries, defaults to the name under root() """
+        self.name = name
+        self.directory = directory if directory != None else os.path.join(root(), name)
+
+    def path(self, key, suffix = ""):
+        """ Where an entry goes, keys that look like hashes are spread over subdirectories """
+        if re.match("^[0-9a-f]{16,}$", key):
+            return os.path.join(self.directory, key[:2], key + suffix)
+        return os.path.join(self.directory, key + suffix)
+
+    def touch(self, path, mtime = None):
+        """ Mark an entry as just used, for prune() """
+        now = time.time()
+        try:
+            if mtime == None:
+                mtime = os.stat(path).st_mtime
+            if now - mtime > touch_interval:
+                os.utime(path, (now, now))
+        except OSError:
+            pass
+
+    def lookup(self, key, suffix = ""):
+        """ Path of an entry if it's there (counting a hit and touching it), otherwise None (counting a miss) """
+        path = self.path(key, suffix)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            count(self.name, "misses")
+            return None
+        count(self.name, "hits")
+        self.touch(path, mtime)
+        return path
+
+    def get(self, key, suffix = ""):
+        """ An entry's bytes, or None if it isn't there """
+        path = self.path(key, suffix)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except OSError:
+            count(self.name, "misses")
+            return None
+        count(self.name, "hits")
+        self.touch(path, mtime)
+        return data
+
+    def temp_path(self, path):
+        return "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+
+    def put(self, key, data, suffix = ""):
+        """ Write an entry (bytes, or a str as UTF-8), atomically. Returns its path """
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temp_path = self.temp_path(path)
+        with open(temp_path, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        self.put_file(temp_path, path)
+        return path
+
+    def put_file(self, temp_path, path):
+        """ Move a file written somewhere in the namespace (eg by a renderer) into place as an entry """
+        os.replace(temp_path, path)
+        count(self.name, "writes")
+
+    def entries(self):
+        """ (path, bytes, last used) of every entry, least recently used first. Doesn't include temp files """
+        found = []
+        for directory, dirs, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith(".tmp") or ".tmp." in file:
+                    continue
+                path = os.path.join(directory, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((path, stat.st_size, stat.st_mtime))
+        return sorted(found, key = lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for path, size, used in self.entries())
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def prune(self, max_bytes = None):
+        """ Remove the least recently used entries until the namespace fits in max_bytes (defaults to its
+        budget), and any temp files left behind by crashed builds. Returns (entries removed, bytes freed) """
+        if max_bytes == None:
+            max_bytes = budget(self.name)
+        removed = 0
+        freed = 0
+        now = time.time()
+        for directory, dirs, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(directory, file)
+                try:
+                    stale = (file.endswith(".tmp") or ".tmp." in file) and now - os.stat(path).st_mtime > stale_temp_seconds
+                except OSError:
+                    stale = False
+                if stale:
+                    self.remove(path)
+        if max_bytes == None:
+            return (0, 0)
+        entries = self.entries()
+        total = sum(size for path, size, used in entries)
+        for path, size, used in entries:
+            if total <= max_bytes:
+                break
+            if self.remove(path):
+                total -= size
+                removed += 1
+                freed += size
+        return (removed, freed)
+
+    def clear(self):
+        """ Remove every entry. Returns (entries removed, bytes freed) """
+        removed = 0
+        freed = 0
+        for path, size, used in self.entries():
+            if self.remove(path):
+                removed += 1
+                freed += size
+        return (removed, freed)
+
+
+class TemporaryCache:
+    """ Points the cache at a temporary directory of its own (eg for a test), with the default budgets,
+    until cleanup() or the end of a with block, when the previous $CHORDPROBOOK_CACHE and
+    $CHORDPROBOOK_CACHE_LIMITS are put back and the directory removed """
+    settings = ["CHORDPROBOOK_CACHE", "CHORDPROBOOK_CACHE_LIMITS"]
+
+    def __init__(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.name = self.tmp.name
+        self.previous = dict((name, os.environ.get(name)) for name in TemporaryCache.settings)
+        os.environ["CHORDPROBOOK_CACHE"] = self.name
+        os.environ.pop("CHORDPROBOOK_CACHE_LIMITS", None)
+
+    def cleanup(self):
+        for name, value in self.previous.items():
+            if value == None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.cleanup()
+
+
+def namespaces(names = None):
+    """ Namespaces by name, defaults to the known ones (see budgets) plus any other directories in the cache """
+    if names == None:
+        names = list(budgets)
+        if os.path.isdir(root()):
+            names += sorted(name for name in os.listdir(root()) if os.path.isdir(os.path.join(root(), name)) and name not in budgets)
+    return [Namespace(name) for name in names]
+
+
+def record():
+    """ Add the hits and misses counted since the last record() to the stats log, and prune namespaces
+    that have been written to. Called at the end of each build """
+    global counters
+    with lock:
+        counts, counters = counters, {}
+    if counts == {}:
+        return
+    line = json.dumps({"time": time.time(), "pid": os.getpid(),
+                       "namespaces": dict((name, {"hits": c["hits"], "misses": c["misses"]}) for name, c in counts.items())})
+    try:
+        os.makedirs(root(), exist_ok = True)
+        # One short line in append mode, so builds running at the same time don't mix their lines up
+        with open(os.path.join(root(), stats_file), "a") as f:
+            f.write(line + "\n")
+    except OSError:
+        pass
+    for name, c in counts.items():
+        if c["writes"] > 0:
+            Namespace(name).prune()
+
+
+def recorded():
+    """ Total hits and misses per namespace in the stats log, and the number of builds recorded """
+    totals = {}
+    builds = 0
+    try:
+        with open(os.path.join(root(), stats_file)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                builds += 1
+                for name, c in entry.get("namespaces", {}).items():
+                    total = totals.setdefault(name, {"hits": 0, "misses": 0})
+                    total["hits"] += c.get("hits", 0)
+                    total["misses"] += c.get("misses", 0)
+    except OSError:
+        pass
+    return totals, builds
+
+
+def stats(names = None):
+    """ List of dicts (name, entries, bytes, budget, hits, misses, hit_rate), one per namespace """
+    totals, builds = recorded()
+    found = []
+    for namespace in namespaces(names):
+        entries = namespace.entries()
+        hits = totals.get(namespace.name, {}).get("hits", 0)
+        misses = totals.get(namespace.name, {}).get("misses", 0)
+        found.append({"name": namespace.name,
+                      "entries": len(entries),
+                      "bytes": sum(size for path, size, used in entries),
+                      "budget": budget(namespace.name),
+                      "hits": hits,
+                      "misses": misses,
+                      "hit_rate": hits / (hits + misses) if hits + misses else None})
+    return found
+
+
+def argument_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog = "mksong cache", description = "Report on or tidy up the cache in %s" % root())
+    parser.add_argument('action', choices = ['stats', 'prune', 'clear'],
+                        help = 'stats: entries, size and hit rate (from the builds recorded) for each namespace; prune: remove the least recently used entries from namespaces over budget; clear: remove everything (and the recorded hit rates)')
+    parser.add_argument('namespaces', nargs = '*', default = None, help = 'Only these namespaces, eg html-fragments pdf-parts: defaults to all of them')
+    parser.add_argument('--max-size', default = None, help = 'With prune, the budget for each namespace (eg 100M) instead of the usual ones')
+    parser.add_argument('--json', action = 'store_true', help = 'With stats, print JSON')
+    return parser
+
+
+def command(argv):
+    """ mksong cache ...: returns the report as text """
+    args = argument_parser().parse_intermixed_args(argv)
+    names = args.namespaces or None
+    lines = []
+    if args.action == 'stats':
+        found = stats(names)
+        if args.json:
+            return json.dumps({"directory": root(), "builds": recorded()[1], "namespaces": found}, indent = 2)
+        lines.append("Cache in %s, hits and misses from %s builds" % (root(), recorded()[1]))
+        lines.append("%-16s %8s %9s %9s %8s %8s %8s" % ("namespace", "entries", "size", "budget", "hits", "misses", "hit rate"))
+        for s in found:
+            lines.append("%-16s %8s %9s %9s %8s %8s %8s" % (
+                s["name"], s["entries"], format_size(s["bytes"]), format_size(s["budget"]) if s["budget"] != None else "-",
+                s["hits"], s["misses"], "%.0f%%" % (100 * s["hit_rate"]) if s["hit_rate"] != None else "-"))
+    else:
+        max_bytes = parse_size(args.max_size) if args.max_size != None else None
+        for namespace in namespaces(names):
+            if args.action == 'prune':
+                removed, freed = namespace.prune(max_bytes)
+            else:
+                removed, freed = namespace.clear()
+            lines.append("%s: removed %s entries, %s" % (namespace.name, removed, format_size(freed)))
+        if args.action == 'clear' and names == None and os.path.exists(os.path.join(root(), stats_file)):
+            os.remove(os.path.join(root(), stats_file))
+    return "\n".join(lines)
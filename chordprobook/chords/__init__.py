@@ -1,20 +1,15 @@
 #! /usr/bin/env python3
-import glob
+# PIL, base64 and concurrent.futures are imported where they're used, so that loading this module stays quick
 import re
-import argparse
 import os, os.path
-import subprocess
-import pypandoc
-import tempfile
-import copy
-import fnmatch
-import math
-from PIL import Image, ImageFont, ImageDraw
-from io import BytesIO
-import base64
-import yaml
+import struct
+import array
+import threading
+import zlib
 import chordprobook
+import chordprobook.cache as cache
 import chordprobook.instruments
+import chordprobook.profiling as profiling
 
 class transposer:
     """ This should have been a static method with two parameters transpose(chord_or_note, offset)
@@ -38,6 +33,9 @@ class transposer:
 
     __superscripts = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
 
+    # (offset, chord) -> transposed chord, so each chord in a song is only worked out once per key
+    chord_table = {}
+
     def __init__(self, offset = 0, key = None, major_chart = False):
         self.minor = False
         if key:
@@ -54,7 +52,12 @@ class transposer:
     def transpose_chord(self, chord_string, offset=None):
         if offset:
             self.offset = offset
-        return re.sub("([A-G](\#|b)?)",(lambda x: self.transpose_note(x.group())), chord_string)
+        key = (self.offset, chord_string)
+        transposed = transposer.chord_table.get(key)
+        if transposed == None:
+            transposed = re.sub("([A-G](\#|b)?)",(lambda x: self.transpose_note(x.group())), chord_string)
+            transposer.chord_table[key] = transposed
+        return transposed
 
     def transpose_chord_nashville(self, chord_string, offset=None):
         if offset:
@@ -118,6 +121,8 @@ class ChordVoicings:
     """Container for alternative fingerings/voicings."""
     def __init__(self, grid):
         self.voicings = [grid]
+        # Set by ChordChart once all the definitions from its chart file are in
+        self.from_index = False
 
     def append(self, grid):
         self.voicings.append(grid)
@@ -134,15 +139,31 @@ class ChordVoicings:
 class ChordChart(object):
     """ A set of ChordDiagrams, multiple fingerings per chord """
 
-    def __init__(self, transpose = 0,file = None, lefty=False):
-        """Container for a set of ChordDiagrams"""
+    # Chord chart files that have been indexed already, by (path, modification time, transpose)
+    indexes = {}
+    index_hits = 0
+    index_misses = 0
+    # normalise_chord_name results, it gets asked about the same few chords over and over
+    normalised_names = {}
+
+    def __init__(self, transpose = 0,file = None, lefty=False, instrument = None, lazy = False):
+        """Container for a set of ChordDiagrams
+        instrument: optional Instrument, chords not in the chart will be filled in from its FingeringStore
+        lazy: only index the file, and turn definitions into ChordDiagrams as they're asked for
+        """
         self.grids = {}
         self.tuning = None
         self.transposer = transposer(transpose)
         self.error = None
         self.lefty = lefty
+        self.instrument = instrument
+        self.not_in_store = set()
+        self.index = {}
+        self.compiled = None
         if file != None:
-            self.load_file(open(file))
+            self.load_index(file)
+            if not lazy:
+                self.load_all()
         
 
 
@@ -159,10 +180,11 @@ class ChordChart(object):
         defs_file = instruments.get_chordpro_file_by_name(instrument_name)
         path, file = os.path.split(os.path.realpath(__file__))
         if defs_file != None:
+            self.instrument = instruments.get_instrument_by_name(instrument_name)
             self.transposer.offset = instruments.get_transpose_by_name(instrument_name)
             f = os.path.join(path, defs_file)
             if os.path.exists(f):
-                self.load_file(open(f))
+                self.load_index(f)
             else:
                 print("******** Unable to load %s" % f)
         else:
@@ -172,6 +194,7 @@ class ChordChart(object):
         grid = ChordDiagram(lefty=self.lefty)
         grid.parse_definition(definition)
         grid.name = self.normalise_chord_name(grid.name)
+        self.load_chord(grid.name)
         if grid.name not in self.grids:
             self.grids[grid.name] = ChordVoicings(grid)
         else:
@@ -179,6 +202,7 @@ class ChordChart(object):
 
     def add_from_diagram(self, grid):
         grid.name = self.normalise_chord_name(grid.name)
+        self.load_chord(grid.name)
         if grid.name not in self.grids:
             self.grids[grid.name] = ChordVoicings(grid)
         else:
@@ -202,6 +226,70 @@ class ChordChart(object):
                 else:
                     self.grids[grid.name].append(grid)
 
+    def load_index(self, path):
+        """ Lazy version of load_file: work out which definitions go with which chord name
+        (transposed for the instrument), but don't unpack them until they're needed.
+        Definitions come from the compiled version of the file (see CompiledChart) if it can be compiled,
+        otherwise they're the {define: } lines from the file itself.
+        Indexes are kept so the next chart to load the same file doesn't have to read it again
+        """
+        self.transposer.offset = 12 - self.transposer.offset
+        key = (os.path.realpath(path), os.path.getmtime(path), self.transposer.offset)
+        if key in ChordChart.indexes:
+            ChordChart.index_hits += 1
+        else:
+            ChordChart.index_misses += 1
+            index = {}
+            try:
+                compiled = CompiledChart.load(path)
+                for name, offsets in compiled.index.items():
+                    if self.transposer.offset > 0:
+                        name = self.transposer.transpose_chord(name)
+                    index.setdefault(name, []).extend(offsets)
+            except (ValueError, OverflowError, struct.error):
+                # Something in there the binary format can't hold exactly, so stick to the text
+                compiled = None
+                index = {}
+                name_re = re.compile("{define: +(\\S+)", re.IGNORECASE)
+                with open(path) as f:
+                    for line in f:
+                        if line.startswith("{define:"):
+                            name_search = re.match(name_re, line)
+                            name = self.normalise_chord_name(name_search.group(1) if name_search else "")
+                            if self.transposer.offset > 0:
+                                name = self.transposer.transpose_chord(name)
+                            index.setdefault(name, []).append(line)
+            ChordChart.indexes[key] = (index, compiled)
+        self.index, self.compiled = ChordChart.indexes[key]
+
+    def load_chord(self, chord_name):
+        """ Parse the definitions for a chord from the index, if there are any we haven't parsed yet """
+        definitions = self.index.get(chord_name)
+        if definitions == None or chord_name in self.grids and self.grids[chord_name].from_index:
+            return
+        voicings = None
+        for definition in definitions:
+            grid = ChordDiagram(lefty=self.lefty)
+            if self.compiled != None:
+                unpacked = self.compiled.definition(definition)
+                if unpacked != None:
+                    grid.set_definition(*unpacked)
+                grid.setup()
+            else:
+                grid.parse_definition(definition)
+            grid.name = chord_name
+            if voicings == None:
+                voicings = ChordVoicings(grid)
+            else:
+                voicings.append(grid)
+        voicings.from_index = True
+        self.grids[chord_name] = voicings
+
+    def load_all(self):
+        """ Make sure every chord in the index has been parsed """
+        for chord_name in self.index:
+            self.load_chord(chord_name)
+
     def clean_chord_name(self, chord_name):
         """ Remove characters from a chord name that are to do with timing: ! and /. """
          # Allow ! for stacatto chord
@@ -215,6 +303,9 @@ class ChordChart(object):
         """ Transform chord name as used to a canonical name, means we only have to store a limited set of chords
         chord_name: a string representation of a chord
         """
+        if chord_name in ChordChart.normalised_names:
+            return ChordChart.normalised_names[chord_name]
+        original_name = chord_name
         chord_name = self.clean_chord_name(chord_name)
         # Normalise "add" for ninths, elevenths etc - TODO sharps as well
         #chord_name = re.sub("[aA]dd(\d+)","\\1", chord_name)
@@ -232,6 +323,7 @@ class ChordChart(object):
         chord_name = re.sub("\+","aug", chord_name)
         tr = transposer(0)
         chord_name = tr.transpose_chord(chord_name)
+        ChordChart.normalised_names[original_name] = chord_name
         return chord_name
 
     def nashvillize(self, chord_name, key, major_chart = False):
@@ -269,6 +361,9 @@ class ChordChart(object):
 
     def get_default(self, chord_name):
         chord_name = self.normalise_chord_name(chord_name)
+        self.load_chord(chord_name)
+        if chord_name not in self.grids:
+            self.add_from_store(chord_name)
         if chord_name in self.grids:
             chord = self.grids[chord_name]
             if len(chord.voicings) > 0:
@@ -276,13 +371,27 @@ class ChordChart(object):
         else:
             return None
 
+    def add_from_store(self, chord_name):
+        """ Fill in a chord that's not in the chart with fingerings worked out for the instrument's tuning """
+        if self.instrument == None or self.instrument.notes == [] or chord_name in self.not_in_store:
+            return
+        fingerings = self.instrument.fingering_store().get(self.instrument, chord_name)
+        if fingerings == []:
+            self.not_in_store.add(chord_name)
+            return
+        chord = Chord(chord_name, lefty=self.lefty)
+        chord._fingering_array = fingerings
+        chord.add_to_chordchart(self)
+
     def sort_by_playability(self,chord_name):
+        self.load_chord(chord_name)
         if chord_name in self.grids:
             chord = self.grids[chord_name]
             chord.sort_by_playability()
 
     def to_chordpro(self, chord_name):
         """ Output chordpro definitions for all know variants of a chord"""
+        self.load_chord(chord_name)
         if chord_name in self.grids:
             chordpro = ""
             for grid in self.grids[chord_name].voicings:
@@ -292,6 +401,7 @@ class ChordChart(object):
     def all_to_chordpro(self):
        """ Output all voicings of all chords"""
        chordpro = ""
+       self.load_all()
        for chord_name in sorted(self.grids.keys()):
             chordpro += "%s\n" % self.to_chordpro(chord_name)
        return chordpro
@@ -306,6 +416,10 @@ class ChordDiagram(object):
     bgcolor = (255,255,255) #whitish
     dot_text_color = (256,256,256) #white
     dot_color = (0,0,0) #black
+    # Rendered diagrams (as data URIs) by everything that goes into drawing them, see drawing_key
+    data_URIs = {}
+    data_URI_hits = 0
+    data_URI_misses = 0
 
     def __init__(self, name="", strings=[], draw_name=False, offsets = None, lefty= False):
         """ Empty diagram. No strings, no frets, no nothin' """
@@ -325,13 +439,34 @@ class ChordDiagram(object):
         self.chord = Chord(name)
         self.setup()
 
+    def drawing_key(self, display_name=None):
+        """ Everything draw() looks at, so diagrams that would come out the same share a key """
+        dots = tuple(tuple((dot.fret, dot.finger) for dot in string.dots) for string in self.strings)
+        return (self.name, display_name, self.draw_name, self.base_fret, self.num_frets,
+                self.box_width, self.box_height, dots)
+
     def to_data_URI(self, display_name=None):
-        """Convert pic binary data to a data URI for use in web pages"""
-        self.draw(display_name=display_name)
-        output = BytesIO()
-        self.img.save(output, format='PNG')
-        im_data = output.getvalue()
-        return('data:image/png;base64,' + base64.b64encode(im_data).decode())
+        """Convert pic binary data to a data URI for use in web pages.
+        Each different diagram is only drawn once, see ChordDiagram.data_URIs and DiagramStore"""
+        key = self.drawing_key(display_name)
+        uri = ChordDiagram.data_URIs.get(key)
+        if uri != None:
+            ChordDiagram.data_URI_hits += 1
+            return uri
+        ChordDiagram.data_URI_misses += 1
+        import base64
+        store = DiagramStore()
+        im_data = store.get(key)
+        if im_data == None:
+            from io import BytesIO
+            self.draw(display_name=display_name)
+            output = BytesIO()
+            self.img.save(output, format='PNG')
+            im_data = output.getvalue()
+            store.put(key, im_data)
+        uri = 'data:image/png;base64,' + base64.b64encode(im_data).decode()
+        ChordDiagram.data_URIs[key] = uri
+        return uri
         
 
     def to_md(self, display_name=None):
@@ -421,10 +556,12 @@ class ChordDiagram(object):
         self.playability = self.open_strings * 50  - self.max_fret * 29 - (self.max_fret - self.min_fret) * 7 - self.fingers * 8
 
 
+    @profiling.profiled("ChordDiagram.draw", "diagram")
     def draw(self, display_name=None):
         """
         Render the chord.
         """
+        from PIL import Image, ImageDraw
         # Commence scribbling
         self.img = Image.new("RGB", (self.box_width, self.box_height), ChordDiagram.bgcolor)
         draw = ImageDraw.Draw(self.img)
@@ -499,56 +636,75 @@ class ChordDiagram(object):
 
     def parse_definition(self, definition):
         """Unpack a chordpro chord definition, trying to be as permissive as possible """
+        unpacked = ChordDiagram.unpack_definition(definition)
+        if unpacked != None:
+            self.name = unpacked[0]
+            self.set_definition(*unpacked[1:])
+        self.setup()
+
+    def unpack_definition(definition):
+        """ Pull the parts out of a chordpro {define: } line, without building any diagram
+        Returns (name, base_fret, frets, fingers, additional_dots) or None if it doesn't look like a definition.
+        frets has None for unplayed strings, fingers is None if not given and
+        additional_dots is a list of (string, fret, finger)
+        """
         frets_re = re.compile("{define: +(\\S+?) *(base-fret (\\d+))? *(frets)? +([\\d x]+)", re.IGNORECASE)
         frets_search = re.search(frets_re, definition)
+        if frets_search == None:
+            return None
 
-        if frets_search != None:
-            self.name = frets_search.group(1)
-            self.base_fret = frets_search.group(3)
-            if self.base_fret == None:
-                self.base_fret = 0
-            else:
-                self.base_fret = int(self.base_fret)
-            #Get rid of basic frets part
-            definition = re.sub(frets_re, "", definition)
-
-            #Look for optional fingers spec
-            fingers_re = re.compile("fingers +([\\d ]+)", re.IGNORECASE)
-            fingers_search = re.search(fingers_re, definition)
+        name = frets_search.group(1)
+        base_fret = frets_search.group(3)
+        if base_fret == None:
+            base_fret = 0
+        else:
+            base_fret = int(base_fret)
+        #Get rid of basic frets part
+        definition = re.sub(frets_re, "", definition)
+
+        #Look for optional fingers spec
+        fingers_re = re.compile("fingers +([\\d ]+)", re.IGNORECASE)
+        fingers_search = re.search(fingers_re, definition)
+        fingers = None
+        if fingers_search != None:
+            fingers = fingers_search.group(1).strip().split(" ")
+            definition = re.sub(fingers_re, "", definition)
+
+        frets = [None if fret.lower() == 'x' else int(fret) for fret in frets_search.group(5).strip().split(" ")]
+
+        # Look for additional fingers
+        # Could add this to main regex but this was simpler in initial coding
+        additional_dots = []
+        definition = definition.replace("}","")
+        additional = definition.strip().split("add: ")
+        for dot_to_add in additional:
+             add_re = re.compile("string +(\\d+) +fret +(\\d+) +finger +(\\d+)")
+             add_search = re.search(add_re, dot_to_add)
+             if add_search != None:
+                additional_dots.append((int(add_search.group(1)), int(add_search.group(2)), int(add_search.group(3))))
+        return (name, base_fret, frets, fingers, additional_dots)
+
+    def set_definition(self, base_fret, frets, fingers, additional_dots):
+        """ Set up the strings from an unpacked definition (see unpack_definition), call setup() afterwards """
+        self.base_fret = base_fret
+        # Don't use fingerings if we're doing left handed chords
+        if self.lefty:
             fingers = None
-            # Don't use fingerings if we're doing left handed chords
-            if not self.lefty and fingers_search != None:
-                fingers = fingers_search.group(1).strip().split(" ")
-                definition = re.sub(fingers_re, "", definition)
+        self.strings = []
+        i = 0
+        for fret in frets:
+            finger = None
+            if fingers != None:
+                finger = fingers[i] if fingers[i] != 0 else None
 
-            self.strings = []
-            frets = frets_search.group(5).strip().split(" ")
-            i = 0
-            for fret in frets:
-                fret = None if  fret.lower() == 'x' else int(fret)
-                finger = None
-                if fingers != None:
-                    finger = fingers[i] if fingers[i] != 0 else None
-
-                self.strings.append(String([Dot(fret, finger)]))
-                i += 1
-            # Look for additional fingers
-            # Could add this to main regex but this was simpler in initial coding
-            definition = definition.replace("}","")
-            additional = definition.strip().split("add: ")
-            for dot_to_add in additional:
-                 add_re = re.compile("string +(\d+) +fret +(\d+) +finger +(\d+)")
-                 add_search = re.search(add_re, dot_to_add)
-                 if add_search != None:
-                    string = int(add_search.group(1)) - 1
-                    fret = int(add_search.group(2))
-                    finger = int(add_search.group(3))
-                    if string <= len(frets) and fret > 0:
-                        self.strings[string].dots.append(Dot(fret, finger))
-            if self.lefty:
-                self.strings.reverse()
-
-        self.setup()
+            self.strings.append(String([Dot(fret, finger)]))
+            i += 1
+        for (string, fret, finger) in additional_dots:
+            string = string - 1
+            if string <= len(frets) and fret > 0:
+                self.strings[string].dots.append(Dot(fret, finger))
+        if self.lefty:
+            self.strings.reverse()
 
 
 
@@ -637,12 +793,16 @@ class Chord:
 
         return self.nums
 
-    def find_fingerings(self, instrument, reach = 4, fingers = 4, unplayed = 0):
+    def find_fingerings(self, instrument, reach = 4, fingers = 4, unplayed = 0, library = None):
         """Work out ways of playing a chord on the given instrument
         instrument: an instrument object
+        library: optional ShapeLibrary to re-use moveable shapes found for other chords
       """
         self.spell()
-        self._fingering_array = Fingerings(self, instrument, reach, fingers, unplayed).fingerings
+        if library != None:
+            self._fingering_array = library.find_fingerings(self, instrument, reach, fingers, unplayed)
+        else:
+            self._fingering_array = Fingerings(self, instrument, reach, fingers, unplayed).fingerings
 
 
     def to_chordpro(self):
@@ -655,6 +815,8 @@ class Chord:
     def add_to_chordchart(self, chart):
         """ Add the chords found by find_fingerings to a chord chart object)"""
         for fingering in self._fingering_array:
+            if self.lefty:
+                fingering = list(reversed(fingering))
             diagram = ChordDiagram(offsets = fingering, name=self.name, lefty=self.lefty)
             chart.add_from_diagram(diagram)
         chart.sort_by_playability(self.name)
@@ -662,80 +824,749 @@ class Chord:
 class Fingerings:
     """ Class for holding and finding different ways of playinc a chord """
 
-    def __init__(self, chord, instrument, reach=4, fingers=4, max_unplayed_strings = 1):
+    # Frets 0..max_fret are searched on each string
+    max_fret = 11
+
+    # Number of notes in each 12-bit pitch-class mask, so notes still to find can be looked up rather than counted
+    bit_count = [bin(i).count("1") for i in range(1 << 12)]
+
+    def __init__(self, chord, instrument, reach=4, fingers=4, max_unplayed_strings = 1, frets = None, open_only = False):
         """ Set up a fingerings object
         chord = A and instance of chordprobook.chords.Chord
         instrument = An instance of chordprobook.instruments.Instrument
+        frets = Optional list of the frets to try on each string (defaults to all of them)
+        open_only = Only look for fingerings with at least one open string
         """
         self.chord = chord
-        notes_yet_to_find = [x.num for x in chord.notes]
-         # TODO make this a chord
-
         self.max_reach = reach
         self.max_fingers = fingers
         self.instrument = instrument
         self.max_unplayed_strings = max_unplayed_strings
+        self.frets = frets
+        self.open_only = open_only
         self.fingerings = [] # Array of working chords
-        #Start recursive search from leftmost string, initialise with no strings played
-        frets_found = [-1] * len(instrument.notes)
-        self.find_note(list(frets_found), list(notes_yet_to_find), 0,0)
-
-
-    def find_note(self, frets_found, notes_yet_to_find, search_string, search_fret):
-        """ Recursive search for chord fingerings, uses integer arrays for now. TODO, integrate this code with ChordDiagram
-        frets_found = array with one element per string, playable notes with be added as fret numbers eg [0,0,0,3] is a uke C
-        TODO: Finger counting, unplayed strings, barre chords
-         """
-        def chord_stats(frets_found):
-            """calculate some details about the chord
-            Returns:
-            max_fret: Highest fret position
-            min_fret: Lowest non-zero played string fret position
-            fingers: Number of fingers needed to play
-            """
-            max_fret = 0
-            min_fret = 1
-            fingers = 0
-            played_notes = [x for x in frets_found if x > 0]
-            if played_notes != []:
-                max_fret = max(played_notes)
-                min_fret = min(played_notes)
-                fingers = len(played_notes)
-                # Allow for barre by assuming one finger can play the min_fret position
-                if frets_found.count(0) == 0:
-                    fingers = fingers - frets_found.count(min_fret) + 1
-            return (max_fret, min_fret, fingers)
-
-        # Terminate recursion when we've gone past the 11th fret, or run out of strings
-        if search_fret > 11 or search_string > len(self.instrument.notes) - 1:
-            return None
-
-        self.find_note(list(frets_found), list(notes_yet_to_find), search_string, search_fret + 1)
-        # Left-most strings may be left uplayed so if the one to the left is, and we have enough strings left then search
-        if  search_string < self.max_unplayed_strings and  (search_string  == 0 or frets_found[search_string - 1] == -1) and search_fret == 0 and len(frets_found) - search_string > len(notes_yet_to_find):
-            self.find_note(list(frets_found), list(notes_yet_to_find), search_string + 1, 0 )
-
-        current_note = Note(self.instrument.notes[search_string].name)
-
-        current_note.transpose(search_fret)
-        #print("string ", search_string, "fret", search_fret, "Is note", current_note.name, "so far", frets_found, "To find", [Note(x).name for x in notes_yet_to_find], "max", max_fret, "min", min_fret)
-
-        if current_note.num in self.chord.nums:
-            frets_found[search_string] = search_fret
-
-             #If chord not playable bail out
-            max_fret, min_fret, fingers = chord_stats(frets_found)
-            if fingers > self.max_fingers or max_fret - min_fret >= self.max_reach: # or (search_string == 0 and max_fret  > self.max_reach):
-                return
+        self.search()
+
+    def search(self):
+        """ Iterative search for chord fingerings, walks the strings from left to right.
+        Notes are held as pitch-class bitmasks, and the reach / finger counts are kept
+        up to date as each string is added so that dead-end shapes are dropped early.
+        Fingerings are integer arrays with one fret per string, -1 for unplayed eg [0,0,0,3] is a uke C
+        Results come out in the same order as the old recursive search (highest frets first).
+        """
+        num_strings = len(self.instrument.notes)
+        if num_strings == 0:
+            return
+
+        chord_mask = 0
+        extension_mask = 0
+        for i, num in enumerate(self.chord.nums):
+            chord_mask |= 1 << num
+            # Chord mods beyond the core four notes should only be played once
+            if i > 3:
+                extension_mask |= 1 << num
+
+        # For each string, the frets (high to low) that sound a note in the chord and the note they sound
+        candidates = []
+        for note in self.instrument.notes:
+            frets = []
+            for fret in range(Fingerings.max_fret, -1, -1):
+                bit = 1 << ((note.num + fret) % 12)
+                if bit & chord_mask and (self.frets == None or fret in self.frets):
+                    frets.append((fret, bit))
+            candidates.append(frets)
+
+        # Can any string after this one be played open?
+        open_later = [False] * num_strings
+        for string in range(num_strings - 2, -1, -1):
+            open_later[string] = open_later[string + 1] or (candidates[string + 1] != [] and candidates[string + 1][-1][0] == 0)
+
+        bit_count = Fingerings.bit_count
+        frets_found = [-1] * num_strings
+        # Stack entries: (string, options, to_find, max_fret, min_fret, played, at_min, open_strings)
+        # max_fret/min_fret are over fretted (non-zero) strings, at_min counts strings on min_fret
+        stack = [(0, self.options(0, chord_mask, candidates), chord_mask, 0, 0, 0, 0, 0)]
+        while stack:
+            string, options, to_find, max_fret, min_fret, played, at_min, open_strings = stack[-1]
+            option = next(options, None)
+            if option == None:
+                frets_found[string] = -1
+                stack.pop()
+                continue
+
+            fret, bit = option
+            next_string = string + 1
+            if fret == -1:
+                # Leave this string unplayed
+                frets_found[string] = -1
+                if next_string < num_strings:
+                    stack.append((next_string,
+                                  self.options(next_string, to_find, candidates, skip_ok=True),
+                                  to_find, max_fret, min_fret, played, at_min, open_strings))
+                continue
+
+            # Incremental chord stats
+            new_open = open_strings
+            new_max, new_min, new_played, new_at_min = max_fret, min_fret, played, at_min
+            if fret == 0:
+                new_open += 1
+            else:
+                new_played += 1
+                if played == 0 or fret < min_fret:
+                    new_min = fret
+                    new_at_min = 1
+                elif fret == min_fret:
+                    new_at_min += 1
+                if fret > max_fret:
+                    new_max = fret
+
+            # Allow for barre by assuming one finger can play the min_fret position
+            fingers_needed = new_played
+            if new_played and not new_open:
+                fingers_needed = new_played - new_at_min + 1
+            reach = new_max - new_min if new_played else -1
+
+            # If chord not playable bail out
+            if fingers_needed > self.max_fingers or reach >= self.max_reach:
+                continue
+
+            # No barre once there's an open string, so with no open string yet every fretted string needs a finger
+            if self.open_only and not new_open and (new_played > self.max_fingers or not open_later[string]):
+                continue
+
+            if bit & to_find:
+                new_to_find = to_find & ~bit
+            elif bit & extension_mask:
+                # This is a chord mod that's not core so don't put in more than one
+                continue
+            else:
+                new_to_find = to_find
+
+            frets_found[string] = fret
+            if next_string == num_strings:
+                if new_to_find == 0:
+                    self.fingerings.append(list(frets_found))
+                continue
+
+            # Not enough strings left to find the rest of the notes
+            if bit_count[new_to_find] > num_strings - next_string:
+                continue
+
+            stack.append((next_string,
+                          self.options(next_string, new_to_find, candidates),
+                          new_to_find, new_max, new_min, new_played, new_at_min, new_open))
+
+    def options(self, string, to_find, candidates, skip_ok = None):
+        """ Generate the ways of playing a string: fretted notes high to low, then unplayed, then open
+        Left-most strings may be left unplayed if all the strings to the left of them are, and there
+        are enough strings left to find the remaining notes
+        """
+        if skip_ok == None:
+            skip_ok = string == 0
+        for fret, bit in candidates[string]:
+            if fret == 0:
+                break
+            yield (fret, bit)
+        if skip_ok and string < self.max_unplayed_strings and len(candidates) - string > Fingerings.bit_count[to_find]:
+            yield (-1, 0)
+        if candidates[string] and candidates[string][-1][0] == 0:
+            yield candidates[string][-1]
+
+
+class BatchFingerings:
+    """ Find fingerings for a whole set of chords on one tuning in a single pass, using NumPy.
+    Gives the same fingerings, in the same order, as running Fingerings on each chord in turn
+    but the work of enumerating playable shapes is shared across all the chords (and roots).
+    NumPy is optional, creating one of these raises ImportError if it is not installed
+    """
 
-            if current_note.num in notes_yet_to_find: #Note index already found?
-                notes_yet_to_find.remove(current_note.num)
-                #print("Got a match:", self.chord.name, frets_found, [Note(x).name  for x in notes_yet_to_find], search_string == len(self.instrument.notes))
-            elif self.chord.nums.index(current_note.num) > 3:
-                    # This is a chord mod that's not core so don't put in more than one
-                    return
-            if len(notes_yet_to_find) == 0 and search_string == len(self.instrument.notes) - 1:
-                self.fingerings.append(frets_found)
+    def __init__(self, instrument, reach=4, fingers=4, max_unplayed_strings = 1):
+        import numpy
+        self.np = numpy
+        self.instrument = instrument
+        self.max_reach = reach
+        self.max_fingers = fingers
+        self.max_unplayed_strings = max_unplayed_strings
+        # Pitch-class of every (string, fret) position, -1 is the unplayed "fret" and sounds nothing
+        frets = numpy.arange(Fingerings.max_fret + 1)
+        self.pitch_classes = (numpy.array([note.num for note in instrument.notes]).reshape(-1, 1) + frets) % 12
+
+    def find(self, chords):
+        """ Work out the fingerings for a list of Chord objects, setting _fingering_array on each """
+        np = self.np
+        masks = []
+        for chord in chords:
+            chord.spell()
+            mask = 0
+            for num in chord.nums:
+                mask |= 1 << num
+            masks.append(mask)
+            chord._fingering_array = []
+
+        shapes = self.shapes(masks)
+        if len(shapes) == 0:
+            return chords
+        num_strings = shapes.shape[1]
+        sounding = shapes >= 0
+        pitch_classes = np.where(sounding, self.pitch_classes[np.arange(num_strings), np.maximum(shapes, 0)], -1)
+        shape_masks = np.bitwise_or.reduce(np.where(sounding, 1 << np.maximum(pitch_classes, 0), 0), axis=1)
+        unplayed = (~sounding).sum(axis=1)
+
+        # Same order as the depth-first search: frets high to low, then unplayed, then open
+        rank = np.where(shapes > 0, Fingerings.max_fret - shapes, np.where(shapes == -1, Fingerings.max_fret, Fingerings.max_fret + 1))
+        order = np.lexsort([rank[:, string] for string in reversed(range(num_strings))])
+        shapes, pitch_classes, shape_masks, unplayed = shapes[order], pitch_classes[order], shape_masks[order], unplayed[order]
+
+        for chord, mask in zip(chords, masks):
+            # Left-most strings may only be left unplayed while there are enough strings for the notes
+            found = (shape_masks == mask) & (unplayed <= num_strings - len(chord.nums))
+            # Chord mods beyond the core four notes are only played once
+            for num in chord.nums[4:]:
+                found &= (pitch_classes == num).sum(axis=1) <= 1
+            chord._fingering_array = shapes[found].tolist()
+        return chords
+
+    def shapes(self, masks):
+        """ Enumerate playable fret arrays a string at a time, keeping only those within reach and
+        finger limits that could still turn into one of the chords in masks
+        """
+        np = self.np
+        num_strings = self.pitch_classes.shape[0]
+        if num_strings == 0:
+            return np.zeros((0, 0), dtype=np.int8)
+
+        # For every set of notes, the fewest extra notes needed to make one of the chords (or too many)
+        all_masks = np.arange(1 << 12)
+        needed = np.full(1 << 12, num_strings + 1)
+        for mask in set(masks):
+            subset = (all_masks & ~mask) == 0
+            missing = np.array(Fingerings.bit_count)[mask & ~all_masks]
+            needed = np.where(subset, np.minimum(needed, missing), needed)
+
+        shapes = np.zeros((1, 0), dtype=np.int8)
+        shape_masks = np.zeros(1, dtype=np.int64)
+        frets = np.arange(-1, Fingerings.max_fret + 1, dtype=np.int8)
+        for string in range(num_strings):
+            options = frets if string < self.max_unplayed_strings else frets[1:]
+            count = len(shapes)
+            new_frets = np.tile(options, count)
+            shapes = np.hstack([np.repeat(shapes, len(options), axis=0), new_frets.reshape(-1, 1)])
+            shape_masks = np.repeat(shape_masks, len(options))
+            shape_masks = shape_masks | np.where(new_frets >= 0, 1 << self.pitch_classes[string, np.maximum(new_frets, 0)], 0)
+
+            # Only left-most strings can be unplayed
+            keep = (new_frets >= 0) | (shapes == -1).all(axis=1)
+
+            fretted = shapes > 0
+            played = fretted.sum(axis=1)
+            max_fret = np.where(fretted, shapes, 0).max(axis=1)
+            min_fret = np.where(fretted, shapes, Fingerings.max_fret + 1).min(axis=1)
+            at_min = (shapes == min_fret.reshape(-1, 1)).sum(axis=1)
+            # Allow for barre by assuming one finger can play the min_fret position
+            fingers = np.where((played > 0) & ~(shapes == 0).any(axis=1), played - at_min + 1, played)
+            reach = np.where(played > 0, max_fret - min_fret, -1)
+            keep &= (fingers <= self.max_fingers) & (reach < self.max_reach)
+            keep &= needed[shape_masks] <= num_strings - string - 1
+
+            shapes = shapes[keep]
+            shape_masks = shape_masks[keep]
+        return shapes
+
+
+class ShapeLibrary:
+    """ Moveable chord shapes, shared between all 12 roots of a chord type and between tunings
+    with the same intervals between the strings (eg GCEA and DGBE).
+
+    A fingering with no open strings can be slid up or down the neck to play the same type of
+    chord with a different root, so these are only searched for once, close to the nut, and stored
+    as relative shapes. Fingerings using open strings only exist in some keys and are searched for
+    key by key. Shapes are keyed by (tuning interval signature, chord quality, reach, fingers, unplayed)
+    """
 
+    def __init__(self):
+        self.shapes = {}
+
+    def signature(self, instrument):
+        """ Intervals from the first string to each of the others, in semitones """
+        if instrument.notes == []:
+            return ()
+        return tuple((note.num - instrument.notes[0].num) % 12 for note in instrument.notes)
+
+    def get_shapes(self, instrument, quality, reach=4, fingers=4, unplayed=0):
+        """ Look up (or work out) the shapes for a chord quality eg "m7" on an instrument's tuning
+        Returns a dictionary with:
+        closed: list of (root, frets) pairs with the lowest fretted note on the first fret
+        open: a list of fingerings for each root
+        Roots are counted in semitones from the first string.
+        """
+        key = (self.signature(instrument), quality, reach, fingers, unplayed)
+        if key not in self.shapes:
+            closed = []
+            open_voicings = []
+            first_string = instrument.notes[0].num if instrument.notes != [] else 0
+            for root in range(0, 12):
+                chord = Chord(Note((root + first_string) % 12).name + quality)
+                chord.spell()
+                # Everything fretted within reach of the nut, the rest of the neck is just these shapes moved up
+                fretted = Fingerings(chord, instrument, reach, fingers, unplayed, frets=range(1, reach + 1)).fingerings
+                closed += [(root, frets) for frets in fretted if min(fret for fret in frets if fret > 0) == 1]
+                open_voicings.append(Fingerings(chord, instrument, reach, fingers, unplayed, open_only=True).fingerings)
+            self.shapes[key] = {"closed": closed, "open": open_voicings}
+        return self.shapes[key]
+
+    def find_fingerings(self, chord, instrument, reach=4, fingers=4, unplayed=0):
+        """ Work out ways of playing a chord from the stored shapes, same results as Fingerings """
+        chord.spell()
+        shapes = self.get_shapes(instrument, chord.flavour, reach, fingers, unplayed)
+        root = (chord.root.num - instrument.notes[0].num) % 12 if instrument.notes != [] else 0
+        fingerings = list(shapes["open"][root])
+        for shape_root, frets in shapes["closed"]:
+            shift = (root - shape_root) % 12
+            if max(frets) + shift <= Fingerings.max_fret:
+                fingerings.append([fret + shift if fret > 0 else fret for fret in frets])
+
+        # Same order as the Fingerings search: frets high to low, then unplayed, then open
+        def rank(fret):
+            if fret > 0:
+                return Fingerings.max_fret - fret
+            return Fingerings.max_fret if fret == -1 else Fingerings.max_fret + 1
+        fingerings.sort(key=lambda frets: [rank(fret) for fret in frets])
+        return fingerings
+
+
+# Shapes found so far in this process, for find_fingerings_job
+shape_library = ShapeLibrary()
+
+
+class CompiledChart:
+    """ A chord chart (.cho) file compiled to a compact binary form, so loading it is one read and
+    no regular expressions. The .cho file is always the source of truth: compiled files live in the
+    cache directory (see FingeringStore) and get rebuilt whenever the source's modification time or size changes.
+
+    File format: a header with the magic bytes CPBC, format version, source mtime (ns), source size and
+    the number of chord names, then the name index: for each normalised chord name its length, the name (UTF-8),
+    the number of definitions and the offset of each definition record. Then the definition records: base fret,
+    number of strings, flags (1: parsed, 2: has fingers), number of additional dots, then one signed byte
+    per string for frets (-1 for unplayed), the same for fingers if present, then (string, fret, finger) per
+    additional dot.
+    """
+    magic = b"CPBC"
+    # Bump this if the format, parsing or name normalisation changes so old compiled files get rebuilt
+    version = 1
+    header = struct.Struct("<4sHqQH")
+    record = struct.Struct("<HBBB")
+    parsed = 1
+    has_fingers = 2
+
+    def __init__(self, source, directory = None):
+        self.source = os.path.realpath(source)
+        self.namespace = cache.Namespace("charts", directory)
+        base_name = os.path.splitext(os.path.basename(self.source))[0]
+        self.file_name = "%s_%08x.chart" % (base_name, zlib.crc32(self.source.encode("utf-8")))
+        self.path = self.namespace.path(self.file_name)
+        self.data = b""
+        # Normalised (untransposed) chord name -> list of record offsets, in file order
+        self.index = {}
+
+    def load(source, directory = None):
+        """ Get the compiled version of a chart file, compiling (and saving) it first if it's missing or stale """
+        chart = CompiledChart(source, directory)
+        if not chart.read():
+            chart.compile()
+            try:
+                chart.save()
+            except OSError:
+                pass
+        return chart
+
+    def source_stamp(self):
+        stat = os.stat(self.source)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read(self):
+        """ Read the compiled file, returns False if there isn't an up-to-date one """
+        data = self.namespace.get(self.file_name)
+        if data == None or len(data) < CompiledChart.header.size:
+            return False
+        magic, version, mtime, size, num_names = CompiledChart.header.unpack_from(data, 0)
+        if magic != CompiledChart.magic or version != CompiledChart.version or (mtime, size) != self.source_stamp():
+            return False
+        pos = CompiledChart.header.size
+        for i in range(num_names):
+            name_length = data[pos]
+            name = data[pos + 1: pos + 1 + name_length].decode("utf-8")
+            pos += 1 + name_length
+            count, = struct.unpack_from("<H", data, pos)
+            pos += 2
+            self.index[name] = list(struct.unpack_from("<%sI" % count, data, pos))
+            pos += 4 * count
+        self.data = data
+        return True
+
+    def compile(self):
+        """ Parse the source .cho file into records and a name index """
+        stamp = self.source_stamp()
+        chart = ChordChart()
+        names = []
+        records = []
+        with open(self.source) as f:
+            for line in f:
+                if line.startswith("{define:"):
+                    unpacked = ChordDiagram.unpack_definition(line)
+                    names.append(chart.normalise_chord_name(unpacked[0] if unpacked != None else ""))
+                    records.append(CompiledChart.pack_definition(unpacked))
+        index = {}
+        for name, record in zip(names, records):
+            index.setdefault(name, []).append(record)
+
+        # Work out where each record will go, after the header and name index
+        pos = CompiledChart.header.size
+        for name in index:
+            pos += 1 + len(name.encode("utf-8")) + 2 + 4 * len(index[name])
+        data = bytearray(CompiledChart.header.pack(CompiledChart.magic, CompiledChart.version, stamp[0], stamp[1], len(index)))
+        body = bytearray()
+        for name in index:
+            encoded_name = name.encode("utf-8")
+            data += struct.pack("<B", len(encoded_name)) + encoded_name
+            data += struct.pack("<H", len(index[name]))
+            offsets = []
+            for record in index[name]:
+                offsets.append(pos + len(body))
+                body += record
+            data += struct.pack("<%sI" % len(offsets), *offsets)
+            self.index[name] = offsets
+        self.data = bytes(data + body)
+
+    def pack_definition(unpacked):
+        """ Binary record for the result of ChordDiagram.unpack_definition """
+        if unpacked == None:
+            return CompiledChart.record.pack(0, 0, 0, 0)
+        name, base_fret, frets, fingers, additional_dots = unpacked
+        flags = CompiledChart.parsed
+        if fingers != None:
+            # Fingers are kept as the strings they were in the definition, only pack ones that come back the same
+            if len(fingers) != len(frets) or any(str(int(finger)) != finger for finger in fingers):
+                raise ValueError("Can't compile fingers in definition for %s" % name)
+            flags |= CompiledChart.has_fingers
+        record = bytearray(CompiledChart.record.pack(base_fret, len(frets), flags, len(additional_dots)))
+        record += array.array("b", [-1 if fret == None else fret for fret in frets]).tobytes()
+        if fingers != None:
+            record += array.array("b", [int(finger) for finger in fingers]).tobytes()
+        for dot in additional_dots:
+            record += struct.pack("<BBB", *dot)
+        return bytes(record)
+
+    def definition(self, offset):
+        """ Unpacked definition (see ChordDiagram.unpack_definition, without the name) for a record, or None """
+        base_fret, num_strings, flags, num_dots = CompiledChart.record.unpack_from(self.data, offset)
+        if not flags & CompiledChart.parsed:
+            return None
+        pos = offset + CompiledChart.record.size
+        frets = [None if fret == -1 else fret for fret in array.array("b", self.data[pos: pos + num_strings])]
+        pos += num_strings
+        fingers = None
+        if flags & CompiledChart.has_fingers:
+            fingers = [str(finger) for finger in array.array("b", self.data[pos: pos + num_strings])]
+            pos += num_strings
+        additional_dots = [struct.unpack_from("<BBB", self.data, pos + 3 * i) for i in range(num_dots)]
+        return (base_fret, frets, fingers, additional_dots)
+
+    def save(self):
+        """ Write the compiled chart (atomically, see cache.Namespace.put) """
+        self.namespace.put(self.file_name, self.data)
+
+
+class FingeringStore:
+    """ Fingerings found by Chord.find_fingerings, saved to disk so they only ever need to be worked out once.
+    There is one file per (tuning, reach, fingers, unplayed, engine version) in the fingerings namespace
+    of the cache (see chordprobook.cache), which can be moved with the CHORDPROBOOK_CACHE environment variable.
+
+    File format: the magic bytes CPBF, then a header with the format version and the number of strings,
+    then for each chord: the length of its name, the name (UTF-8), the number of fingerings, and then
+    one signed byte per string for each fingering (-1 for unplayed).
+    """
+    magic = b"CPBF"
+    # Bump this when changes to Fingerings would find different fingerings, so old files get ignored
+    engine_version = 1
+    header = struct.Struct("<4sHB")
+    # Defaults used for filling in chords that chord charts don't have
+    default_reach = 4
+    default_fingers = 4
+    default_unplayed = 4
+    # Stores already read in this process, by path
+    loaded = {}
+    # Stores with fingerings added since they were last saved, by path, see save_all
+    unsaved = {}
+    lock = threading.Lock()
+
+    def __init__(self, tuning, reach = default_reach, fingers = default_fingers, unplayed = default_unplayed, directory = None):
+        self.tuning = tuning
+        self.reach = reach
+        self.fingers = fingers
+        self.unplayed = unplayed
+        self.namespace = cache.Namespace("fingerings", directory)
+        self.directory = self.namespace.directory
+        self.file_name = "%s_r%s_f%s_u%s_v%s.fingerings" % (re.sub("[^A-Za-z0-9#]", "_", tuning), reach, fingers, unplayed, FingeringStore.engine_version)
+        self.path = self.namespace.path(self.file_name)
+        if self.path not in FingeringStore.loaded:
+            FingeringStore.loaded[self.path] = self.read()
+        self.fingerings = FingeringStore.loaded[self.path]
+
+    def read(self):
+        """ Load fingerings from disk, returns a dict of chord name -> list of fingerings """
+        fingerings = {}
+        data = self.namespace.get(self.file_name)
+        if data == None or len(data) < FingeringStore.header.size:
+            return fingerings
+        magic, version, num_strings = FingeringStore.header.unpack_from(data, 0)
+        if magic != FingeringStore.magic or version != FingeringStore.engine_version:
+            return fingerings
+        pos = FingeringStore.header.size
+        while pos < len(data):
+            name_length = data[pos]
+            name = data[pos + 1: pos + 1 + name_length].decode("utf-8")
+            pos += 1 + name_length
+            count, = struct.unpack_from("<H", data, pos)
+            pos += 2
+            frets = array.array("b", data[pos: pos + count * num_strings]).tolist()
+            pos += count * num_strings
+            fingerings[name] = [frets[i * num_strings: (i + 1) * num_strings] for i in range(count)]
+        return fingerings
+
+    def save(self):
+        """ Write all the fingerings out in one go (to a temp file first, so readers never see half a file),
+        along with any that other processes have saved since this one read the file """
+        on_disk = self.read()
+        with FingeringStore.lock:
+            for name, found in on_disk.items():
+                self.fingerings.setdefault(name, found)
+            fingerings = dict(self.fingerings)
+            FingeringStore.unsaved.pop(self.path, None)
+        num_strings = 0
+        for found in fingerings.values():
+            if found != []:
+                num_strings = len(found[0])
+                break
+        data = bytearray(FingeringStore.header.pack(FingeringStore.magic, FingeringStore.engine_version, num_strings))
+        for name in sorted(fingerings):
+            encoded_name = name.encode("utf-8")
+            data += struct.pack("<B", len(encoded_name)) + encoded_name
+            data += struct.pack("<H", len(fingerings[name]))
+            for frets in fingerings[name]:
+                data += array.array("b", frets).tobytes()
+        self.namespace.put(self.file_name, bytes(data))
+
+    def save_all():
+        """ Save every store that has had fingerings added, called once at the end of each build """
+        with FingeringStore.lock:
+            stores = list(FingeringStore.unsaved.values())
+        for store in stores:
+            store.save()
+
+    def __contains__(self, chord_name):
+        return chord_name in self.fingerings
+
+    def add(self, chord):
+        """ Remember the fingerings found for a chord (save() or save_all() writes them out) """
+        with FingeringStore.lock:
+            self.fingerings[chord.name] = chord._fingering_array
+            FingeringStore.unsaved[self.path] = self
+
+    def get(self, instrument, chord_name, save = False):
+        """ Fingerings for a chord by name, working them out if they're not stored yet (they're saved
+        by save_all() at the end of the build, or straight away with save)
+        Chords of a type we can't spell get an empty list.
+        """
+        chord_name = ChordChart().normalise_chord_name(chord_name)
+        if chord_name not in self.fingerings:
+            chord = Chord(chord_name)
+            if re.match("[A-G](#|b)?", chord_name) and chord.spell() != None and instrument.notes != []:
+                chord.find_fingerings(instrument, self.reach, self.fingers, self.unplayed)
+            else:
+                chord._fingering_array = []
+            self.add(chord)
+            if save:
+                self.save()
+        return self.fingerings[chord_name]
+
+
+class DiagramStore:
+    """ Drawn chord diagrams (PNGs) saved to disk, in the diagrams namespace of the cache, so each one is
+    only ever drawn once rather than once per run. Entries are named by a hash of ChordDiagram.drawing_key.
+    prewarm() fills it with every instrument's chords """
+    # Bump this when changes to ChordDiagram.draw would draw different pictures
+    version = 1
+    hits = 0
+    misses = 0
+
+    def __init__(self, directory = None):
+        self.namespace = cache.Namespace("diagrams", directory)
+        self.directory = self.namespace.directory
+
+    def key(self, drawing_key):
+        import hashlib
+        return hashlib.sha256(repr((DiagramStore.version, drawing_key)).encode("utf-8")).hexdigest()
+
+    def __contains__(self, drawing_key):
+        return os.path.exists(self.namespace.path(self.key(drawing_key), ".png"))
+
+    def get(self, drawing_key):
+        """ The PNG for a diagram, or None if it hasn't been drawn yet """
+        png = self.namespace.get(self.key(drawing_key), ".png")
+        if png == None:
+            DiagramStore.misses += 1
+        else:
+            DiagramStore.hits += 1
+        return png
+
+    def put(self, drawing_key, png):
+        try:
+            self.namespace.put(self.key(drawing_key), png, ".png")
+        except OSError:
+            # Can't save it, so it gets drawn again next time
+            pass
+
+
+def find_fingerings_job(job):
+    """ Work out fingerings for a list of chords on a tuning, with BatchFingerings if NumPy is installed,
+    otherwise from the shapes in shape_library (so each chord type is only searched for once per tuning
+    interval signature, whatever its root)
+    job: (tuning, chord_names, reach, fingers, unplayed)
+    Returns a list of (chord_name, fingerings). Runs in a worker process for ChartGenerator.
+    """
+    tuning, chord_names, reach, fingers, unplayed = job
+    instrument = chordprobook.instruments.Instrument(data={"name": tuning, "tuning": tuning})
+    chords = [Chord(chord_name) for chord_name in chord_names]
+    try:
+        BatchFingerings(instrument, reach, fingers, unplayed).find(chords)
+    except ImportError:
+        for chord in chords:
+            chord.find_fingerings(instrument, reach, fingers, unplayed, library=shape_library)
+    return [(chord.name, chord._fingering_array) for chord in chords]
+
+
+class ChartGenerator:
+    """ Generate chord charts for one or more tunings, sharing the work out over a pool of processes.
+    Each job is a whole tuning (or, with more processes than tunings, a group of its roots), so the
+    batch search in find_fingerings_job shares its work across as many roots as it can.
+    Chords already in the FingeringStore for a tuning are not worked out again, and new ones are added to it.
+    """
+    default_variants = ["", "7", "m", "m7", "maj7", "6", "sus4", "9", "add9", "dim"]
 
-            self.find_note(list(frets_found), list(notes_yet_to_find), search_string + 1, 0)
+    def __init__(self, reach=4, fingers=4, unplayed=4, variants=None, processes=None):
+        """
+        variants: Chord types to generate for each root, eg ["", "m", "7"]
+        processes: Number of worker processes, defaults to the number of CPUs, 1 means don't use a pool
+        """
+        self.reach = reach
+        self.fingers = fingers
+        self.unplayed = unplayed
+        self.variants = variants if variants != None else ChartGenerator.default_variants
+        self.processes = processes
+
+    def chord_names(self, root):
+        return [transposer().get_note(root) + variant for variant in self.variants]
+
+    def root_groups(self, tunings):
+        """ The 12 roots split into as few groups as keep every process busy, eg [range(0, 12)] for
+        a tuning per process, [range(0, 6), range(6, 12)] for one tuning and two processes """
+        processes = 1 if self.processes == 1 else (self.processes or os.cpu_count() or 1)
+        groups = max(1, min(12, processes // max(1, len(tunings))))
+        return [range(12 * group // groups, 12 * (group + 1) // groups) for group in range(groups)]
+
+    @profiling.profiled("ChartGenerator.find_fingerings", describe = lambda generator, tunings: {"tunings": tunings})
+    def find_fingerings(self, tunings):
+        """ Returns a dictionary of tuning -> {chord name -> fingerings} for all roots and variants """
+        stores = {}
+        jobs = []
+        for tuning in tunings:
+            stores[tuning] = FingeringStore(tuning, self.reach, self.fingers, self.unplayed)
+            for roots in self.root_groups(tunings):
+                names = [name for root in roots for name in self.chord_names(root)
+                         if ChordChart().normalise_chord_name(name) not in stores[tuning]]
+                if names != []:
+                    jobs.append((tuning, names, self.reach, self.fingers, self.unplayed))
+
+        if self.processes == 1 or len(jobs) < 2:
+            results = map(find_fingerings_job, jobs)
+        else:
+            import concurrent.futures
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+            results = list(pool.map(find_fingerings_job, jobs))
+            pool.shutdown()
+
+        # Results come back in the same order as the jobs went out, so this is always the same
+        for job, found in zip(jobs, results):
+            store = stores[job[0]]
+            for chord_name, fingerings in found:
+                store.fingerings[chord_name] = fingerings
+        for tuning in tunings:
+            stores[tuning].save()
+
+        fingerings = {}
+        for tuning in tunings:
+            fingerings[tuning] = {}
+            for root in range(0, 12):
+                for name in self.chord_names(root):
+                    name = ChordChart().normalise_chord_name(name)
+                    fingerings[tuning][name] = stores[tuning].fingerings[name]
+        return fingerings
+
+    def add_to_chart(self, chart, fingerings):
+        """ Add a tuning's fingerings (from find_fingerings) to a ChordChart, in root/variant order """
+        for chord_name, found in fingerings.items():
+            chord = Chord(chord_name, lefty=chart.lefty)
+            chord._fingering_array = found
+            chord.add_to_chordchart(chart)
+
+    def charts(self, tunings):
+        """ Returns a dictionary of tuning -> ChordChart """
+        charts = {}
+        for tuning, fingerings in self.find_fingerings(tunings).items():
+            charts[tuning] = ChordChart()
+            self.add_to_chart(charts[tuning], fingerings)
+        return charts
+
+
+def prewarm_job(job):
+    """ Draw the default voicing of every chord in an instrument's chart, with and without its name,
+    into the DiagramStore. job: (instrument name, lefty)
+    Named diagrams show the name as the song wrote it (see ChordChart.grid_as_md), so only the chart's
+    own spellings (eg Bb, Cmaj7) are drawn here: songs that write A# or CM7 still draw those the first time.
+    Returns (instrument name, lefty, diagrams drawn, diagrams already stored). Runs in a worker process for prewarm.
+    """
+    name, lefty = job
+    instrument = chordprobook.instruments.Instruments().get_instrument_by_name(name)
+    instrument.load_chord_chart(lefty=lefty)
+    chart = instrument.chart
+    chart.load_all()
+    store = DiagramStore()
+    drawn = 0
+    stored = 0
+    for chord_name in sorted(chart.grids):
+        diagram = chart.grids[chord_name].voicings[0]
+        for display_name in (False, chord_name):
+            if diagram.drawing_key(display_name) in store:
+                stored += 1
+            else:
+                diagram.to_data_URI(display_name)
+                drawn += 1
+    return (name, lefty, drawn, stored)
+
+
+@profiling.profiled("prewarm")
+def prewarm(processes = None):
+    """ mksong --prewarm: fill the DiagramStore with every instrument's chord diagrams, right and left-handed,
+    sharing the instruments out over a pool of processes
+    processes: Number of worker processes, defaults to the number of CPUs, 1 means don't use a pool
+    Returns a list of (instrument name, lefty, diagrams drawn, diagrams already stored) """
+    jobs = [(instrument.name, lefty)
+            for instrument in chordprobook.instruments.Instruments().instruments
+            for lefty in (False, True)]
+    if processes == 1:
+        return list(map(prewarm_job, jobs))
+    import concurrent.futures
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    results = list(pool.map(prewarm_job, jobs))
+    pool.shutdown()
+    return results
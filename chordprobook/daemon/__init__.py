@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+"""
+Render daemon: a long-running mksong (mksong --daemon) that keeps instruments.yaml, parsed songs,
+chord chart indexes and rendered chord diagrams in memory between builds.
+
+Requests are JSON over HTTP (with Content-Type: application/json), on a localhost port or a Unix socket:
+
+POST /render  a build: any mksong long option name (underscores for dashes) as a key, plus
+              formats:  list of pdf, html, docx, odt, epub (defaults to pdf)
+              files:    list of song file paths
+              transpose: semitones to transpose the files by (book files have their own {transpose: })
+              cwd:      directory relative paths are relative to (defaults to the daemon's)
+              cwd and every output have to be in the daemon's directory (its root), or the request gets a 400
+              include_bytes: true to get the contents of the files back (base64) as well as their paths
+              eg {"book_file": "book.txt", "instrument": "Soprano Ukulele", "formats": ["pdf", "html"]}
+              Returns {"outputs": [paths], "seconds": build time} (and "bytes": {path: base64})
+GET /stats    requests, cache hit rates and build latency percentiles
+
+Each build gets its own Instruments (they hold the chart being drawn from, so builds can't share them)
+but they're made from the cached instruments.yaml, and charts come from the shared ChordChart indexes.
+"""
+import json
+import os
+import threading
+import time
+import chordprobook.books as books
+import chordprobook.build as build
+import chordprobook.chords as chords
+import chordprobook.instruments as inst
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a sorted list """
+    if values == []:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def hit_rate(hits, misses):
+    return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else None}
+
+
+class RequestError(Exception):
+    """ Something wrong with a request (rather than with the build) """
+    pass
+
+
+class Busy(Exception):
+    """ No build slot came free in time """
+    pass
+
+
+class RenderDaemon:
+    """ Runs builds with warm caches, see the module docstring for the protocol """
+    def __init__(self, port = 8765, socket_path = None, max_concurrent = 2, wait = 60, data_dir = None, latencies_kept = 1000, root = None):
+        """ port: localhost port to listen on, unless there's a socket_path
+        max_concurrent: builds to run at once
+        wait: seconds a request waits for a build slot before it gets a 503
+        data_dir: where mksong's reference.docx and reference.odt are
+        root: the only directory requests can build in (and write to), defaults to the current directory """
+        self.root = os.path.realpath(root or os.getcwd())
+        self.port = port
+        self.socket_path = socket_path
+        self.max_concurrent = max_concurrent
+        self.wait = wait
+        self.data_dir = data_dir
+        self.latencies_kept = latencies_kept
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.song_cache = books.SongCache()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.latencies = []
+        self.server = None
+        self.warm_up()
+
+    def warm_up(self):
+        """ Read instruments.yaml and index every instrument's chord chart, so the first build doesn't have to """
+        for instrument in inst.Instruments().instruments:
+            for lefty in (False, True):
+                instrument.load_chord_chart(lefty=lefty)
+
+    def args_for(self, request):
+        """ mksong options for a request, raises RequestError if it asks for something we don't know about """
+        request = dict(request)
+        for name in ['cwd', 'include_bytes']:
+            request.pop(name, None)
+        transpose = request.pop('transpose', 0)
+        if not isinstance(transpose, int) or isinstance(transpose, bool):
+            raise RequestError("transpose should be a whole number of semitones, not %s" % json.dumps(transpose))
+        formats = request.pop('formats', [])
+        unknown = [name for name in formats if name not in build.formats]
+        unknown += [name for name in request if name in build.request_options]
+        try:
+            args = build.default_args(**dict((name, value) for (name, value) in request.items() if name not in build.request_options))
+        except ValueError as e:
+            raise RequestError(str(e))
+        if unknown:
+            raise RequestError("Can't do %s in a request" % ", ".join(unknown))
+        for name in formats:
+            args[name] = True
+        args['transpose'] = transpose
+        return build.prepare(args, self.data_dir)
+
+    def inside_root(self, path):
+        path = os.path.realpath(path)
+        return path == self.root or path.startswith(os.path.join(self.root, ""))
+
+    def check_outputs(self, args, book, output_file):
+        """ Raises RequestError if any of the build's outputs would go outside the root """
+        if args['one_doc']:
+            # Single sheets go next to their songs
+            directories = [os.path.join(os.path.dirname(song.path), args['directory']) for song in book.songs if song.path != None]
+        else:
+            directories = [os.path.dirname(output_file) or "."]
+        for directory in directories:
+            if not self.inside_root(os.path.join(self.root, directory)):
+                raise RequestError("Can't write to %s, it's outside %s" % (directory, self.root))
+
+    def render(self, request):
+        """ Run a build for a request (a dict), returns the response as a dict """
+        args = self.args_for(request)
+        cwd = os.path.join(self.root, request.get('cwd') or ".")
+        if not self.inside_root(cwd):
+            raise RequestError("cwd %s is outside %s" % (request['cwd'], self.root))
+        if not self.slots.acquire(timeout=self.wait):
+            with self.lock:
+                self.rejected += 1
+            raise Busy("All %s build slots busy" % self.max_concurrent)
+        with self.lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        ok = False
+        try:
+            book, output_file = build.load_book(args, inst.Instruments(), self.song_cache, cwd)
+            self.check_outputs(args, book, output_file)
+            outputs = build.save_book(book, args, output_file, cwd = cwd)
+            ok = True
+        finally:
+            seconds = time.perf_counter() - start
+            self.slots.release()
+            with self.lock:
+                self.in_flight -= 1
+                self.requests += 1
+                if ok:
+                    self.latencies = (self.latencies + [seconds])[-self.latencies_kept:]
+                else:
+                    self.errors += 1
+        response = {"outputs": outputs, "seconds": seconds}
+        if request.get('include_bytes'):
+            import base64
+            response["bytes"] = {}
+            for path in outputs:
+                with open(path, "rb") as f:
+                    response["bytes"][path] = base64.b64encode(f.read()).decode()
+        return response
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {"uptime_seconds": time.time() - self.started,
+                     "requests": self.requests,
+                     "errors": self.errors,
+                     "rejected": self.rejected,
+                     "in_flight": self.in_flight,
+                     "max_concurrent": self.max_concurrent}
+        stats["latency_seconds"] = {"count": len(latencies),
+                                    "p50": percentile(latencies, 0.5),
+                                    "p90": percentile(latencies, 0.9),
+                                    "p99": percentile(latencies, 0.99),
+                                    "max": latencies[-1] if latencies else None}
+        songs = hit_rate(self.song_cache.hits, self.song_cache.misses)
+        songs["size"] = len(self.song_cache.songs)
+        diagrams = hit_rate(chords.ChordDiagram.data_URI_hits, chords.ChordDiagram.data_URI_misses)
+        diagrams["size"] = len(chords.ChordDiagram.data_URIs)
+        charts = hit_rate(chords.ChordChart.index_hits, chords.ChordChart.index_misses)
+        charts["size"] = len(chords.ChordChart.indexes)
+        fragments = books.FragmentCache.shared()
+        html = hit_rate(fragments.hits, fragments.misses)
+        html["size"] = len(fragments.fragments)
+        stats["caches"] = {"songs": songs, "diagrams": diagrams, "chord_charts": charts, "html_fragments": html}
+        return stats
+
+    def make_server(self):
+        """ The HTTP server, listening but not yet serving """
+        import http.server
+        import socketserver
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self.reply(200, daemon.stats())
+                else:
+                    self.reply(404, {"error": "Not found, try POST /render or GET /stats"})
+
+            def do_POST(self):
+                if self.path != "/render":
+                    self.reply(404, {"error": "Not found, try POST /render or GET /stats"})
+                    return
+                # Browsers can send other pages' forms here, but not as JSON without asking first
+                content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                if content_type != "application/json":
+                    self.reply(415, {"error": "Requests should be Content-Type: application/json"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length).decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise RequestError("Request should be a JSON object")
+                    self.reply(200, daemon.render(request))
+                except (ValueError, RequestError) as e:
+                    self.reply(400, {"error": str(e)})
+                except Busy as e:
+                    self.reply(503, {"error": str(e)})
+                except Exception as e:
+                    self.reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+
+            def address_string(self):
+                # Unix socket clients don't have an address
+                return self.client_address[0] if self.client_address else daemon.socket_path
+
+        if self.socket_path != None:
+            class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = Server(self.socket_path, Handler)
+        else:
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+            self.server.daemon_threads = True
+            self.port = self.server.server_address[1]
+        return self.server
+
+    def serve(self):
+        """ Serve until interrupted """
+        self.make_server()
+        print("Render daemon listening on %s" % (self.socket_path or "http://127.0.0.1:%s" % self.port))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            if self.socket_path != None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
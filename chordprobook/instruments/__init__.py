@@ -1,24 +1,27 @@
 import os
 import re
 
-import yaml
-
 import chordprobook.chords
+import chordprobook.profiling as profiling
 
 class Instruments:
     """Class to represent the set of instruments we know about, 
     Assumes the instruments are in a file instruments.yaml in the same directory
     as this one.
     TODO add an option to add more"""
+    # instruments.yaml, read the first time it's needed
+    data = None
     
     def __init__(self):
-        path, file = os.path.split(os.path.realpath(__file__))
-        f = open(os.path.join(path,"instruments.yaml"))
-        instrument_data = yaml.load(f)
+        if Instruments.data == None:
+            path, file = os.path.split(os.path.realpath(__file__))
+            import yaml
+            with open(os.path.join(path,"instruments.yaml")) as f:
+                Instruments.data = yaml.load(f)
         self.tuning_lookup = {}
         self.name_lookup = {}
         self.instruments = []
-        for i in instrument_data:
+        for i in Instruments.data:
             inst = Instrument(i)
             self.add_instrument(inst)
         
@@ -103,7 +106,15 @@ class Instrument:
              self.transpose = 0
         self.chart = chordprobook.chords.ChordChart()
         self.error = None
-        
+        self.store = None
+
+    def fingering_store(self):
+        """ Stored fingerings for this instrument's tuning, used for chords its chart doesn't have """
+        if self.store == None:
+            self.store = chordprobook.chords.FingeringStore(self.tuning)
+        return self.store
+
+    @profiling.profiled("Instrument.load_chord_chart", describe = lambda instrument, *args, **kwargs: {"instrument": instrument.name})
     def load_chord_chart(self, lefty=False):
         defs_file = self.chord_definitions
         if lefty:
@@ -111,5 +122,7 @@ class Instrument:
         if defs_file != None:
             path, file = os.path.split(os.path.realpath(__file__))
             defs_file = os.path.join(path, "..", "chords", defs_file)           
-            self.chart = chordprobook.chords.ChordChart(self.transpose, defs_file, lefty=self.lefty)
+            self.chart = chordprobook.chords.ChordChart(self.transpose, defs_file, lefty=self.lefty, instrument=self, lazy=True)
+        else:
+            self.chart.instrument = self
            
@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+"""
+Putting books together from separately rendered PDFs (mksong --assemble and --shards),
+and splitting up PDFs rendered together (mksong --batch-pdf).
+
+Each song, set and the front matter is rendered to its own PDF, kept in a PartCache keyed by
+its HTML and the wkhtmltopdf options, so after a change only the parts that changed are rendered
+again. merge() then joins the parts with pypdf, putting back what wkhtmltopdf did for the whole book:
+the page headers (title on the left, [page]/[toPage] on the right) and the outline.
+
+Needs pypdf (pip install pypdf).
+"""
+import hashlib
+import html
+import os
+import re
+import tempfile
+import threading
+import chordprobook.cache as cache
+import chordprobook.renderers as renderers
+
+mm = 72 / 25.4
+# Where wkhtmltopdf puts headers with mksong's options (--margin-top 26 --header-spacing 4), in points
+header_baseline = (26 - 4 - 1.5) * mm
+header_margin = 10 * mm
+# Helvetica widths (per 1000 points of font size) of what goes in page numbers
+helvetica_widths = dict([(digit, 556) for digit in "0123456789"] + [("/", 278), (" ", 278)])
+
+
+def pypdf():
+    try:
+        import pypdf
+    except ImportError:
+        raise ImportError("Putting PDFs together (--assemble) needs pypdf: pip install pypdf")
+    return pypdf
+
+
+def pdf_string(text):
+    return "(%s)" % text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def text_pdf(pages, width = 595, height = 842, outline = []):
+    """ Smallest useful PDF: pages is a list of lists of (x, y, font size, text) to write on each page
+    in Helvetica, outline a list of (title, page number counting from 0). Returns the PDF as bytes """
+    outlines = 4 + 2 * len(pages)
+    objects = ["<< /Type /Catalog /Pages 2 0 R%s >>" % (" /Outlines %s 0 R" % outlines if outline else ""),
+               "<< /Type /Pages /Kids [%s] /Count %s >>" % (" ".join("%s 0 R" % (4 + 2 * i) for i in range(len(pages))), len(pages)),
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for page in pages:
+        stream = " ".join("BT /F1 %s Tf %.2f %.2f Td %s Tj ET" % (size, x, y, pdf_string(text)) for (x, y, size, text) in page)
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Contents %s 0 R /Resources << /Font << /F1 3 0 R >> >> >>"
+                       % (width, height, len(objects) + 2))
+        objects.append("<< /Length %s >>\nstream\n%s\nendstream" % (len(stream.encode("latin-1", "replace")), stream))
+    if outline:
+        objects.append("<< /Type /Outlines /First %s 0 R /Last %s 0 R /Count %s >>" % (outlines + 1, outlines + len(outline), len(outline)))
+        for number, (title, page) in enumerate(outline, outlines + 1):
+            links = "".join([" /Prev %s 0 R" % (number - 1) if number > outlines + 1 else "",
+                             " /Next %s 0 R" % (number + 1) if number < outlines + len(outline) else ""])
+            objects.append("<< /Title %s /Parent %s 0 R%s /Dest [%s 0 R /XYZ 0 %s 0] >>" % (pdf_string(title), outlines, links, 4 + 2 * page, height))
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += ("%s 0 obj\n%s\nendobj\n" % (number, body)).encode("latin-1", "replace")
+    xref = len(pdf)
+    pdf += ("xref\n0 %s\n0000000000 65535 f \n" % (len(objects) + 1)).encode("latin-1")
+    for offset in offsets:
+        pdf += ("%010d 00000 n \n" % offset).encode("latin-1")
+    pdf += ("trailer\n<< /Size %s /Root 1 0 R >>\nstartxref\n%s\n%%%%EOF\n" % (len(objects) + 1, xref)).encode("latin-1")
+    return pdf
+
+
+def page_count(path):
+    return len(pypdf().PdfReader(path).pages)
+
+
+def write_atomically(path, data):
+    """ Write to a temp file then move it into place, so nobody reads a half-written file """
+    temp_path = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class PartCache:
+    """ PDFs rendered from stand-alone HTML documents, kept on disk by a hash of the document,
+    the wkhtmltopdf options and the renderer (see Renderer.versions) """
+    def __init__(self, directory = None):
+        self.namespace = cache.Namespace("pdf-parts", directory)
+        self.directory = self.namespace.directory
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, document, options):
+        renderer = renderers.current()
+        return hashlib.sha256("\n".join([renderer.name, renderer.versions()] + list(options) + [document]).encode("utf-8")).hexdigest()
+
+    def pdfs(self, documents, options):
+        """ Paths of PDFs for each of the HTML documents, rendering (all at once) the ones that aren't cached.
+        A path is None if rendering failed """
+        keys = [self.key(document, options) for document in documents]
+        paths = [self.namespace.path(key, ".pdf") for key in keys]
+        jobs = {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for document, key, path in zip(documents, keys, paths):
+                if path in jobs:
+                    continue
+                if self.namespace.lookup(key, ".pdf") != None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    html_path = os.path.join(temp_dir, "%s.html" % len(jobs))
+                    with open(html_path, "w") as f:
+                        f.write(document)
+                    # Rendered next to where it goes then moved, so other builds never see half a PDF
+                    jobs[path] = renderers.html_to_pdf_job(html_path, "%s.%s.%s.tmp.pdf" % (path, os.getpid(), threading.get_ident()), options)
+            renderers.run(list(jobs.values()))
+        for path, job in jobs.items():
+            if job.ok and os.path.exists(job.details["pdf_path"]):
+                self.namespace.put_file(job.details["pdf_path"], path)
+            elif os.path.exists(job.details["pdf_path"]):
+                os.remove(job.details["pdf_path"])
+        return [path if os.path.exists(path) else None for path in paths]
+
+
+def plain_text(text):
+    """ Titles can have HTML in them (eg &nbsp;), outlines and headers can't """
+    return re.sub(r"\s+", " ", html.unescape(re.sub("<.*?>", "", text))).strip()
+
+
+def outline_entries(reader, outline = None):
+    """ (page number counting from 0, plain text title) for every entry in a PDF's outline, at any depth """
+    entries = []
+    for entry in reader.outline if outline == None else outline:
+        if isinstance(entry, list):
+            entries += outline_entries(reader, entry)
+        else:
+            entries.append((reader.get_destination_page_number(entry), plain_text(entry.title)))
+    return entries
+
+
+def split(pdf_path, parts):
+    """ Split a PDF rendered from several documents into parts: a list of (path, number of pages, heading),
+    one for each document. Each document's heading has to be in the outline (as wkhtmltopdf makes it from
+    their h1s) on the page the part starts on, so a page that moved between documents isn't missed.
+    Returns False (and writes nothing) if the outline or the page counts don't match """
+    from io import BytesIO
+    reader = pypdf().PdfReader(pdf_path)
+    if sum(pages for path, pages, heading in parts) != len(reader.pages):
+        return False
+    entries = set(outline_entries(reader))
+    start = 0
+    for path, pages, heading in parts:
+        if (start, plain_text(heading)) not in entries:
+            return False
+        start += pages
+    start = 0
+    for path, pages, heading in parts:
+        writer = pypdf().PdfWriter()
+        for page in reader.pages[start:start + pages]:
+            writer.add_page(page)
+        start += pages
+        output = BytesIO()
+        writer.write(output)
+        write_atomically(path, output.getvalue())
+    return True
+
+
+def helvetica_can_write(text):
+    """ Whether merge() can put text in a header: text_pdf's Helvetica only has Latin-1 characters """
+    try:
+        plain_text(text).encode("latin-1")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def header_width(text, size):
+    return sum(helvetica_widths.get(c, 556) for c in text) * size / 1000
+
+
+def merge(parts, pdf_path, header_left = None, header_size = 12, headers = True, outline = []):
+    """ Join PDFs into one at pdf_path
+    parts: list of (path, outline entry for the part's first page or None)
+    header_left: text for the top left of every page, the top right gets [page]/[toPage]
+    headers: False if the parts have their own
+    outline: more outline entries, as (title, page number counting from 0) """
+    from io import BytesIO
+    writer = pypdf().PdfWriter()
+    starts = []
+    for path, title in parts:
+        starts.append(len(writer.pages))
+        for page in pypdf().PdfReader(path).pages:
+            writer.add_page(page)
+
+    # Headers are drawn on pages of their own, then laid over the parts' pages
+    total = len(writer.pages)
+    for number, page in enumerate(writer.pages if headers else [], 1):
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        right = "%s/%s" % (number, total)
+        header = [(width - header_margin - header_width(right, header_size), height - header_baseline, header_size, right)]
+        if header_left:
+            header.append((header_margin, height - header_baseline, header_size, plain_text(header_left)))
+        overlay = pypdf().PdfReader(BytesIO(text_pdf([header], width, height))).pages[0]
+        page.merge_page(overlay)
+
+    entries = [(title, start) for (start, (path, title)) in zip(starts, parts) if title]
+    for title, start in sorted(entries + list(outline), key = lambda entry: entry[1]):
+        if start < total:
+            writer.add_outline_item(plain_text(title), start)
+
+    output = BytesIO()
+    writer.write(output)
+    write_atomically(pdf_path, output.getvalue())
+    return total
@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+"""
+Records where a build spends its time, for mksong --profile and mkchordchart --profile.
+
+Code marks out spans, either with the span() context manager or the profiled() decorator:
+
+    with profiling.span("reorder"):
+        ...
+
+Each span gets wall time, CPU time (this process, plus any child processes for subprocess spans)
+and the peak memory (resident set size) reached by the time it finishes. Nothing is recorded
+unless the profiler has been enabled, so spans can stay in the code.
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, so no CPU time for child processes or peak memory there
+    resource = None
+
+
+def peak_memory_mb(who = None):
+    """ High-water mark for resident memory, in MB, for this process or its (finished) children """
+    if resource == None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == None else who)
+    # ru_maxrss is in bytes on macOS and KB everywhere else
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def child_cpu_time():
+    if resource == None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span:
+    """ One timed piece of work, nested inside whatever span was open when it started """
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.get_ident()
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.depth = len(stack)
+        self.parent = stack[-1].name if stack else None
+        self.parent_category = stack[-1].category if stack else None
+        stack.append(self)
+        self.peak_at_start = peak_memory_mb()
+        self.child_cpu_at_start = child_cpu_time() if self.category == "subprocess" else 0.0
+        self.cpu_at_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.process_time() - self.cpu_at_start
+        if self.category == "subprocess":
+            self.cpu += child_cpu_time() - self.child_cpu_at_start
+            self.peak = max(peak_memory_mb(), peak_memory_mb(resource.RUSAGE_CHILDREN) if resource else 0.0)
+        else:
+            self.peak = peak_memory_mb()
+        self.profiler.stack().pop()
+        self.profiler.spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {"name": self.name,
+                "category": self.category,
+                "args": self.args,
+                "parent": self.parent,
+                "depth": self.depth,
+                "thread": self.thread,
+                "start": self.start - self.profiler.started,
+                "wall": self.wall,
+                "cpu": self.cpu,
+                "peak_memory_mb": self.peak,
+                "memory_growth_mb": self.peak - self.peak_at_start}
+
+
+class NullSpan:
+    """ Stands in for a Span when the profiler is off """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Profiler:
+    """ Collects spans for a whole run """
+    null_span = NullSpan()
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.started = None
+        self.local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+        self.spans = []
+        self.started = time.perf_counter()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, category = "stage", **args):
+        """ Context manager timing the code inside it
+        category: stage (book level work), song (work on one song, args should include song=title),
+        subprocess (external tools) or diagram
+        """
+        if not self.enabled:
+            return Profiler.null_span
+        return Span(self, name, category, args)
+
+    def to_json(self):
+        return {"total": time.perf_counter() - self.started,
+                "peak_memory_mb": peak_memory_mb(),
+                "spans": [span.to_dict() for span in self.spans]}
+
+    def to_chrome_trace(self):
+        """ Trace event format, can be loaded into chrome://tracing or https://ui.perfetto.dev """
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans, key = lambda span: span.start):
+            args = dict(span.args)
+            args.update({"cpu_ms": round(span.cpu * 1000, 3), "peak_memory_mb": round(span.peak, 1)})
+            events.append({"name": span.name,
+                           "cat": span.category,
+                           "ph": "X",
+                           "ts": round((span.start - self.started) * 1000000, 1),
+                           "dur": round(span.wall * 1000000, 1),
+                           "pid": pid,
+                           "tid": span.thread,
+                           "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, stem):
+        """ Write stem.profile.json and stem.trace.json, returns their paths """
+        paths = (stem + ".profile.json", stem + ".trace.json")
+        with open(paths[0], "w") as f:
+            json.dump(self.to_json(), f, indent=1)
+        with open(paths[1], "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        return paths
+
+    def summary(self, count = 10):
+        """ Table of the slowest stages (all spans with the same name added up) and songs """
+        stages = {}
+        songs = {}
+        for span in self.spans:
+            calls, wall, cpu, peak = stages.get((span.category, span.name), (0, 0.0, 0.0, 0.0))
+            stages[(span.category, span.name)] = (calls + 1, wall + span.wall, cpu + span.cpu, max(peak, span.peak))
+            # Only count the outermost span for each song, so nested work isn't counted twice
+            if span.category == "song" and "song" in span.args and span.parent_category != "song":
+                songs[span.args["song"]] = songs.get(span.args["song"], 0.0) + span.wall
+
+        lines = ["Profile: %.3fs total, peak memory %.1f MB" % (time.perf_counter() - self.started, peak_memory_mb()), ""]
+        lines.append("%-40s %-10s %6s %10s %10s %9s" % ("Slowest stages", "category", "calls", "wall s", "cpu s", "peak MB"))
+        for (category, name), (calls, wall, cpu, peak) in sorted(stages.items(), key = lambda item: item[1][1], reverse=True)[:count]:
+            lines.append("%-40s %-10s %6d %10.3f %10.3f %9.1f" % (name[:40], category, calls, wall, cpu, peak))
+        if songs:
+            lines.append("")
+            lines.append("%-58s %10s" % ("Slowest songs", "wall s"))
+            for song, wall in sorted(songs.items(), key = lambda item: item[1], reverse=True)[:count]:
+                lines.append("%-58s %10.3f" % (song[:58], wall))
+        return "\n".join(lines)
+
+
+def profiled(name, category = "stage", describe = None):
+    """ Decorator that runs a function inside a span. describe, if given, is called with the
+    function's arguments after it returns and gives a dict of extra args for the span (eg the song title)
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.span(name, category) as current:
+                result = function(*args, **kwargs)
+                if describe != None:
+                    current.args.update(describe(*args, **kwargs))
+            return result
+        return wrapper
+    return decorate
+
+
+# One profiler for the whole process
+profiler = Profiler()
+span = profiler.span
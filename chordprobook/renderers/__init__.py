@@ -0,0 +1,519 @@
+#! /usr/bin/env python3
+"""
+The external programs that turn songs into documents: pandoc (via pypandoc) for markdown, HTML
+and word processor formats, and a PDF engine for PDF.
+
+All of chordprobook's conversions go through convert() and html_to_pdf() here, which hand
+them to the current renderer. Renderers:
+
+pandoc: the real thing (the default)
+null:   runs nothing, records each job and writes placeholder output files, so whole
+        book builds can be timed or tested on machines without pandoc or wkhtmltopdf
+
+Pick one with use(), or with the CHORDPROBOOK_RENDERER environment variable.
+
+PDF engines (for the pandoc renderer):
+
+wkhtmltopdf: the wkhtmltopdf program (the default)
+weasyprint:  WeasyPrint, in this process (pip install weasyprint). It doesn't run JavaScript,
+             so song text isn't shrunk to fit the page; headers and page numbers are done
+             with CSS paged media
+
+Pick one with use_pdf_engine(), or with the CHORDPROBOOK_PDF_ENGINE environment variable.
+
+Conversions that don't depend on each other can be made into Jobs (convert_job(), html_to_pdf_job())
+and run together with run(): the pandoc renderer runs them as parallel subprocesses.
+"""
+import os
+import re
+import time
+import chordprobook.profiling as profiling
+
+
+class Job:
+    """ One conversion for a renderer to run: tool is pandoc or wkhtmltopdf (HTML to PDF, whatever the
+    PDF engine), details are the arguments to Renderer.convert or Renderer.html_to_pdf. Renderers that
+    run programs themselves set command (the program and its arguments) and input (bytes for its stdin),
+    or function, to call in a thread instead of running a program. Binary jobs keep their output as bytes.
+    Once run: returncode, output (the converted text, for conversions without an outputfile, or what
+    function returned), stderr, attempts, seconds and timed_out """
+    def __init__(self, tool, command = None, input = None, function = None, **details):
+        self.tool = tool
+        self.command = command
+        self.input = input
+        self.function = function
+        self.details = details
+        self.binary = False
+        self.returncode = None
+        self.output = None
+        self.stderr = ""
+        self.attempts = 0
+        self.seconds = 0
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def describe(self):
+        status = "timed out" if self.timed_out else "exit status %s" % self.returncode
+        return "%s failed (%s, %s attempts): %s" % (self.tool, status, self.attempts, self.stderr.strip())
+
+
+class JobError(RuntimeError):
+    """ A conversion failed, job is the Job """
+    def __init__(self, job):
+        RuntimeError.__init__(self, job.describe())
+        self.job = job
+
+
+class Renderer:
+    """ Interface for renderers """
+    name = None
+
+    def convert(self, source, to, format, outputfile=None, extra_args=[]):
+        """ Same as pypandoc.convert: source is text or a path, returns the converted text
+        if there's no outputfile """
+        raise NotImplementedError
+
+    def html_to_pdf(self, html_path, pdf_path, options=[]):
+        """ Make a PDF from an HTML file (or a list of them, each starting a new page),
+        options are wkhtmltopdf command line options. Returns the exit status """
+        raise NotImplementedError
+
+    def convert_job(self, source, to, format, outputfile=None, extra_args=[]):
+        """ A Job for convert() """
+        return Job("pandoc", source=source, to=to, format=format, outputfile=outputfile, extra_args=list(extra_args))
+
+    def html_to_pdf_job(self, html_path, pdf_path, options=[]):
+        """ A Job for html_to_pdf() """
+        return Job("wkhtmltopdf", html_path=html_path, pdf_path=pdf_path, options=list(options))
+
+    def html_to_pdf_bytes(self, html, options=[]):
+        """ A PDF (bytes) from an HTML document (a string). This one goes through temp files """
+        import tempfile
+        with tempfile.TemporaryDirectory() as temp_dir:
+            html_path = os.path.join(temp_dir, "document.html")
+            pdf_path = os.path.join(temp_dir, "document.pdf")
+            with open(html_path, "w") as f:
+                f.write(html)
+            self.html_to_pdf(html_path, pdf_path, options)
+            with open(pdf_path, "rb") as f:
+                return f.read()
+
+    def convert_to_bytes(self, source, to, format, extra_args=[]):
+        """ Like convert(), for formats that aren't text (eg docx). This one goes through a temp file """
+        import tempfile
+        with tempfile.TemporaryDirectory() as temp_dir:
+            outputfile = os.path.join(temp_dir, "document.%s" % to)
+            self.convert(source, to, format, outputfile=outputfile, extra_args=extra_args)
+            with open(outputfile, "rb") as f:
+                return f.read()
+
+    def versions(self):
+        """ The versions of the tools this uses, as a string """
+        return ""
+
+    def run(self, jobs):
+        """ Run jobs, filling in their results. This one just calls convert() and html_to_pdf() in turn """
+        for job in jobs:
+            start = time.perf_counter()
+            job.attempts += 1
+            if job.tool == "wkhtmltopdf":
+                job.returncode = self.html_to_pdf(**job.details)
+            else:
+                job.output = self.convert(**job.details)
+                job.returncode = 0
+            job.seconds = time.perf_counter() - start
+        return jobs
+
+
+class PDFEngine:
+    """ Interface for PDF engines: HTML files to a PDF, given wkhtmltopdf command line options
+    (which engines that aren't wkhtmltopdf translate as best they can) """
+    name = None
+
+    def command(self, html_paths, pdf_path, options):
+        """ The command line to run, or None if the engine runs in this process (see render) """
+        return None
+
+    def render(self, html_paths, pdf_path, options):
+        raise NotImplementedError
+
+    def render_bytes(self, html, options):
+        """ A PDF (bytes) from an HTML document (a string), for engines that run in this process """
+        raise NotImplementedError
+
+    def version(self):
+        return self.name
+
+
+class WkhtmltopdfEngine(PDFEngine):
+    """ The wkhtmltopdf program """
+    name = "wkhtmltopdf"
+
+    def command(self, html_paths, pdf_path, options):
+        return ["wkhtmltopdf"] + list(options) + list(html_paths) + [pdf_path]
+
+    def version(self):
+        import subprocess
+        try:
+            output = subprocess.run(["wkhtmltopdf", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+            return output.decode("utf-8", "replace").strip().split("\n")[0]
+        except OSError:
+            return "wkhtmltopdf missing"
+
+
+class WeasyPrintEngine(PDFEngine):
+    """ WeasyPrint, in this process. Page size, margins, headers (with page numbers) and the outline
+    come from CSS made from the wkhtmltopdf options """
+    name = "weasyprint"
+
+    def stylesheet(self, options):
+        """ CSS paged media for the wkhtmltopdf options mksong uses """
+        def quoted(text):
+            return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+        def content(text):
+            """ Header text, with wkhtmltopdf's [page] and [toPage] as page counters """
+            parts = []
+            for part in re.split(r"(\[page\]|\[toPage\])", text):
+                if part == "[page]":
+                    parts.append("counter(page)")
+                elif part == "[toPage]":
+                    parts.append("counter(pages)")
+                elif part:
+                    parts.append(quoted(part))
+            return " ".join(parts) or '""'
+
+        def value(name, default = None):
+            return options[options.index(name) + 1] if name in options else default
+
+        header_style = "font-family: %s; font-size: %spt;" % (quoted(value("--header-font-name", "sans-serif")), value("--header-font-size", "12"))
+        page = ["size: %s;" % value("-s", "A4"), "margin: 10mm;"]
+        if "--margin-top" in options:
+            page.append("margin-top: %smm;" % value("--margin-top"))
+        for option, box in [("--header-left", "top-left"), ("--header-center", "top-center"), ("--header-right", "top-right")]:
+            if option in options:
+                page.append("@%s { content: %s; %s }" % (box, content(value(option)), header_style))
+        css = "@page { %s }\n" % " ".join(page)
+        if "--page-offset" in options:
+            css += "@page :first { counter-reset: page %s }\n" % (int(value("--page-offset")) + 1)
+        # wkhtmltopdf only makes an outline if asked, to --outline-depth
+        depth = int(value("--outline-depth", 4)) if "--outline" in options else 0
+        css += "".join("h%s { bookmark-level: none }\n" % level for level in range(depth + 1, 7))
+        return css
+
+    def render(self, html_paths, pdf_path, options):
+        import weasyprint
+        stylesheet = weasyprint.CSS(string = self.stylesheet(options))
+        documents = [weasyprint.HTML(filename = path).render(stylesheets = [stylesheet]) for path in html_paths]
+        # Each file starts a new page, as with wkhtmltopdf
+        pages = [page for document in documents for page in document.pages]
+        documents[0].copy(pages).write_pdf(pdf_path)
+
+    def render_bytes(self, html, options):
+        import weasyprint
+        stylesheet = weasyprint.CSS(string = self.stylesheet(options))
+        return weasyprint.HTML(string = html, base_url = ".").render(stylesheets = [stylesheet]).write_pdf()
+
+    def version(self):
+        try:
+            import weasyprint
+            return "WeasyPrint %s" % weasyprint.__version__
+        except ImportError:
+            return "weasyprint missing"
+
+
+pdf_engines = {WkhtmltopdfEngine.name: WkhtmltopdfEngine, WeasyPrintEngine.name: WeasyPrintEngine}
+
+
+class PandocRenderer(Renderer):
+    """ pandoc (found by pypandoc), run as subprocesses, and a PDF engine.
+    concurrency: jobs to run at once, defaults to the number of CPUs
+    timeout: seconds before a job is killed
+    retries: times to rerun a job that timed out or was killed
+    pdf_engine: name of a PDF engine (see pdf_engines), defaults to $CHORDPROBOOK_PDF_ENGINE or wkhtmltopdf """
+    name = "pandoc"
+    # pypandoc's short names for formats
+    formats = {"md": "markdown", "dbk": "docbook", "tex": "latex"}
+
+    def __init__(self, concurrency = None, timeout = 300, retries = 1, pdf_engine = None):
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.timeout = timeout
+        self.retries = retries
+        self.pandoc = None
+        self.tool_versions = None
+        self.use_pdf_engine(pdf_engine or os.environ.get("CHORDPROBOOK_PDF_ENGINE", WkhtmltopdfEngine.name))
+
+    def use_pdf_engine(self, name):
+        if name not in pdf_engines:
+            raise ValueError("Unknown PDF engine %s, try one of: %s" % (name, ", ".join(sorted(pdf_engines))))
+        self.pdf_engine = pdf_engines[name]()
+        self.tool_versions = None
+
+    def convert(self, source, to, format, outputfile=None, extra_args=[]):
+        job = self.run([self.convert_job(source, to, format, outputfile, extra_args)])[0]
+        if not job.ok:
+            raise JobError(job)
+        return job.output
+
+    def html_to_pdf(self, html_path, pdf_path, options=[]):
+        job = self.run([self.html_to_pdf_job(html_path, pdf_path, options)])[0]
+        if not job.ok:
+            print(job.describe())
+        return job.returncode
+
+    def html_to_pdf_bytes(self, html, options=[]):
+        """ The HTML goes to the PDF engine's stdin (or straight to it, in process) and the PDF comes back
+        on its stdout, no files involved. Raises JobError if it fails """
+        job = self.run([self.html_to_pdf_bytes_job(html, options)])[0]
+        # wkhtmltopdf gives up on missing images and the like but still makes the PDF
+        if not job.output or not job.output.startswith(b"%PDF"):
+            raise JobError(job)
+        return job.output
+
+    def convert_to_bytes(self, source, to, format, extra_args=[]):
+        """ pandoc writes the output to its stdout, so there's no file. Raises JobError if it fails """
+        job = self.convert_job(source, to, format, outputfile="-", extra_args=extra_args)
+        job.binary = True
+        self.run([job])
+        if not job.ok:
+            raise JobError(job)
+        return job.output
+
+    def versions(self):
+        """ First line of pandoc --version and the PDF engine's version (checked once) """
+        if self.tool_versions == None:
+            import subprocess
+            if self.pandoc == None:
+                import pypandoc
+                self.pandoc = pypandoc.get_pandoc_path()
+            try:
+                output = subprocess.run([self.pandoc, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+                pandoc = output.decode("utf-8", "replace").strip().split("\n")[0]
+            except OSError:
+                pandoc = "pandoc missing"
+            self.tool_versions = "%s, %s" % (pandoc, self.pdf_engine.version())
+        return self.tool_versions
+
+    def convert_job(self, source, to, format, outputfile=None, extra_args=[]):
+        """ The same pandoc command line pypandoc.convert would run """
+        if self.pandoc == None:
+            import pypandoc
+            self.pandoc = pypandoc.get_pandoc_path()
+        job = Renderer.convert_job(self, source, to, format, outputfile, extra_args)
+        job.command = [self.pandoc, "--from=" + self.formats.get(format, format), "--to=" + self.formats.get(to, to)]
+        if os.path.exists(source):
+            job.command.append(source)
+        else:
+            job.input = source.encode("utf-8")
+        if outputfile:
+            job.command.append("--output=" + outputfile)
+        job.command += list(extra_args)
+        return job
+
+    def html_to_pdf_job(self, html_path, pdf_path, options=[]):
+        job = Renderer.html_to_pdf_job(self, html_path, pdf_path, options)
+        html_paths = html_path if isinstance(html_path, list) else [html_path]
+        job.command = self.pdf_engine.command(html_paths, pdf_path, options)
+        if job.command == None:
+            job.function = lambda: self.pdf_engine.render(html_paths, pdf_path, options)
+        return job
+
+    def html_to_pdf_bytes_job(self, html, options=[]):
+        """ A Job for html_to_pdf_bytes(), its output is the PDF """
+        job = Renderer.html_to_pdf_job(self, None, None, options)
+        job.binary = True
+        job.command = self.pdf_engine.command(["-"], "-", options)
+        if job.command == None:
+            job.function = lambda: self.pdf_engine.render_bytes(html, options)
+        else:
+            job.input = html.encode("utf-8")
+        return job
+
+    def run(self, jobs):
+        """ Run the jobs as subprocesses, up to self.concurrency at a time. Each one is waited for
+        by a thread of its own (rather than an asyncio loop, which Python 3.7 can only use for
+        subprocesses in the main thread), so this works from any thread """
+        import concurrent.futures
+        if len(jobs) == 1:
+            self.run_job(jobs[0])
+        elif jobs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = self.concurrency) as pool:
+                list(pool.map(self.run_job, jobs))
+        return jobs
+
+    def run_job(self, job):
+        """ Run a job, killing it if it takes longer than the timeout and trying again
+        (up to self.retries times) if it was killed """
+        import subprocess
+        if job.function != None:
+            self.call_job(job)
+            return
+        start = time.perf_counter()
+        while True:
+            job.attempts += 1
+            process = subprocess.Popen(job.command,
+                                       stdin=subprocess.PIPE if job.input != None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = process.communicate(job.input, timeout=self.timeout)
+                job.timed_out = False
+            except subprocess.TimeoutExpired:
+                process.kill()
+                stdout, stderr = process.communicate()
+                job.timed_out = True
+            job.returncode = process.returncode
+            job.output = stdout if job.binary else stdout.decode("utf-8", "replace")
+            job.stderr = stderr.decode("utf-8", "replace")
+            if job.ok or job.returncode > 0 or job.attempts > self.retries:
+                break
+        job.seconds = time.perf_counter() - start
+
+    def call_job(self, job):
+        """ Run a job that's a function (see Job). It can't be killed, so there's no timeout """
+        import traceback
+        start = time.perf_counter()
+        job.attempts += 1
+        try:
+            job.output = job.function()
+            job.returncode = 0
+        except Exception:
+            job.returncode = 1
+            job.stderr = traceback.format_exc()
+        job.seconds = time.perf_counter() - start
+
+
+class NullRenderer(Renderer):
+    """ Doesn't run anything. Jobs are kept in self.jobs, text conversions come back unchanged
+    and output files get placeholders (a one page PDF for PDFs) """
+    name = "null"
+
+    def __init__(self):
+        self.jobs = []
+
+    def versions(self):
+        return "null"
+
+    def convert(self, source, to, format, outputfile=None, extra_args=[]):
+        self.jobs.append({"tool": "pandoc", "to": to, "format": format, "outputfile": outputfile, "extra_args": list(extra_args)})
+        if os.path.isfile(source):
+            with open(source) as f:
+                source = f.read()
+        if outputfile == None:
+            return source
+        if to == "html":
+            with open(outputfile, "w") as f:
+                f.write(source)
+        elif to == "pdf":
+            write_placeholder_pdf(outputfile)
+        else:
+            with open(outputfile, "w") as f:
+                f.write("Placeholder %s from the null renderer\n" % to)
+        return ""
+
+    def html_to_pdf(self, html_path, pdf_path, options=[]):
+        self.jobs.append({"tool": "wkhtmltopdf", "input": html_path, "output": pdf_path, "options": list(options)})
+        if isinstance(html_path, list):
+            # A page for each document, with its h1 in the outline as wkhtmltopdf would
+            headings = []
+            for path in html_path:
+                with open(path) as f:
+                    heading = re.search("<h1[^>]*>(.*?)</h1>", f.read(), re.S)
+                headings.append(heading.group(1) if heading else "")
+            write_placeholder_pdf(pdf_path, pages = len(html_path), outline = [(heading, page) for page, heading in enumerate(headings) if heading])
+        else:
+            write_placeholder_pdf(pdf_path)
+        return 0
+
+    def html_to_pdf_bytes(self, html, options=[]):
+        import chordprobook.pdfs as pdfs
+        self.jobs.append({"tool": "wkhtmltopdf", "input": None, "output": None, "options": list(options)})
+        return pdfs.text_pdf([[(72, 770, 12, "Placeholder from the null renderer")]])
+
+    def convert_to_bytes(self, source, to, format, extra_args=[]):
+        self.jobs.append({"tool": "pandoc", "to": to, "format": format, "outputfile": None, "extra_args": list(extra_args)})
+        return ("Placeholder %s from the null renderer\n" % to).encode("utf-8")
+
+
+def write_placeholder_pdf(path, text = "Placeholder from the null renderer", pages = 1, outline = []):
+    """ Smallest useful PDF: A4 pages with a line of text on each, and an outline of (title, page) """
+    import chordprobook.pdfs as pdfs
+    with open(path, "wb") as f:
+        f.write(pdfs.text_pdf([[(72, 770, 12, text)]] * pages, outline = outline))
+
+
+renderers = {PandocRenderer.name: PandocRenderer, NullRenderer.name: NullRenderer}
+_current = None
+
+def use(renderer):
+    """ Set the renderer for everything that follows, by name or as a Renderer. Returns it """
+    global _current
+    if not isinstance(renderer, Renderer):
+        if renderer not in renderers:
+            raise ValueError("Unknown renderer %s, try one of: %s" % (renderer, ", ".join(sorted(renderers))))
+        renderer = renderers[renderer]()
+    _current = renderer
+    return _current
+
+def use_pdf_engine(name):
+    """ Set the PDF engine (see pdf_engines) for the current renderer, if it has them """
+    renderer = current()
+    if hasattr(renderer, "use_pdf_engine"):
+        renderer.use_pdf_engine(name)
+    elif name not in pdf_engines:
+        raise ValueError("Unknown PDF engine %s, try one of: %s" % (name, ", ".join(sorted(pdf_engines))))
+
+def current():
+    """ The renderer in use, set from CHORDPROBOOK_RENDERER (default pandoc) the first time it's needed """
+    if _current == None:
+        use(os.environ.get("CHORDPROBOOK_RENDERER", PandocRenderer.name))
+    return _current
+
+def convert(source, to, format, outputfile=None, extra_args=[]):
+    """ pandoc conversion with the current renderer, see Renderer.convert """
+    renderer = current()
+    with profiling.span("pandoc", "subprocess", to=to, renderer=renderer.name):
+        return renderer.convert(source, to, format, outputfile=outputfile, extra_args=extra_args)
+
+def html_to_pdf(html_path, pdf_path, options=[]):
+    """ HTML to PDF with the current renderer, see Renderer.html_to_pdf """
+    renderer = current()
+    with profiling.span("wkhtmltopdf", "subprocess", renderer=renderer.name):
+        return renderer.html_to_pdf(html_path, pdf_path, options)
+
+def html_to_pdf_bytes(html, options=[]):
+    """ HTML (a string) to PDF (bytes) with the current renderer, in memory if it can, see Renderer.html_to_pdf_bytes """
+    renderer = current()
+    with profiling.span("wkhtmltopdf", "subprocess", renderer=renderer.name):
+        return renderer.html_to_pdf_bytes(html, options)
+
+def convert_to_bytes(source, to, format, extra_args=[]):
+    """ pandoc conversion to bytes (eg docx), in memory if the renderer can, see Renderer.convert_to_bytes """
+    renderer = current()
+    with profiling.span("pandoc", "subprocess", to=to, renderer=renderer.name):
+        return renderer.convert_to_bytes(source, to, format, extra_args=extra_args)
+
+def convert_job(source, to, format, outputfile=None, extra_args=[]):
+    """ A pandoc conversion to run later with run() """
+    return current().convert_job(source, to, format, outputfile=outputfile, extra_args=extra_args)
+
+def html_to_pdf_job(html_path, pdf_path, options=[]):
+    """ An HTML to PDF conversion to run later with run() """
+    return current().html_to_pdf_job(html_path, pdf_path, options)
+
+def run(jobs):
+    """ Run jobs together with the current renderer, returns them with their results.
+    A failed pandoc job raises JobError (as pypandoc would have), failed wkhtmltopdf jobs
+    are only reported: it gives up on missing images and the like but still writes the PDF """
+    renderer = current()
+    with profiling.span("jobs", "subprocess", renderer=renderer.name, jobs=len(jobs)):
+        renderer.run(jobs)
+    for job in jobs:
+        if not job.ok:
+            if job.tool == "pandoc":
+                raise JobError(job)
+            print(job.describe())
+    return jobs
@@ -4,11 +4,11 @@
 Quick and dirty script to generate a set of chordpro definitions for a given instrument tuning
 Attempts to sort by playability, but the idea is to create a set of shapes that can then be tweaked by hand.
 
-Calls a hacked version of "Simple minded guitar chords" by Erich Rickheit
+Works out the chords with chordprobook's own chord finder, using a pool of processes
 
 usage:
 
-generate_chord_defs <tuning>
+generate_chord_defs <tuning> [<tuning> ...]
 
 where tuning is a space list of strings (in quotes) eg
 
@@ -17,39 +17,32 @@ where tuning is a space list of strings (in quotes) eg
 """
 
 import argparse
-import re
-import subprocess
 from chordprobook  import chords
-    
-def generate_grids(chord, tuning):
-    command = ["./chord/ch", "-f", "4", "-p", "4",  "-r", "3", "-i", "0",  "-t"]
-    for string in tuning:
-        command.append(string)
-    command += [".", chord]
-    print(" ".join(command))
-    out = subprocess.check_output(command)
-    print(out)
-    return str(out.decode())
+
+variants = ["", "7","6","sus4","m" ,"maj7" ,"m7","add9","dim"]
 
 def generate_defs():
     transposer = chords.transposer()
     parser = argparse.ArgumentParser()
-    parser.add_argument('tuning',  default=None, help='tuning')
+    parser.add_argument('tuning', nargs="+", default=None, help='tuning')
+    parser.add_argument('-r', '--reach', type=int, default=4, help='Maximum reach: largest number frets spanned by a chord')
+    parser.add_argument('-f', '--fingers',type=int,  default=4, help='Maximum number of fingers allowed')
+    parser.add_argument('-u', '--unplayed',type=int,  default=4, help='Maximum number of unplayed strings allowed')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes to use (defaults to number of CPUs)')
     args = vars(parser.parse_args())
-    tuning = args["tuning"]
-    chordpro_definitions = "";
-    for note_index  in range(0,12):
-        for variant in ["", "7","6","sus4","m" ,"maj7" ,"m7","Add9","dim"]:
-            chord_name = transposer.get_note(note_index) + variant
-            defs = generate_grids(chord_name, tuning)
-            grids = chords.ChordChart()
-            grids.load(defs)
-            norm_chord_name = grids.normalise_chord_name(chord_name)
-            grids.sort_by_playability(norm_chord_name)
-            chordpro_definitions += "{c: %s}\n%s\n" % (norm_chord_name,  str(grids.to_chordpro(norm_chord_name)))
-            
-    open("%s_chords.cho" % tuning.replace(" ",""), 'w').write(chordpro_definitions)  
-    
+    generator = chords.ChartGenerator(args["reach"], args["fingers"], args["unplayed"], variants=variants, processes=args["jobs"])
+    charts = generator.charts(args["tuning"])
+    for tuning in args["tuning"]:
+        grids = charts[tuning]
+        chordpro_definitions = "";
+        for note_index  in range(0,12):
+            for variant in variants:
+                chord_name = transposer.get_note(note_index) + variant
+                norm_chord_name = grids.normalise_chord_name(chord_name)
+                chordpro_definitions += "{c: %s}\n%s\n" % (norm_chord_name,  str(grids.to_chordpro(norm_chord_name)))
+
+        open("%s_chords.cho" % tuning.replace(" ",""), 'w').write(chordpro_definitions)
+
 
 if __name__ == "__main__":
     generate_defs()
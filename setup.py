@@ -1,6 +1,6 @@
 from distutils.core import setup
 setup(
-    packages=['chordprobook', 'chordprobook.books', 'chordprobook.instruments', 'chordprobook.chords'],
+    packages=['chordprobook', 'chordprobook.books', 'chordprobook.instruments', 'chordprobook.chords', 'chordprobook.profiling', 'chordprobook.renderers', 'chordprobook.build', 'chordprobook.daemon', 'chordprobook.pdfs', 'chordprobook.cache', 'chordprobook.batch', 'chordprobook.api'],
     #py_modules =[ 'chordprobook', 'chordprobook.books', 'chordprobook.instruments', 'chordprobook.chords'],
     package_data={   
     'chordprobook.instruments': ['instruments.yaml'],
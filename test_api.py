@@ -0,0 +1,56 @@
+#!usr/bin/env python3
+import unittest
+import contextlib
+import io
+import chordprobook.api as api
+import chordprobook.cache as cache
+import chordprobook.renderers as renderers
+
+song = "{title: Hello}\n{key: C}\n[C]Hello [F]there [G]you\n"
+
+class TestApi(unittest.TestCase):
+  def setUp(self):
+      self.previous = renderers.current()
+      renderers.use("null")
+      self.cache = cache.TemporaryCache()
+
+  def tearDown(self):
+      renderers.use(self.previous)
+      self.cache.cleanup()
+
+  def test_render_song(self):
+      out = io.StringIO()
+      with contextlib.redirect_stdout(out):
+          pdf = api.render_song(song, key = "D", instrument = "Soprano Ukulele")
+          html = api.render_song(song, key = "D", fmt = "html").decode("utf-8")
+      self.assertEqual(out.getvalue(), "")
+      self.assertTrue(pdf.startswith(b"%PDF"))
+      self.assertTrue("Key: D" in html or ">D<" in html)
+      self.assertFalse(">F<" in html)
+      # From the key it's written in, however it was transposed
+      html = api.render_song(song, key = "C", transpose = 2, fmt = "html").decode("utf-8")
+      self.assertTrue("Hello (C)" in html and '<span class="chord">D</span>' not in html)
+      self.assertEqual(api.note_number("F#m"), 6)
+      self.assertEqual(api.note_number(" Bb"), 10)
+      with self.assertRaises(ValueError):
+          api.render_song(song, fmt = "rtf")
+      with self.assertRaises(ValueError):
+          api.render_song("{title: No key}\n[C]Hello\n", key = "D")
+
+  def test_render_book(self):
+      with contextlib.redirect_stdout(io.StringIO()):
+          self.assertTrue(api.render_book([song, (song, 2)], title = "Gig").startswith(b"%PDF"))
+          self.assertTrue(len(api.render_book([song], fmt = "epub")) > 0)
+          html = api.render_book([song, song.replace("Hello}", "Goodbye}")], title = "Gig", fmt = "html").decode("utf-8")
+      self.assertTrue("Gig" in html and "Goodbye" in html)
+
+  def test_threads(self):
+      import concurrent.futures
+      keys = ["C", "D", "E", "F", "G", "A"]
+      with concurrent.futures.ThreadPoolExecutor(max_workers = 3) as pool:
+          pages = list(pool.map(lambda key: api.render_song(song, key = key, fmt = "html").decode("utf-8"), keys))
+      self.assertEqual(len(pages), len(keys))
+      self.assertTrue("G" in pages[4] and "D" in pages[4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!usr/bin/env python3
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+import chordprobook.batch as batch
+import chordprobook.cache as cache
+import chordprobook.renderers as renderers
+
+class TestBatch(unittest.TestCase):
+  def setUp(self):
+      self.previous = renderers.current()
+      renderers.use("null")
+      self.cache = cache.TemporaryCache()
+      self.tmp = tempfile.TemporaryDirectory()
+      self.dir = self.tmp.name
+      os.mkdir(os.path.join(self.dir, "out"))
+      for name in ["one", "two", "three"]:
+          self.write("%s.cho" % name, "{title: Song %s}\n{key: C}\n[C]Hello [G]there\n" % name)
+      self.write("book.txt", "{title: Book}\none.cho\ntwo.cho\n")
+      self.write("nightly.yaml", """
+defaults:
+  directory: out
+targets:
+  book:
+    book_file: book.txt
+    formats: [pdf, html]
+  sheets:
+    one-doc: true
+    files: ["*.cho"]
+  ukulele:
+    book_file: book.txt
+    instrument: Soprano Ukulele
+    file_stem: ukulele
+""")
+
+  def tearDown(self):
+      renderers.use(self.previous)
+      self.cache.cleanup()
+      self.tmp.cleanup()
+
+  def write(self, name, text):
+      with open(os.path.join(self.dir, name), "w") as f:
+          f.write(text)
+
+  def test_load(self):
+      targets = batch.load(os.path.join(self.dir, "nightly.yaml"))
+      self.assertEqual([name for name, args in targets], ["book", "sheets", "ukulele"])
+      book = dict(targets)["book"]
+      self.assertTrue(book["pdf"] and book["html"] and book["directory"] == "out")
+      self.assertEqual(dict(targets)["sheets"]["files"], [os.path.join(self.dir, name) for name in ["one.cho", "three.cho", "two.cho"]])
+
+      self.write("bad.yaml", "targets:\n  bad:\n    no_such_option: true\n")
+      with self.assertRaises(ValueError):
+          batch.load(os.path.join(self.dir, "bad.yaml"))
+      self.write("bad.yaml", "targets:\n  bad:\n    watch: true\n")
+      with self.assertRaises(ValueError):
+          batch.load(os.path.join(self.dir, "bad.yaml"))
+
+      # mksong batch says what's wrong rather than print a traceback
+      mksong = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mksong")
+      result = subprocess.run([sys.executable, mksong, "batch", os.path.join(self.dir, "bad.yaml")], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      self.assertEqual(result.returncode, 1)
+      self.assertEqual(result.stdout.decode().strip(), "Target bad can't do watch")
+      self.assertEqual(result.stderr, b"")
+
+  def test_run(self):
+      report, ok = batch.command([os.path.join(self.dir, "nightly.yaml"), "--jobs", "2"])
+      self.assertTrue(ok)
+      for name in ["songbook.pdf", "songbook.html", "one.cho_key_C.pdf", "three.cho_key_C.pdf", "ukulele_soprano_ukulele.pdf"]:
+          self.assertTrue(os.path.exists(os.path.join(self.dir, "out", name)))
+      # Seven songs in all, but only three different ones (two of them with and without chord grids)
+      self.assertTrue("3 targets, 0 failed" in report)
+      self.assertTrue("5 songs parsed, 2 shared" in report)
+      for name in ["book", "sheets", "ukulele"]:
+          self.assertTrue("\n%s " % name in report)
+
+      # A target that fails doesn't stop the others
+      self.write("nightly.yaml", "targets:\n  missing:\n    files: [missing.cho]\n  one:\n    files: [one.cho]\n    one_doc: true\n")
+      results = batch.run(batch.load(os.path.join(self.dir, "nightly.yaml")), self.dir)
+      self.assertTrue(results[0]["error"].startswith("FileNotFoundError"))
+      self.assertEqual(results[1]["outputs"], [os.path.join(self.dir, ".", "one.cho_key_C.pdf")])
+
+if __name__ == '__main__':
+    unittest.main()
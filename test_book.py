@@ -2,10 +2,20 @@
 import unittest
 import tempfile
 import chordprobook.books as books
+import chordprobook.cache as cache
 import chordprobook.chords as chords
+import chordprobook.renderers as renderers
 import os
+import subprocess
+import sys
 
 class TestStuff(unittest.TestCase):
+  def setUp(self):
+      self.cache = cache.TemporaryCache()
+
+  def tearDown(self):
+      self.cache.cleanup()
+
   def test_chord_markup_normaliser(self):
      self.assertEqual(books.normalize_chord_markup("xxxxxxx[A] yyyy"), "xxxxxxx [A] yyyy")
      self.assertEqual(books.normalize_chord_markup("[A]yyyy"), "[A] yyyy")
@@ -15,6 +25,12 @@ class TestStuff(unittest.TestCase):
      self.assertEqual(books.normalize_chord_markup("When he chucked me off the[D] pier at Woolloomoo[G]loo [C] [G]"), "When he chucked me off the [D] pier at Woolloomoo[G]loo [C] [G]")
 
 
+  def test_lazy_imports(self):
+     # Importing the package shouldn't drag in the heavy dependencies, they load when first used
+     loaded = subprocess.check_output([sys.executable, "-c",
+                                       "import sys, chordprobook.books; print([m for m in ['PIL', 'pypandoc', 'yaml'] if m in sys.modules])"])
+     self.assertEqual(loaded.decode().strip(), "[]")
+
   def test_TOC(self):
       #Check that we can build a table of contents and split it across multiple pages when necessary
       book_text = ""
@@ -66,6 +82,52 @@ class TestStuff(unittest.TestCase):
       self.assertEqual(result[1]["title"], "This is a second song! (D)")
 
 
+  def test_null_renderer(self):
+      previous = renderers.current()
+      null = renderers.use("null")
+      try:
+          b = books.cp_song_book()
+          b.add_song_from_text("{title: This is a second song!}\n{key: Db}\n{tr: +1 +2}\n[C]Hello", "test1")
+          with tempfile.TemporaryDirectory() as tmp:
+              result = b.save_as_single_sheets(tmp)
+              self.assertEqual(len(result), 3)
+              pdfs = [job["output"] for job in null.jobs if job["tool"] == "wkhtmltopdf"]
+              self.assertEqual(len(pdfs), 3)
+              for pdf in pdfs:
+                  with open(pdf, "rb") as f:
+                      self.assertTrue(f.read().startswith(b"%PDF"))
+
+              self.assertEqual([sheet["paths"] for sheet in result], [[pdf] for pdf in pdfs])
+
+              written = b.output({"html": True, "pdf": True, "docx": False, "odt": False, "epub": False, "a4": True}, os.path.join(tmp, "book"))
+              self.assertEqual(written, [os.path.join(tmp, "book.html"), os.path.join(tmp, "book.pdf")])
+              self.assertTrue(os.path.exists(os.path.join(tmp, "book.html")))
+              self.assertTrue(os.path.exists(os.path.join(tmp, "book.pdf")))
+      finally:
+          renderers.use(previous)
+
+  def test_fragment_cache(self):
+      previous = renderers.current()
+      null = renderers.use("null")
+      try:
+          with tempfile.TemporaryDirectory() as tmp:
+              cache = books.FragmentCache(tmp)
+              song = books.cp_song("{title: Cached}\n{key: C}\n[C]Hello [G]there", transpose=2)
+              song.format(instrument_name="Soprano Ukulele")
+              md = song.to_html_md()
+              self.assertEqual(books.songs_to_html([md, md], cache), [md, md])
+              self.assertEqual(len(null.jobs), 1)
+
+              # A new cache (as in a later run) finds it on disk, in another key it's a new conversion
+              cache = books.FragmentCache(tmp)
+              other = books.cp_song("{title: Cached}\n{key: C}\n[C]Hello [G]there", transpose=3)
+              other.format(instrument_name="Soprano Ukulele")
+              books.songs_to_html([md, other.to_html_md()], cache)
+              self.assertEqual(len(null.jobs), 2)
+              self.assertEqual(cache.hits, 1)
+      finally:
+          renderers.use(previous)
+
   def test_book(self):
       book_path = "samples/sample.book.txt"
       b = books.cp_song_book(path=book_path)
@@ -206,6 +268,13 @@ class TestStuff(unittest.TestCase):
         self.assertEqual(page % 2, 0)
       page += song.pages
 
+    # Big books used to run out of stack
+    book = books.cp_song_book()
+    for i in range(3000):
+      book.add_song_from_text(two1 if i % 3 == 0 else one1, str(i))
+    book.reorder(1, old=None, new_order=[], waiting=[])
+    self.assertEqual(len([song for song in book.songs if not song.blank]), 3000)
+
   def test_auto_transpose(self):
       song1 =  books.cp_song("{title: 1 page}\n{key: C}\n{transpose: +2 -3}")
       self.assertEqual(song1.standard_transpositions, [0, 2, -3])
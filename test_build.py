@@ -0,0 +1,129 @@
+#!usr/bin/env python3
+import unittest
+import os
+import tempfile
+import time
+import chordprobook.build as build
+import chordprobook.cache as cache
+import chordprobook.renderers as renderers
+
+class TestBuild(unittest.TestCase):
+  def setUp(self):
+      self.previous = renderers.current()
+      renderers.use("null")
+      self.cache = cache.TemporaryCache()
+      self.tmp = tempfile.TemporaryDirectory()
+      self.dir = self.tmp.name
+      for name in ["one", "two"]:
+          self.write("%s.cho" % name, "{title: Song %s}\n{key: C}\n[C]Hello [G]there\n" % name)
+      self.write("book.txt", "{title: Watched}\none.cho\ntwo.cho\n")
+
+  def tearDown(self):
+      renderers.use(self.previous)
+      self.cache.cleanup()
+      self.tmp.cleanup()
+
+  def write(self, name, text):
+      path = os.path.join(self.dir, name)
+      with open(path, "w") as f:
+          f.write(text)
+      # Make sure the change shows, however coarse the file system's timestamps
+      stamp = time.time() + len(text)
+      os.utime(path, (stamp, stamp))
+      return path
+
+  def test_build(self):
+      args = build.prepare(build.default_args(files=["one.cho"], html=True))
+      written = build.build(args, cwd=self.dir)
+      self.assertEqual(written, [os.path.join(self.dir, ".", "songbook.html")])
+      with self.assertRaises(ValueError):
+          build.default_args(no_such_option=True)
+
+  def test_manifest(self):
+      args = build.prepare(build.default_args(book_file="book.txt", one_doc=True))
+      sheets = [os.path.join(self.dir, ".", name) for name in ["one.cho_key_C.pdf", "two.cho_key_C.pdf"]]
+      self.assertEqual(build.build(args, cwd=self.dir), sheets)
+      self.assertTrue(os.path.exists(os.path.join(self.dir, build.books.Manifest.file_name)))
+
+      # Nothing changed, so nothing is made, but the outputs are still listed
+      made = len(renderers.current().jobs)
+      self.assertEqual(build.build(args, cwd=self.dir), sheets)
+      self.assertEqual(len(renderers.current().jobs), made)
+
+      # A transposition changes one sheet
+      self.write("book.txt", "{title: Watched}\none.cho {transpose: +2}\ntwo.cho\n")
+      build.build(args, cwd=self.dir)
+      self.assertEqual([job["output"] for job in renderers.current().jobs[made:] if job["tool"] == "wkhtmltopdf"],
+                       [os.path.join(self.dir, ".", "one.cho_key_D.pdf")])
+
+      made = len(renderers.current().jobs)
+      build.build(dict(args, force=True), cwd=self.dir)
+      self.assertEqual(len([job for job in renderers.current().jobs[made:] if job["tool"] == "wkhtmltopdf"]), 2)
+
+  def test_all_keys(self):
+      self.write("keyless.cho", "{title: Keyless}\n[Am]Hello [G/B]there\n")
+      args = build.prepare(build.default_args(files=["one.cho", "keyless.cho"], one_doc=True, all_keys=True))
+      written = build.build(args, cwd=self.dir)
+      keys = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+      self.assertEqual(written[:12], [os.path.join(self.dir, ".", "one.cho_key_%s.pdf" % key) for key in keys])
+      self.assertEqual(written[12:], [os.path.join(self.dir, ".", "keyless.cho%s.pdf" % ("_%s" % trans if trans else "")) for trans in range(12)])
+
+      # The same parsed song, in each key
+      song = build.books.cp_song("{title: Keyless}\n[Am]Hello [G/B]there\n")
+      chords_in = []
+      for trans in song.all_keys():
+          song.set_transpose(trans)
+          song.format(transpose=trans)
+          chords_in.append(song.md)
+      self.assertTrue("Am" in chords_in[0] and "G/B" in chords_in[0])
+      self.assertTrue("Bm" in chords_in[2] and "A/C#" in chords_in[2])
+      self.assertTrue("Abm" in chords_in[11] and "F#/Bb" in chords_in[11])
+
+      # Songs transposed in the book still start from the key they're written in
+      self.write("book.txt", "{title: Transposed}\none.cho {transpose: +2}\n")
+      args = build.prepare(build.default_args(book_file="book.txt", one_doc=True, all_keys=True))
+      written = build.build(args, cwd=self.dir)
+      self.assertEqual(written[:12], [os.path.join(self.dir, ".", "one.cho_key_%s.pdf" % key) for key in keys])
+      song = build.books.cp_song("{title: One}\n{key: C}\n[C]Hello [G]there\n", transpose=2)
+      song.set_transpose(0)
+      song.format(transpose=0)
+      self.assertEqual(song.key, "C")
+      self.assertTrue('<span class="chord">C</span>' in song.md and '<span class="chord">D</span>' not in song.md)
+
+  def test_watch_book(self):
+      args = build.prepare(build.default_args(book_file="book.txt", html=True))
+      watcher = build.Watcher(args, cwd=self.dir)
+      watcher.build()
+      self.assertEqual(sorted(watcher.stamps), sorted(os.path.join(self.dir, name) for name in ["book.txt", "one.cho", "two.cho"]))
+      self.assertEqual(watcher.changes(), set())
+
+      path = self.write("two.cho", "{title: Song two, again}\n[D]Changed\n")
+      self.assertEqual(watcher.changes(), {path})
+      watcher.build(watcher.changes())
+      with open(os.path.join(self.dir, "songbook.html")) as f:
+          self.assertTrue("Song two, again" in f.read())
+      # The other song came from the cache
+      self.assertEqual(watcher.song_cache.hits, 1)
+      self.assertEqual(watcher.changes(), set())
+
+  def test_watch_sheets(self):
+      args = build.prepare(build.default_args(book_file="book.txt", one_doc=True))
+      watcher = build.Watcher(args, cwd=self.dir)
+      self.assertEqual(len(watcher.build()), 2)
+      path = self.write("one.cho", "{title: Song one}\n{key: D}\n[D]Changed\n")
+      # Only the changed song's sheet is made again
+      self.assertEqual(watcher.build(watcher.changes()), [os.path.join(self.dir, ".", "one.cho_key_D.pdf")])
+
+      self.write("book.txt", "{title: Watched}\none.cho\n")
+      self.assertEqual(watcher.build(watcher.changes()), [os.path.join(self.dir, ".", "one.cho_key_D.pdf")])
+
+      # A change to the book along with a song (that has other inputs) affects all the songs
+      self.write("page.png", "not really")
+      self.write("one.cho", "{title: Song one}\n{key: D}\n{page_image: page.png}\n[D]Changed\n")
+      watcher.build(watcher.changes())
+      self.write("one.cho", "{title: Song one}\n{key: E}\n{page_image: page.png}\n[E]Changed again\n")
+      self.write("book.txt", "{title: Watched}\none.cho\ntwo.cho\n")
+      self.assertEqual(sorted(watcher.build(watcher.changes())), [os.path.join(self.dir, ".", name) for name in ["one.cho_key_E.pdf", "two.cho_key_C.pdf"]])
+
+if __name__ == '__main__':
+    unittest.main()
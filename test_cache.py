@@ -0,0 +1,63 @@
+#!usr/bin/env python3
+import unittest
+import os
+import time
+import chordprobook.cache as cache
+
+class TestCache(unittest.TestCase):
+  def setUp(self):
+      self.tmp = cache.TemporaryCache()
+      cache.counters.clear()
+
+  def tearDown(self):
+      self.tmp.cleanup()
+
+  def test_namespace(self):
+      namespace = cache.Namespace("diagrams")
+      self.assertEqual(namespace.get("ab" * 32, ".png"), None)
+      path = namespace.put("ab" * 32, b"png", ".png")
+      self.assertEqual(path, os.path.join(self.tmp.name, "diagrams", "ab", "ab" * 32 + ".png"))
+      self.assertEqual(namespace.get("ab" * 32, ".png"), b"png")
+      self.assertEqual(namespace.lookup("ab" * 32, ".png"), path)
+      self.assertEqual(cache.counters["diagrams"], {"hits": 2, "misses": 1, "writes": 1})
+      # Keys that aren't hashes go straight in the directory
+      self.assertEqual(namespace.put("GCEA.fingerings", "text"), os.path.join(self.tmp.name, "diagrams", "GCEA.fingerings"))
+
+  def test_prune(self):
+      namespace = cache.Namespace("pdf-parts")
+      for i in range(5):
+          path = namespace.put("%064x" % i, b"x" * 100, ".pdf")
+          os.utime(path, (time.time() - 1000 + i, time.time() - 1000 + i))
+      # Using the oldest one makes it the newest
+      namespace.get("%064x" % 0, ".pdf")
+      self.assertEqual(namespace.prune(250), (3, 300))
+      self.assertEqual(sorted(os.path.basename(path) for path, size, used in namespace.entries()),
+                       ["%064x.pdf" % 0, "%064x.pdf" % 4])
+
+      os.environ["CHORDPROBOOK_CACHE_LIMITS"] = "diagrams=1M, pdf-parts=100"
+      self.assertEqual(cache.budget("pdf-parts"), 100)
+      self.assertEqual(cache.budget("html-fragments"), cache.budgets["html-fragments"])
+      # Writing to a namespace that's over budget prunes it at the end of the build
+      cache.record()
+      self.assertEqual(len(namespace.entries()), 1)
+
+  def test_stats(self):
+      namespace = cache.Namespace("html-fragments")
+      namespace.put("%064x" % 1, "<p>Hello</p>", ".html")
+      namespace.get("%064x" % 1, ".html")
+      namespace.get("%064x" % 2, ".html")
+      cache.record()
+      namespace.get("%064x" % 1, ".html")
+      cache.record()
+      stats = dict((s["name"], s) for s in cache.stats())
+      self.assertEqual((stats["html-fragments"]["entries"], stats["html-fragments"]["bytes"]), (1, 12))
+      self.assertEqual((stats["html-fragments"]["hits"], stats["html-fragments"]["misses"]), (2, 1))
+      self.assertEqual(stats["diagrams"]["hit_rate"], None)
+      self.assertTrue("html-fragments" in cache.command(["stats"]))
+
+      self.assertEqual(cache.command(["clear", "html-fragments"]), "html-fragments: removed 1 entries, 12B")
+      cache.command(["clear"])
+      self.assertEqual(cache.recorded(), ({}, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,23 @@
 #!usr/bin/env python3
 import unittest
 import copy
+import chordprobook.cache
 import chordprobook.chords
 import chordprobook.chords as chords
 import chordprobook.instruments
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class TestChorddiagram(unittest.TestCase):
-        
+  def setUp(self):
+      self.cache = chordprobook.cache.TemporaryCache()
+
+  def tearDown(self):
+      self.cache.cleanup()
+
   def test_notes(self):
       N = chordprobook.chords.Note
       self.assertEqual(N("C#").num, N("Db").num)
@@ -75,7 +86,86 @@ class TestChorddiagram(unittest.TestCase):
 
      print(c7.to_chordpro())
 
-     
+  def test_guitar_chord_finder(self):
+     guitar = chordprobook.instruments.Instrument(data = {"name": "Guitar", "tuning" : "EADGBE"})
+
+     E = chordprobook.chords.Chord('E')
+     E.find_fingerings(guitar, unplayed=0)
+     self.assertTrue([0, 2, 2, 1, 0, 0] in E._fingering_array)
+
+     # Open C needs the bottom string left unplayed
+     C = chordprobook.chords.Chord('C')
+     C.find_fingerings(guitar, unplayed=0)
+     self.assertFalse([-1, 3, 2, 0, 1, 0] in C._fingering_array)
+     C.find_fingerings(guitar, unplayed=1)
+     self.assertTrue([-1, 3, 2, 0, 1, 0] in C._fingering_array)
+
+  def test_shape_library(self):
+     library = chordprobook.chords.ShapeLibrary()
+     guitar = chordprobook.instruments.Instrument(data = {"name": "Guitar", "tuning" : "EADGBE"})
+     for name in ["C", "F#m", "Bb7", "Ebmaj7", "G#dim", "A9"]:
+         from_shapes = chordprobook.chords.Chord(name)
+         from_shapes.find_fingerings(guitar, unplayed=1, library=library)
+         searched = chordprobook.chords.Chord(name)
+         searched.find_fingerings(guitar, unplayed=1)
+         self.assertEqual(from_shapes._fingering_array, searched._fingering_array)
+
+     # Shapes are shared between tunings with the same intervals
+     uke = chordprobook.instruments.Instrument(data = {"name": "Uke", "tuning" : "GCEA"})
+     baritone = chordprobook.instruments.Instrument(data = {"name": "Baritone", "tuning" : "DGBE"})
+     C = chordprobook.chords.Chord('C')
+     C.find_fingerings(uke, library=library)
+     num_shapes = len(library.shapes)
+     G = chordprobook.chords.Chord('G')
+     G.find_fingerings(baritone, library=library)
+     self.assertEqual(len(library.shapes), num_shapes)
+     self.assertEqual(C._fingering_array, G._fingering_array)
+
+  def test_job_without_numpy(self):
+     # Without NumPy, generator jobs find the same fingerings from shapes shared between roots and tunings
+     import sys
+     import unittest.mock
+     names = [root + variant for root in ["C", "F#", "Bb"] for variant in ["", "m", "7"]]
+     expected = []
+     for name in names:
+         chord = chordprobook.chords.Chord(name)
+         chord.find_fingerings(chordprobook.instruments.Instrument(data = {"name": "Uke", "tuning" : "GCEA"}), 4, 4, 1)
+         expected.append((chord.name, chord._fingering_array))
+     chordprobook.chords.shape_library.shapes.clear()
+     with unittest.mock.patch.dict(sys.modules, {"numpy": None}):
+         self.assertEqual(chordprobook.chords.find_fingerings_job(("GCEA", names, 4, 4, 1)), expected)
+         num_shapes = len(chordprobook.chords.shape_library.shapes)
+         self.assertEqual(num_shapes, 3)
+         chordprobook.chords.find_fingerings_job(("DGBE", names, 4, 4, 1))
+     self.assertEqual(len(chordprobook.chords.shape_library.shapes), num_shapes)
+
+  @unittest.skipIf(numpy == None, "NumPy not installed")
+  def test_batch_chord_finder(self):
+     # Batch search should find exactly what the one-chord-at-a-time search does
+     for tuning in ["GCEA", "EADGBE"]:
+         instrument = chordprobook.instruments.Instrument(data = {"name": tuning, "tuning" : tuning})
+         batch = [chordprobook.chords.Chord(name) for name in ["C", "C#m", "D7", "Ebmaj7", "F6", "Gsus4", "A9", "Badd9", "Bdim"]]
+         chordprobook.chords.BatchFingerings(instrument, max_unplayed_strings=1).find(batch)
+         for chord in batch:
+             single = chordprobook.chords.Chord(chord.name)
+             single.find_fingerings(instrument, unplayed=1)
+             self.assertEqual(chord._fingering_array, single._fingering_array)
+
+  def test_chart_generator(self):
+     # Same chart whether or not the work is shared out between processes
+     serial = chordprobook.chords.ChartGenerator(variants=["", "m", "7"], processes=1).charts(["GCEA"])
+     # Start again with nothing stored
+     chordprobook.chords.FingeringStore.loaded.clear()
+     chordprobook.cache.Namespace("fingerings").clear()
+     parallel = chordprobook.chords.ChartGenerator(variants=["", "m", "7"], processes=2).charts(["GCEA", "EADGBE"])
+     self.assertEqual(serial["GCEA"].all_to_chordpro(), parallel["GCEA"].all_to_chordpro())
+     self.assertEqual(len(parallel["EADGBE"].grids), 36)
+     self.assertEqual(parallel["GCEA"].get_default("C").to_chordpro(), "{define: C frets 0 0 0 3}")
+
+     # A job per tuning, unless there are processes to spare
+     self.assertEqual(chordprobook.chords.ChartGenerator(processes=4).root_groups(["GCEA", "EADGBE", "DGBE", "GDAE"]), [range(0, 12)])
+     self.assertEqual(chordprobook.chords.ChartGenerator(processes=1).root_groups(["GCEA"]), [range(0, 12)])
+     self.assertEqual(chordprobook.chords.ChartGenerator(processes=3).root_groups(["GCEA"]), [range(0, 4), range(4, 8), range(8, 12)])
 
 if __name__ == '__main__':
     unittest.main()
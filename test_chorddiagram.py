@@ -1,11 +1,18 @@
 #!usr/bin/env python3
 import unittest
+import os
+import tempfile
+import chordprobook.cache as cache
 import chordprobook.chords
 import chordprobook.chords as chords
 import chordprobook.instruments
 
 class TestChorddiagram(unittest.TestCase):
+  def setUp(self):
+      self.cache = cache.TemporaryCache()
 
+  def tearDown(self):
+      self.cache.cleanup()
 
   def test_init(self):
     """
@@ -270,6 +277,59 @@ class TestChorddiagram(unittest.TestCase):
        self.assertEqual(c_chord.root.num, N("C").num)
        print(str(c_chord.spell()))
        self.assertEqual(c_chord.spell(), [N('C').num, N('Eb').num, N('G').num])
+  def test_compiled_chart(self):
+      with tempfile.TemporaryDirectory() as tmp:
+          source = os.path.join(tmp, "test_chords.cho")
+          with open(source, "w") as f:
+              f.write("{c: A}\n{define: A frets 2 1 0 0 fingers 2 1 0 0}\n")
+              f.write("{define: Amaj frets 2 1 0 4}\n")
+              f.write("{define: Bb7 base-fret 7 frets 1 x 3 4 add: string 1 fret 3 finger 4}\n")
+          compiled = chords.CompiledChart.load(source, tmp)
+          self.assertTrue(os.path.exists(compiled.path))
+          self.assertEqual(list(compiled.index.keys()), ["A", "Bb7"])
+          self.assertEqual(compiled.definition(compiled.index["A"][0]), (0, [2, 1, 0, 0], ["2", "1", "0", "0"], []))
+
+          # Read back, gives the same chart as the text
+          reread = chords.CompiledChart(source, tmp)
+          self.assertTrue(reread.read())
+          self.assertEqual(reread.data, compiled.data)
+          for lefty in [False, True]:
+              text = chords.ChordChart(lefty=lefty)
+              text.load_file(open(source))
+              from_compiled = chords.ChordChart(lefty=lefty)
+              from_compiled.index, from_compiled.compiled = reread.index, reread
+              self.assertEqual(from_compiled.all_to_chordpro(), text.all_to_chordpro())
+
+          # Stale once the source changes
+          with open(source, "a") as f:
+              f.write("{define: C frets 0 0 0 3}\n")
+          self.assertFalse(chords.CompiledChart(source, tmp).read())
+          self.assertTrue("C" in chords.CompiledChart.load(source, tmp).index)
+
+  def test_diagram_store(self):
+      name, lefty, drawn, stored = chords.prewarm_job(("Mandolin", True))
+      self.assertEqual((name, lefty, stored), ("Mandolin", True, 0))
+      self.assertTrue(drawn > 100)
+      self.assertEqual(chords.prewarm_job(("Mandolin", True))[2:], (0, drawn))
+
+      # A new process (no diagrams in memory) gets them from the store instead of drawing them
+      diagram = chords.ChordDiagram()
+      diagram.parse_definition("{define: Zz frets 2 1 0 0}")
+      uri = diagram.to_data_URI()
+      del chords.ChordDiagram.data_URIs[diagram.drawing_key()]
+      hits = chords.DiagramStore.hits
+      self.assertEqual(diagram.to_data_URI(), uri)
+      self.assertEqual(chords.DiagramStore.hits, hits + 1)
+
+      # Named diagrams are stored under the chart's spelling, the name as a song writes it is drawn
+      mandolin = chordprobook.instruments.Instruments().get_instrument_by_name("Mandolin")
+      mandolin.load_chord_chart(lefty=True)
+      chords.ChordDiagram.data_URIs.clear()
+      hits, misses = chords.DiagramStore.hits, chords.DiagramStore.misses
+      mandolin.chart.grid_as_md("Cmaj7", display_name=True)
+      self.assertEqual((chords.DiagramStore.hits, chords.DiagramStore.misses), (hits + 1, misses))
+      mandolin.chart.grid_as_md("CM7", display_name=True)
+      self.assertEqual((chords.DiagramStore.hits, chords.DiagramStore.misses), (hits + 1, misses + 1))
 
 if __name__ == '__main__':
     unittest.main()
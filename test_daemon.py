@@ -0,0 +1,94 @@
+#!usr/bin/env python3
+import unittest
+import json
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import chordprobook.cache as cache
+import chordprobook.daemon as daemon
+import chordprobook.renderers as renderers
+
+class TestDaemon(unittest.TestCase):
+  def setUp(self):
+      self.previous = renderers.current()
+      renderers.use("null")
+      self.tmp = tempfile.TemporaryDirectory()
+      # A cache of its own, so nothing depends on what other tests left there
+      self.cache = cache.TemporaryCache()
+      self.daemon = daemon.RenderDaemon(port=0, max_concurrent=1, root=self.tmp.name)
+      self.server = self.daemon.make_server()
+      threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def tearDown(self):
+      self.server.shutdown()
+      self.server.server_close()
+      renderers.use(self.previous)
+      self.tmp.cleanup()
+      self.cache.cleanup()
+
+  def call(self, path, request=None, content_type="application/json"):
+      url = "http://127.0.0.1:%s%s" % (self.daemon.port, path)
+      data = json.dumps(request).encode() if request != None else None
+      with urllib.request.urlopen(urllib.request.Request(url, data, {"Content-Type": content_type})) as response:
+          return json.loads(response.read().decode())
+
+  def assertRejected(self, code, request, content_type="application/json"):
+      with self.assertRaises(urllib.error.HTTPError) as e:
+          self.call("/render", request, content_type)
+      self.assertEqual(e.exception.code, code)
+
+  def test_render(self):
+      tmp = self.tmp.name
+      with open(os.path.join(tmp, "song.cho"), "w") as f:
+          f.write("{title: Daemon song}\n{key: C}\n[C]Hello [G]there\n")
+      request = {"files": ["song.cho"], "cwd": tmp, "instrument": "Soprano Ukulele",
+                 "transpose": 2, "formats": ["html", "pdf"], "include_bytes": True}
+      first = self.call("/render", request)
+      self.assertEqual(first["outputs"], [os.path.join(tmp, ".", "songbook_soprano_ukulele.html"),
+                                          os.path.join(tmp, ".", "songbook_soprano_ukulele.pdf")])
+      html = open(first["outputs"][0]).read()
+      self.assertTrue("Daemon song (D)" in html)
+      self.assertEqual(set(first["bytes"]), set(first["outputs"]))
+      # Counts are for the whole process, so only compare them with what they were
+      chart_hits = self.call("/stats")["caches"]["chord_charts"]["hits"]
+      self.call("/render", request)
+
+      stats = self.call("/stats")
+      self.assertEqual(stats["requests"], 2)
+      self.assertEqual(stats["latency_seconds"]["count"], 2)
+      self.assertEqual(stats["caches"]["songs"]["hits"], 1)
+      self.assertEqual(stats["caches"]["songs"]["misses"], 1)
+      # The second build's chart came from the index the daemon made when it started
+      self.assertTrue(stats["caches"]["chord_charts"]["hits"] > chart_hits)
+
+      # Bad requests are the client's fault
+      self.assertRejected(400, {"formats": ["png"]})
+      self.assertRejected(400, {"files": ["song.cho"], "cwd": tmp, "transpose": "up"})
+
+  def test_rejected(self):
+      tmp = self.tmp.name
+      os.mkdir(os.path.join(tmp, "songs"))
+      with open(os.path.join(tmp, "songs", "song.cho"), "w") as f:
+          f.write("{title: Daemon song}\n{key: C}\n[C]Hello [G]there\n")
+      with tempfile.TemporaryDirectory() as outside:
+          # Forms (which any web page can send) aren't requests
+          self.assertRejected(415, {"files": ["songs/song.cho"]}, "application/x-www-form-urlencoded")
+          self.assertRejected(415, {"files": ["songs/song.cho"]}, "text/plain")
+          # Nor is writing outside the daemon's directory
+          self.assertRejected(400, {"files": ["song.cho"], "cwd": outside})
+          self.assertRejected(400, {"files": ["songs/song.cho"], "directory": outside})
+          self.assertRejected(400, {"files": ["songs/song.cho"], "file_stem": "../../songbook"})
+          self.assertRejected(400, {"files": ["songs/song.cho"], "one_doc": True, "directory": "../.."})
+          self.assertEqual(os.listdir(outside), [])
+      self.assertEqual(self.call("/render", {"files": ["songs/song.cho"], "one_doc": True, "directory": ".."})["outputs"],
+                       [os.path.join(tmp, "songs", "..", "song.cho_key_C.pdf")])
+
+  def test_percentile(self):
+      self.assertEqual(daemon.percentile([], 0.5), None)
+      self.assertEqual(daemon.percentile([1, 2, 3, 4], 0.5), 3)
+      self.assertEqual(daemon.percentile(list(range(100)), 0.99), 99)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,20 @@
 import unittest
+import os
 import chordprobook
+import chordprobook.cache
+import chordprobook.chords as chords
 import chordprobook.instruments as inst
 
 class TestIntruments(unittest.TestCase):
   """
   Check that we can recognize tunings from instrument names
   """
+  def setUp(self):
+    self.cache = chordprobook.cache.TemporaryCache()
+
+  def tearDown(self):
+    self.cache.cleanup()
+
   def test_instruments(self):
     instruments = inst.Instruments()
     ukes = instruments.get_instruments_by_tuning("GCEA")
@@ -28,9 +37,63 @@ class TestIntruments(unittest.TestCase):
     uke = instruments.get_instrument_by_name("Uke")
     uke.load_chord_chart(lefty=True)
     chord = uke.chart.get_default("C7")
-    self.assertEqual(chord.to_chordpro(),"{define: C7 frets 1 0 0 0}") 
+    self.assertEqual(chord.to_chordpro(),"{define: C7 frets 1 0 0 0}")
+
+  def test_lazy_chart(self):
+    instruments = inst.Instruments()
+    baritone = instruments.get_instrument_by_name("Baritone Ukulele")
+    baritone.load_chord_chart()
+    # Nothing parsed until it's asked for, names are already transposed
+    self.assertEqual(baritone.chart.grids, {})
+    self.assertEqual(baritone.chart.get_default("G").to_chordpro(), "{define: G frets 0 0 0 3}")
+    self.assertEqual(list(baritone.chart.grids.keys()), ["G"])
+
+    # Local definitions still go in front of the ones from the file
+    baritone.chart.add_grid("{define: G frets 0 0 0 0}")
+    self.assertEqual(baritone.chart.get_default("G").to_chordpro(), "{define: G frets 0 0 0 0}")
+    baritone.chart.add_grid("{define: D frets 0 0 0 0}")
+    self.assertEqual(len(baritone.chart.grids["D"].voicings), len(baritone.chart.index["D"]) + 1)
+
+    path = os.path.join(os.path.dirname(chords.__file__), baritone.chord_definitions)
+    eager = chords.ChordChart(baritone.transpose, path)
+    lazy = chords.ChordChart(baritone.transpose, path, lazy=True)
+    self.assertEqual(lazy.all_to_chordpro(), eager.all_to_chordpro())
+
+
+  def test_fingering_store(self):
+    instruments = inst.Instruments()
+    uke = instruments.get_instrument_by_name("Uke")
+    uke.load_chord_chart()
+    # Not in the uke chart file, so gets worked out and saved
+    self.assertFalse("Cadd9" in uke.chart.grids)
+    chord = uke.chart.get_default("Cadd9")
+    self.assertNotEqual(chord, None)
+    self.assertEqual(uke.chart.get_default("Cxyz"), None)
+    store = uke.fingering_store()
+    # Saved once, at the end of the build
+    self.assertFalse(os.path.exists(store.path))
+    chords.FingeringStore.save_all()
+    self.assertTrue(os.path.exists(store.path))
+    self.assertEqual(chords.FingeringStore.unsaved, {})
+
+    # Read back from disk
+    del chords.FingeringStore.loaded[store.path]
+    reloaded = chords.FingeringStore("GCEA")
+    self.assertEqual(reloaded.fingerings, store.fingerings)
+    self.assertEqual(reloaded.fingerings["Cxyz"], [])
+
+    # Two processes that read the file before either saved it keep each other's fingerings
+    del chords.FingeringStore.loaded[store.path]
+    first = chords.FingeringStore("GCEA")
+    del chords.FingeringStore.loaded[store.path]
+    second = chords.FingeringStore("GCEA")
+    first.get(uke, "Dadd9")
+    second.get(uke, "Eadd9")
+    first.save()
+    second.save()
+    del chords.FingeringStore.loaded[store.path]
+    self.assertTrue(all(name in chords.FingeringStore("GCEA") for name in ["Cadd9", "Cxyz", "Dadd9", "Eadd9"]))
 
-      
 if __name__ == '__main__':
     print (dir(inst))
     unittest.main()
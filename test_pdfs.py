@@ -0,0 +1,147 @@
+#!usr/bin/env python3
+import unittest
+import os
+import tempfile
+import chordprobook.books as books
+import chordprobook.cache as cache
+import chordprobook.renderers as renderers
+import chordprobook.pdfs as pdfs
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+@unittest.skipIf(pypdf == None, "needs pypdf")
+class TestPDFs(unittest.TestCase):
+  def setUp(self):
+      self.previous = renderers.current()
+      renderers.use("null")
+      self.tmp = tempfile.TemporaryDirectory()
+      self.cache = cache.TemporaryCache()
+
+  def tearDown(self):
+      renderers.use(self.previous)
+      self.cache.cleanup()
+      self.tmp.cleanup()
+
+  def test_merge(self):
+      one = os.path.join(self.tmp.name, "one.pdf")
+      two = os.path.join(self.tmp.name, "two.pdf")
+      with open(one, "wb") as f:
+          f.write(pdfs.text_pdf([[(72, 770, 12, "One")]]))
+      with open(two, "wb") as f:
+          f.write(pdfs.text_pdf([[(72, 770, 12, "Two")], [(72, 770, 12, "Two, page 2")]]))
+      self.assertEqual(pdfs.page_count(two), 2)
+
+      book = os.path.join(self.tmp.name, "book.pdf")
+      self.assertEqual(pdfs.merge([(one, "Book"), (two, "Song <i>two</i>")], book, header_left="Book&nbsp;title"), 3)
+      reader = pypdf.PdfReader(book)
+      self.assertEqual([item.title for item in reader.outline], ["Book", "Song two"])
+      self.assertEqual([reader.get_destination_page_number(item) for item in reader.outline], [0, 1])
+      text = reader.pages[2].extract_text()
+      self.assertTrue("Two, page 2" in text)
+      self.assertTrue("3/3" in text)
+      self.assertTrue("Book\xa0title" in text or "Book title" in text)
+
+  def test_split(self):
+      batch = os.path.join(self.tmp.name, "batch.pdf")
+      one, two = [os.path.join(self.tmp.name, name) for name in ["one.pdf", "two.pdf"]]
+      with open(batch, "wb") as f:
+          f.write(pdfs.text_pdf([[(72, 770, 12, "Page %s" % page)] for page in range(3)], outline = [("One", 0), ("Two (D)", 2)]))
+      # Three pages either way, but the second document starts on page 2 not page 1
+      self.assertFalse(pdfs.split(batch, [(one, 1, "One"), (two, 2, "Two (D)")]))
+      self.assertFalse(os.path.exists(one))
+      self.assertFalse(pdfs.split(batch, [(one, 2, "One"), (two, 1, "Two (E)")]))
+      self.assertTrue(pdfs.split(batch, [(one, 2, "One"), (two, 1, "Two&nbsp;(D)")]))
+      self.assertEqual([pdfs.page_count(one), pdfs.page_count(two)], [2, 1])
+      self.assertTrue("Page 2" in pypdf.PdfReader(two).pages[0].extract_text())
+
+  def test_assemble(self):
+      book = books.cp_song_book(keep_order=True)
+      book.title = "Assembled"
+      book.add_song_from_text("{title: Short}\n[C]One page\n", "short.cho")
+      book.add_song_from_text("{title: Long}\n[C]First page\n{new_page}\n[G]Second page\n", "long.cho")
+      self.assertEqual([song.pages for song in book.songs], [1, 2])
+      args = {"html": False, "pdf": True, "docx": False, "odt": False, "epub": False, "a4": True, "assemble": True}
+      path = os.path.join(self.tmp.name, "book")
+      self.assertEqual(book.output(args, path), [path + ".pdf"])
+
+      # The null renderer's placeholders are one page each, so the contents go by that
+      self.assertEqual([song.pages for song in book.songs], [1, 1])
+      self.assertTrue("Short  <span style='float:right'> 3</span>" in book.contents)
+      self.assertTrue("Long  <span style='float:right'> 4</span>" in book.contents)
+      reader = pypdf.PdfReader(path + ".pdf")
+      self.assertEqual(len(reader.pages), 3)
+      self.assertEqual([item.title for item in reader.outline], ["Assembled", "Short", "Long"])
+
+      # Nothing changed, so every part comes from the cache
+      jobs = len(renderers.current().jobs)
+      book.output(args, path)
+      self.assertEqual([job["tool"] for job in renderers.current().jobs[jobs:] if job["tool"] == "wkhtmltopdf"], [])
+
+      # Helvetica can't write this title in the headers, so the book is rendered whole
+      book.title = "Песни"
+      jobs = len(renderers.current().jobs)
+      book.output(args, path)
+      pdf_jobs = [job for job in renderers.current().jobs[jobs:] if job["tool"] == "wkhtmltopdf"]
+      self.assertEqual(len(pdf_jobs), 1)
+      self.assertTrue("Песни" in pdf_jobs[0]["options"])
+
+  def test_shards(self):
+      book = books.cp_song_book()
+      book.title = "Sharded"
+      for i in range(20):
+          page_break = "{new_page}\n[G]Second page\n" if i % 3 == 0 else ""
+          book.add_song_from_text("{title: Song %s}\n[C]First page\n%s" % (i, page_break), "%s.cho" % i)
+      book.format()
+      total, plan = book.shard_plan(4)
+      self.assertEqual(len(plan), 4)
+      self.assertEqual(total, 1 + book.toc_pages + sum(song.pages for song in book.songs))
+      self.assertEqual([song for first_page, songs in plan for song in songs], book.songs)
+      # Shards start on right hand pages, straight after the one before
+      page = 2 + book.toc_pages
+      for number, (first_page, songs) in enumerate(plan):
+          if number > 0:
+              self.assertEqual(first_page, page)
+              self.assertEqual(first_page % 2, 1)
+          page += sum(song.pages for song in songs)
+
+      args = {"html": False, "pdf": True, "docx": False, "odt": False, "epub": False, "a4": True, "shards": 4}
+      path = os.path.join(self.tmp.name, "book")
+      jobs = len(renderers.current().jobs)
+      book.output(args, path)
+      pdf_jobs = [job for job in renderers.current().jobs[jobs:] if job["tool"] == "wkhtmltopdf"]
+      self.assertEqual(len(pdf_jobs), 4)
+      offsets = [job["options"][job["options"].index("--page-offset") + 1] for job in pdf_jobs]
+      self.assertEqual(offsets, [str(first_page - 1) for first_page, songs in plan])
+      self.assertTrue("[page]/%s" % total in pdf_jobs[0]["options"])
+      self.assertEqual(pdfs.page_count(path + ".pdf"), 4)
+
+  def test_batch_sheets(self):
+      book = books.cp_song_book()
+      book.add_song_from_text("{title: Batched}\n{key: C}\n{tr: +2 +5}\n[C]Hello", "batched")
+      args = {"pdf": True, "docx": False, "odt": False, "epub": False, "batch_pdf": True}
+      jobs = len(renderers.current().jobs)
+      result = book.save_as_single_sheets(self.tmp.name, args)
+      # One job for all three sheets, split up into the usual files
+      pdf_jobs = [job for job in renderers.current().jobs[jobs:] if job["tool"] == "wkhtmltopdf"]
+      self.assertEqual(len(pdf_jobs), 1)
+      self.assertEqual(len(pdf_jobs[0]["input"]), 3)
+      self.assertEqual([sheet["path"] for sheet in result],
+                       [os.path.join(self.tmp.name, name) for name in ["batched_key_C.pdf", "batched_key_D.pdf", "batched_key_F.pdf"]])
+      for sheet in result:
+          self.assertEqual(pdfs.page_count(sheet["path"]), 1)
+
+      # The long song's sheet should have two pages but the null renderer only makes one,
+      # so the batch doesn't add up and the sheets are made one at a time
+      book.add_song_from_text("{title: Long}\n{key: G}\n[G]One\n{new_page}\n[C]Two", "long")
+      jobs = len(renderers.current().jobs)
+      result = book.save_as_single_sheets(self.tmp.name, args)
+      pdf_jobs = [job for job in renderers.current().jobs[jobs:] if job["tool"] == "wkhtmltopdf"]
+      self.assertEqual([len(job["input"]) if isinstance(job["input"], list) else 1 for job in pdf_jobs], [4, 1, 1, 1, 1])
+      self.assertEqual(result[-1]["path"], os.path.join(self.tmp.name, "long_key_G.pdf"))
+      self.assertTrue(os.path.exists(result[-1]["path"]))
+
+if __name__ == '__main__':
+    unittest.main()
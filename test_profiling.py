@@ -0,0 +1,76 @@
+#!usr/bin/env python3
+import unittest
+import os
+import json
+import tempfile
+import chordprobook.books as books
+import chordprobook.cache as cache
+import chordprobook.profiling as profiling
+
+class TestProfiling(unittest.TestCase):
+  def setUp(self):
+      self.cache = cache.TemporaryCache()
+
+  def tearDown(self):
+      self.cache.cleanup()
+      profiling.profiler.enabled = False
+      profiling.profiler.spans = []
+
+  def test_disabled(self):
+      # Nothing recorded unless the profiler has been turned on
+      with profiling.span("nothing"):
+          pass
+      self.assertEqual(profiling.profiler.spans, [])
+
+  def test_spans(self):
+      profiling.profiler.enable()
+      with profiling.span("outer"):
+          with profiling.span("inner", "song", song="My Song"):
+              sum(range(1000))
+      inner, outer = profiling.profiler.spans
+      self.assertEqual(inner.parent, "outer")
+      self.assertEqual(inner.depth, 1)
+      self.assertTrue(outer.wall >= inner.wall)
+
+      summary = profiling.profiler.summary()
+      self.assertTrue("outer" in summary)
+      self.assertTrue("My Song" in summary)
+
+      trace = profiling.profiler.to_chrome_trace()
+      self.assertEqual([event["name"] for event in trace["traceEvents"]], ["outer", "inner"])
+      self.assertEqual(trace["traceEvents"][1]["args"]["song"], "My Song")
+
+      with tempfile.TemporaryDirectory() as tmp:
+          profile_path, trace_path = profiling.profiler.save(os.path.join(tmp, "test"))
+          with open(profile_path) as f:
+              self.assertEqual(len(json.load(f)["spans"]), 2)
+          with open(trace_path) as f:
+              self.assertEqual(len(json.load(f)["traceEvents"]), 2)
+
+  def test_song_spans(self):
+      profiling.profiler.enable()
+      song = books.cp_song("{title: Profiled}\n[C]Hello")
+      song.format()
+      names = [(span.name, span.args.get("song")) for span in profiling.profiler.spans]
+      self.assertEqual(names, [("cp_song.parse", "Profiled"), ("cp_song.format", "Profiled")])
+
+  def test_book_spans(self):
+      import chordprobook.build as build
+      import chordprobook.renderers as renderers
+      previous = renderers.current()
+      renderers.use("null")
+      try:
+          with tempfile.TemporaryDirectory() as tmp:
+              with open(os.path.join(tmp, "song.cho"), "w") as f:
+                  f.write("{title: Profiled}\n[C]Hello")
+              profiling.profiler.enable()
+              build.build(build.prepare(build.default_args(files=["song.cho"], html=True)), cwd=tmp)
+      finally:
+          renderers.use(previous)
+      # Saving the book takes in formatting it and converting it
+      saves = [span for span in profiling.profiler.spans if span.name == "cp_song_book.save"]
+      self.assertEqual(len(saves), 1)
+      self.assertTrue("cp_song_book.format" in [span.name for span in profiling.profiler.spans if span.parent == "cp_song_book.save"])
+
+if __name__ == '__main__':
+    unittest.main()
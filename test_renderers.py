@@ -0,0 +1,90 @@
+#!usr/bin/env python3
+import unittest
+import sys
+import time
+import chordprobook.renderers as renderers
+
+def python_job(code, input = None):
+    return renderers.Job("python", [sys.executable, "-c", code], input = input)
+
+class TestRenderers(unittest.TestCase):
+  def test_jobs(self):
+      renderer = renderers.PandocRenderer(concurrency = 4, timeout = 1, retries = 1)
+      echo = python_job("import sys; sys.stdout.write(sys.stdin.read().upper())", b"hello")
+      fail = python_job("import sys; sys.stderr.write('Broken'); sys.exit(3)")
+      hang = python_job("import time; time.sleep(30)")
+      start = time.perf_counter()
+      renderer.run([echo, fail, hang])
+      # The hung job is killed (and retried once) rather than holding things up
+      self.assertTrue(time.perf_counter() - start < 10)
+
+      self.assertTrue(echo.ok)
+      self.assertEqual(echo.output, "HELLO")
+      self.assertEqual((fail.returncode, fail.stderr, fail.attempts), (3, "Broken", 1))
+      self.assertTrue(hang.timed_out)
+      self.assertEqual(hang.attempts, 2)
+      self.assertFalse(hang.ok)
+      self.assertTrue("timed out" in hang.describe())
+
+  def test_concurrency(self):
+      renderer = renderers.PandocRenderer(concurrency = 3)
+      jobs = [python_job("import time; time.sleep(0.5)") for i in range(3)]
+      start = time.perf_counter()
+      renderer.run(jobs)
+      self.assertTrue(time.perf_counter() - start < 1.4)
+      self.assertTrue(all(job.ok for job in jobs))
+
+  def test_jobs_in_threads(self):
+      # As the daemon, batch builds and the API run them
+      import concurrent.futures
+      renderer = renderers.PandocRenderer(concurrency = 2)
+      def run(word):
+          return renderer.run([python_job("import sys; sys.stdout.write(sys.stdin.read().upper())", word.encode("utf-8")),
+                               python_job("print('%s')" % word)])
+      with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as pool:
+          results = list(pool.map(run, ["one", "two"]))
+      self.assertEqual([[job.output.strip() for job in jobs] for jobs in results], [["ONE", "one"], ["TWO", "two"]])
+
+  def test_null_jobs(self):
+      null = renderers.NullRenderer()
+      job = null.run([null.convert_job("Some *text*", "html", format="md")])[0]
+      self.assertEqual((job.ok, job.output), (True, "Some *text*"))
+      self.assertEqual(null.jobs[0]["tool"], "pandoc")
+
+  def test_pdf_engines(self):
+      renderer = renderers.PandocRenderer(pdf_engine = "wkhtmltopdf")
+      job = renderer.html_to_pdf_job(["a.html", "b.html"], "out.pdf", ["-s", "A4"])
+      self.assertEqual(job.command, ["wkhtmltopdf", "-s", "A4", "a.html", "b.html", "out.pdf"])
+      with self.assertRaises(ValueError):
+          renderer.use_pdf_engine("no-such-engine")
+
+      css = renderers.WeasyPrintEngine().stylesheet(['--outline', '--header-left', 'My "book"', '--header-right', '[page]/[toPage]',
+                                                     '--margin-top', '26', '--outline-depth', '1', '-s', 'A4', '--page-offset', '4'])
+      self.assertTrue('@top-left { content: "My \\"book\\""' in css)
+      self.assertTrue('@top-right { content: counter(page) "/" counter(pages)' in css)
+      self.assertTrue("margin-top: 26mm;" in css)
+      self.assertTrue("counter-reset: page 5" in css)
+      self.assertTrue("h2 { bookmark-level: none }" in css)
+      self.assertFalse("h1 { bookmark-level: none }" in css)
+
+  def test_in_process_engine(self):
+      # Engines without a command run in a thread, alongside programs
+      class Engine(renderers.PDFEngine):
+          name = "test"
+          def render(self, html_paths, pdf_path, options):
+              if html_paths == ["broken.html"]:
+                  raise ValueError("Can't render")
+              self.rendered = html_paths
+
+      renderer = renderers.PandocRenderer(concurrency = 2)
+      renderer.pdf_engine = Engine()
+      good = renderer.html_to_pdf_job("song.html", "song.pdf")
+      bad = renderer.html_to_pdf_job("broken.html", "broken.pdf")
+      renderer.run([good, bad, python_job("print('hi')")])
+      self.assertTrue(good.ok)
+      self.assertEqual(renderer.pdf_engine.rendered, ["song.html"])
+      self.assertEqual(bad.returncode, 1)
+      self.assertTrue("Can't render" in bad.stderr)
+
+if __name__ == '__main__':
+    unittest.main()